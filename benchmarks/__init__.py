@@ -0,0 +1,5 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/24
+# src - __init__.py
+# md
+# --------------------------------------------------------------------------------------------------------
@@ -0,0 +1,125 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/24
+# src - bench_format_tweets.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from database.twitter_facade import _format_tweets_df, _tweets_df_to_records, tweets_columns
+
+"""
+Micro-benchmark of the tweets normalization in save_tweets: the columnar _format_tweets_df against the former row-wise version.
+Both versions run on identical twint-like frames and must produce identical records.
+
+Usage: python -m benchmarks.bench_format_tweets --sizes 10000 100000 200000
+"""
+
+
+def make_tweets_df(n, seed=0):
+    """Returns a frame with the columns and dtypes of twint.storage.panda.Tweets_df"""
+    rnd = random.Random(seed)
+    usernames = ['Bart_DeWever', 'JanJambon', 'conner_rousseau', 'MeyremAlmaci', 'tomvangrieken']
+    start = datetime(2010, 1, 1)
+    rows = []
+    for i in range(n):
+        tweet_id = str(1000000000000000000 + i)
+        dt = start + timedelta(seconds=rnd.randrange(10 * 365 * 24 * 3600))
+        is_reply = rnd.random() < 0.3
+        reply_to = [{'user_id': str(rnd.randrange(10 ** 9)), 'username': rnd.choice(usernames)} for _ in range(rnd.randrange(1, 4))] if is_reply else []
+        rows.append({'id': tweet_id,
+                     'conversation_id': str(int(tweet_id) - rnd.randrange(1, 1000)) if is_reply else tweet_id,
+                     'created_at': dt.timestamp() * 1000,
+                     'date': dt.strftime('%Y-%m-%d %H:%M:%S'),
+                     'timezone': '+0200',
+                     'place': '',
+                     'tweet': f'Tweet nr {i} over de begroting en de regering #{i % 97}',
+                     'language': 'nl',
+                     'hashtags': [f'#{i % 97}'],
+                     'cashtags': [],
+                     'user_id': rnd.randrange(10 ** 9),
+                     'user_id_str': '',
+                     'username': rnd.choice(usernames),
+                     'name': 'Name',
+                     'day': dt.isoweekday(),
+                     'hour': dt.strftime('%H'),
+                     'link': f'https://twitter.com/x/status/{tweet_id}',
+                     'urls': [],
+                     'photos': [],
+                     'video': 0,
+                     'thumbnail': '',
+                     'retweet': False,
+                     'nlikes': rnd.randrange(1000),
+                     'nreplies': rnd.randrange(100),
+                     'nretweets': rnd.randrange(100),
+                     'quote_url': '',
+                     'search': '',
+                     'near': '',
+                     'geo': '',
+                     'source': '',
+                     'user_rt_id': '',
+                     'user_rt': '',
+                     'retweet_id': '',
+                     'reply_to': reply_to,
+                     'retweet_date': '',
+                     'translate': '',
+                     'trans_src': '',
+                     'trans_dest': ''})
+    return pd.DataFrame(rows)
+
+
+def _legacy_format_tweets_df(df):
+    # The row-wise normalization as it was in save_tweets
+    df = df.rename(columns={'id': 'tweet_id'})
+    df['user_id'] = df['user_id'].apply(str)
+    df['username'] = df['username'].str.lower()
+
+    def f(lst):
+        for dct in lst:
+            dct['username'] = dct['username'].lower()
+
+    df['reply_to'].apply(lambda x: f(x))
+    df['is_reply'] = df['tweet_id'] != df['conversation_id']
+    df['datetime'] = pd.to_datetime(df['date'], format='%Y-%m-%d %H:%M:%S')
+    df['date'] = df['datetime'].dt.date.apply(str)
+    df['time'] = df['datetime'].dt.time.apply(str)
+    return df
+
+
+def _legacy_records(df):
+    return _legacy_format_tweets_df(df)[tweets_columns].to_dict('records')
+
+
+def _records(df):
+    return _tweets_df_to_records(_format_tweets_df(df))
+
+
+def bench(n, repeat=3):
+    timings = {}
+    results = {}
+    for name, func in [('legacy', _legacy_records), ('columnar', _records)]:
+        best = float('inf')
+        for _ in range(repeat):
+            df = make_tweets_df(n)  # New frame every run: both versions lowercase the reply_to dicts in place
+            start = time.perf_counter()
+            records = func(df)
+            best = min(best, time.perf_counter() - start)
+        timings[name], results[name] = best, records
+    identical = results['legacy'] == results['columnar'] and all(list(a) == list(b) for a, b in zip(results['legacy'], results['columnar']))
+    return timings, identical
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the tweets normalization')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 200000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"n_tweets":>10} {"legacy (s)":>12} {"columnar (s)":>14} {"speedup":>9} {"identical":>10}')
+    for n in args.sizes:
+        t, identical = bench(n, args.repeat)
+        print(f'{n:>10} {t["legacy"]:>12.3f} {t["columnar"]:>14.3f} {t["legacy"] / t["columnar"]:>8.1f}x {str(identical):>10}')
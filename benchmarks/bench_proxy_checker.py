@@ -0,0 +1,153 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/31
+# src - bench_proxy_checker.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import sys
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from business.proxy_checker import ProxyChecker
+
+"""
+Check and benchmark of the ProxyChecker against a local stand-in of the proxies, without network and without mongodb.
+
+- FakeProxies: in its own process, listens on one port per fake proxy. The checker sends its requests through the proxy
+  http://127.0.0.1:port and the stand-in answers them itself, as the kind of proxy of the port:
+    - ok:          the test page and an exit ip of its own
+    - captive:     a login page of a hotspot iso the test page
+    - transparent: the test page, but the exit ip is the ip of this host
+    - error:       502 Bad Gateway
+    - slow:        answers after the read timeout
+    - closed:      nothing listens on the port
+  The origin port serves the test page and the ip of the caller to the direct requests of the checker.
+- Every kind of proxy must get its error_code, only the 'ok' proxies pass. The misclassified proxies are printed, exit code 1.
+
+Usage: python -m benchmarks.bench_proxy_checker --proxies 300 --concurrency 100 [--json]
+"""
+kinds = ('ok', 'captive', 'transparent', 'error', 'slow', 'closed')
+expected = {'ok': (False, 0), 'captive': (True, 1), 'transparent': (True, 1), 'error': (True, 1), 'slow': (True, 2), 'closed': (True, 3)}
+test_content = 'twitter'
+test_page = '<html><head><title>Twitter</title></head><body>Mobile Twitter</body></html>'
+captive_page = '<html><head><title>Hotspot</title></head><body>Log in to use the wifi</body></html>'
+
+
+class FakeProxies:
+    """
+    Stand-in of the proxies on the ports of 'port_kinds' {port: kind} and of the test site on 'origin_port'. Answers the absolute-form
+    requests the clients send to an http proxy.
+    """
+
+    def __init__(self, port_kinds, origin_port, slow_seconds=3):
+        self.port_kinds = dict(port_kinds)
+        self.origin_port = origin_port
+        self.slow_seconds = slow_seconds
+        self._process = None
+
+    @property
+    def test_url(self):
+        return f'http://127.0.0.1:{self.origin_port}/page'
+
+    @property
+    def ip_url(self):
+        return f'http://127.0.0.1:{self.origin_port}/ip'
+
+    def start(self):
+        ready = mp.Event()
+        self._process = mp.Process(target=self._serve, args=(ready,), name='fake-proxies', daemon=True)
+        self._process.start()
+        if not ready.wait(30):
+            raise RuntimeError('The fake proxies did not start')
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+        self._process = None
+
+    def _serve(self, ready):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_get('/page', self._page)
+        app.router.add_get('/ip', self._ip)
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        for port in [self.origin_port] + [port for port, kind in self.port_kinds.items() if kind != 'closed']:
+            loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port, backlog=1024).start())
+        ready.set()
+        loop.run_forever()
+
+    def _kind(self, request):
+        port = request.transport.get_extra_info('sockname')[1]
+        return 'origin' if port == self.origin_port else self.port_kinds[port]
+
+    async def _answer(self, kind):
+        # The answer of a proxy that isn't ok, None for an ok proxy
+        if kind == 'error':
+            return web.Response(status=502, text='Bad Gateway')
+        if kind == 'captive':
+            return web.Response(text=captive_page, content_type='text/html')
+        if kind == 'slow':
+            await asyncio.sleep(self.slow_seconds)
+        return None
+
+    async def _page(self, request):
+        return await self._answer(self._kind(request)) or web.Response(text=test_page, content_type='text/html')
+
+    async def _ip(self, request):
+        kind = self._kind(request)
+        if kind in ('origin', 'transparent'):
+            return web.Response(text=request.remote)
+        port = request.transport.get_extra_info('sockname')[1]
+        return await self._answer(kind) or web.Response(text=f'203.0.113.{port % 250 + 1}')
+
+
+def run(n_proxies, concurrency, base_port, read_timeout):
+    port_kinds = {base_port + 1 + i: kinds[i % len(kinds)] for i in range(n_proxies)}
+    fake = FakeProxies(port_kinds, base_port, slow_seconds=read_timeout + 2).start()
+    try:
+        checker = ProxyChecker(test_url=fake.test_url, concurrency=concurrency, connect_timeout=read_timeout, read_timeout=read_timeout,
+                               expected_content=test_content, ip_url=fake.ip_url)
+        start_time = time.perf_counter()
+        proxy_tests = checker.check_proxies([{'ip': '127.0.0.1', 'port': str(port)} for port in port_kinds], save=False)
+        seconds = time.perf_counter() - start_time
+    finally:
+        fake.stop()
+    misclassified = [(port_kinds[int(t['port'])], t) for t in proxy_tests
+                     if (t['blacklisted'], t['error_code']) != expected[port_kinds[int(t['port'])]]]
+    return {'proxies': len(proxy_tests), 'seconds': seconds, 'proxies_per_second': len(proxy_tests) / seconds,
+            'passed': sum(not t['blacklisted'] for t in proxy_tests),
+            'error_codes': dict(Counter(t['error_code'] for t in proxy_tests)),
+            'host_ip': checker.host_ip, 'misclassified': misclassified}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the ProxyChecker against a local stand-in of the proxies')
+    parser.add_argument('--proxies', type=int, default=len(kinds) * 50)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--base-port', type=int, default=18300, help='Port of the test site, the proxies listen on the next ports')
+    parser.add_argument('--read-timeout', type=float, default=1)
+    parser.add_argument('--json', action='store_true', help='Print the results as one json line')
+    args = parser.parse_args()
+
+    result = run(args.proxies, args.concurrency, args.base_port, args.read_timeout)
+    if args.json:
+        print(json.dumps(result, default=str))
+    else:
+        print(f'{result["proxies"]} proxies in {result["seconds"]:.2f}s, {result["proxies_per_second"]:.0f} proxies/s, '
+              f'{result["passed"]} passed, error codes {result["error_codes"]}, ip of this host {result["host_ip"]}')
+        for kind, proxy_test in result['misclassified']:
+            print(f'Misclassified {kind} proxy, expected {expected[kind]}: {proxy_test}')
+    sys.exit(1 if result['misclassified'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/31
+# src - bench_scraping.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing as mp
+import os
+import random
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import twint.get
+import twint.url
+from aiohttp import web, ClientHttpProxyError, ServerDisconnectedError, RequestInfo
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from business.fetch_engine import FetchEngine
+from business.scraping_controller import TwitterScrapingSession
+from database.config_facade import conf_all
+from database.connection import get_client
+from database.profile_queries import get_collection as get_profiles_collection
+from database.proxy_facade import save_proxy_tests
+from database.tweet_queries import get_collection as get_tweets_collection
+from tools import metrics
+from tools.logger import logger
+
+"""
+End-to-end benchmark of TwitterScrapingSession.start_scraping without Twitter and without real proxies.
+
+- FakeTwitter: a local stand-in of the Twitter search timeline, in its own process. It listens on one port per fake proxy. The scrapers
+  send their requests through the proxy http://127.0.0.1:port and the stand-in answers them itself, with the latency of that proxy.
+  Every user has 'tweets_per_day' tweets a day, served in pages of 'page_size' tweets.
+- Fake proxy pool: the ports of the stand-in, saved as tested proxies in the benchmark database. The session populates its ProxyPool
+  from the database as usual. A fraction 'bad_proxies' of them is slower and fails more often.
+- Fault injection: the page requests of both fetch engines (twint.get.RequestUrl and FetchEngine._fetch_page) fail at random with the
+  errors of the real network: ServerDisconnectedError, ClientHttpProxyError and TimeoutError. The faults are raised at the request
+  iso on the wire, because a proxy can only refuse a CONNECT and the stand-in speaks plain http.
+- Results: from the metrics registry of the session (tools/metrics.py): tweets/sec, percentiles of the period latency, mongo writes/sec
+  per collection and the errors per type. --json prints them as one line, to compare runs.
+
+Runs against the local mongod (config 'mongo_uri') in the database 'twitter_benchmark', which is dropped at the start.
+The scraping_controller sleeps 10 seconds after every fault, as in production.
+
+Usage: python -m benchmarks.bench_scraping --users 20 --days 60 --tweets-per-day 10 --engine async --faults 0.01 0.01 0.01
+"""
+benchmark_database = 'twitter_benchmark'
+# Fine buckets for the percentiles, from 10ms to 10min in steps of 25%
+benchmark_buckets = tuple(round(0.01 * 1.25 ** i, 4) for i in range(62))
+
+
+def _tweet_html(tweet_id, username, ms):
+    # A tweet of the search timeline with the attributes twint.tweet.Tweet reads
+    stats = ''.join(f'<span class="ProfileTweet-action--{action} u-hiddenVisually"><span data-tweet-stat-count="{n}"></span></span>'
+                    for n, action in enumerate(['reply', 'retweet', 'favorite']))
+    return (f'<div class="tweet" data-item-id="{tweet_id}" data-conversation-id="{tweet_id}" data-user-id="{zlib.crc32(username.encode())}" '
+            f'data-screen-name="{username}" data-name="{username}" data-reply-to-users-json="[]" data-mentions="">'
+            f'<span class="_timestamp" data-time-ms="{ms}"></span>'
+            f'<p class="tweet-text">Tweet {tweet_id} van {username} over de begroting #benchmark</p>{stats}</div>')
+
+
+class FakeTwitter:
+    """
+    Stand-in of https://twitter.com/i/search/timeline on the ports of the fake proxies. Answers the absolute-form requests the clients
+    send to an http proxy. The tweets of a user are the same in every run: the search pages are made from the query.
+    """
+
+    def __init__(self, ports, tweets_per_day=10, page_size=20, latency=0.2, slow_ports=(), slow_factor=5, seed=0):
+        self.ports = list(ports)
+        self.tweets_per_day = tweets_per_day
+        self.page_size = page_size
+        self.latency = latency  # seconds, mean per request
+        self.slow_ports = set(slow_ports)
+        self.slow_factor = slow_factor
+        self.seed = seed
+        self._process = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.ports[0]}/i'
+
+    def start(self):
+        ready = mp.Event()
+        self._process = mp.Process(target=self._serve, args=(ready,), name='fake-twitter', daemon=True)
+        self._process.start()
+        if not ready.wait(30):
+            raise RuntimeError('The fake Twitter server did not start')
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+        self._process = None
+
+    def _serve(self, ready):
+        self._random = random.Random(self.seed)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_get('/i/search/timeline', self._search)
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        for port in self.ports:
+            loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port, backlog=1024).start())
+        ready.set()
+        loop.run_forever()
+
+    def _tweets(self, username, since, until):
+        # [(tweet_id, ms), ...] of the user from since until until (excluded), epoch seconds
+        tweets = []
+        user_key = zlib.crc32(username.encode()) % 10 ** 6
+        for day in range(since - since % 86400, until, 86400):
+            for k in range(self.tweets_per_day):
+                timestamp = day + (k + 1) * 86400 // (self.tweets_per_day + 1)
+                if since <= timestamp < until:
+                    tweets.append((f'{user_key:06d}{timestamp // 86400:06d}{k:05d}', timestamp * 1000))
+        tweets.reverse()  # Newest first, like Twitter
+        return tweets
+
+    async def _search(self, request):
+        port = request.transport.get_extra_info('sockname')[1]
+        latency = self.latency * (self.slow_factor if port in self.slow_ports else 1)
+        await asyncio.sleep(self._random.uniform(0.5, 1.5) * latency)
+        terms = dict(term.split(':', 1) for term in request.query['q'].split() if ':' in term)
+        tweets = self._tweets(terms['from'], int(terms['since']), int(terms['until']))
+        position = request.query.get('max_position', '-1')
+        offset = 0 if position == '-1' else int(position)
+        page = tweets[offset:offset + self.page_size]
+        items_html = ''.join(_tweet_html(tweet_id, terms['from'], ms) for tweet_id, ms in page)
+        return web.json_response({'items_html': items_html, 'min_position': str(offset + len(page))})
+
+
+class FaultInjector:
+    """
+    Makes the page requests of the fetch engines fail at random. 'rates' is the probability per request of every fault, a bad proxy
+    fails 'bad_factor' times more often. A 'timeout' fault waits 'timeout' seconds before it raises, like a stalled request.
+    install() patches the requests in this process, the workers of the session inherit the patches.
+    """
+    faults = ('disconnect', 'proxy_error', 'timeout')
+
+    def __init__(self, rates, bad_proxies=(), bad_factor=5, timeout=5, seed=0):
+        self.rates = dict(zip(self.faults, rates))
+        self.bad_proxies = set(bad_proxies)  # {'ip:port', ...}
+        self.bad_factor = bad_factor
+        self.timeout = timeout
+        self.seed = seed
+        self._random, self._pid = None, None
+
+    def draw(self, proxy):
+        if self._pid != os.getpid():  # Every worker its own sequence
+            self._random, self._pid = random.Random(f'{self.seed}-{os.getpid()}'), os.getpid()
+        factor = self.bad_factor if proxy in self.bad_proxies else 1
+        x = self._random.random()
+        for fault, rate in self.rates.items():
+            x -= rate * factor
+            if x < 0: return fault
+        return None
+
+    async def fail(self, fault, url):
+        if fault == 'disconnect':
+            raise ServerDisconnectedError()
+        if fault == 'proxy_error':
+            request_info = RequestInfo(URL(url), 'GET', CIMultiDictProxy(CIMultiDict()), URL(url))
+            raise ClientHttpProxyError(request_info, (), status=502, message='Bad Gateway')
+        await asyncio.sleep(self.timeout)
+        raise asyncio.TimeoutError()
+
+    def wrap(self, request, proxy_of):
+        @functools.wraps(request)
+        async def request_with_faults(*args, **kwargs):
+            proxy = proxy_of(*args, **kwargs)
+            fault = self.draw(proxy)
+            if fault: await self.fail(fault, f'http://{proxy}/i/search/timeline')
+            return await request(*args, **kwargs)
+
+        return request_with_faults
+
+    def install(self):
+        twint.get.RequestUrl = self.wrap(twint.get.RequestUrl, lambda config, *args, **kwargs: f'{config.Proxy_host}:{config.Proxy_port}')
+        FetchEngine._fetch_page = self.wrap(FetchEngine._fetch_page, lambda engine, session, proxy_url, *args: proxy_url[len('http://'):])
+
+
+def histogram_quantile(q, buckets, counts):
+    # The q-quantile of a histogram, interpolated in its bucket like Prometheus. counts: per bucket, the last one is +Inf
+    total = sum(counts)
+    if not total: return None
+    rank, cumulative = q * total, 0
+    for i, count in enumerate(counts):
+        if count and cumulative + count >= rank:
+            if i == len(buckets): return buckets[-1]  # In +Inf
+            lower = buckets[i - 1] if i else 0
+            return lower + (buckets[i] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return buckets[-1]
+
+
+def setup_database(usernames, begin_date, proxies):
+    # Fresh benchmark database with a profile per user and the fake proxies as tested proxies
+    get_client().drop_database(benchmark_database)
+    get_profiles_collection().insert_many([{'user_id': str(zlib.crc32(username.encode())), 'username': username, 'join_date': str(begin_date)}
+                                           for username in usernames])
+    save_proxy_tests([{'ip': ip, 'port': port, 'delay': 1, 'blacklisted': False, 'error_code': 200} for ip, port in proxies])
+
+
+def report(snapshot, wall_time, n_tweets_in_db):
+    counters, histograms, buckets = snapshot['counters'], snapshot['histograms'], snapshot['buckets']
+    periods = {dict(labels)['status']: n for (name, labels), n in counters.items() if name == 'twitter_periods_total'}
+    errors = {dict(labels)['error']: n for (name, labels), n in counters.items() if name == 'twitter_scrape_errors_total'}
+    n_tweets = counters.get(('twitter_tweets_saved_total', ()), 0)
+    period_counts = histograms.get(('twitter_period_seconds', ()), [0] * (len(buckets) + 2))[:-1]
+    writes = {}
+    for (name, labels), histogram in histograms.items():
+        if name != 'twitter_mongo_write_seconds': continue
+        n_writes = sum(histogram[:-1])
+        writes[dict(labels)['collection']] = {'writes_per_sec': n_writes / wall_time, 'mean_ms': 1000 * histogram[-1] / n_writes if n_writes else None}
+    return {'wall_seconds': wall_time,
+            'periods_ok': periods.get('ok', 0),
+            'periods_fail': periods.get('fail', 0),
+            'errors': errors,
+            'tweets_saved': n_tweets,
+            'tweets_in_db': n_tweets_in_db,
+            'tweets_per_sec': n_tweets / wall_time,
+            'period_seconds': {f'p{int(q * 100)}': histogram_quantile(q, buckets, period_counts) for q in (0.5, 0.9, 0.99)},
+            'mongo_writes': writes,
+            'worker_cpu_seconds': counters.get(('twitter_worker_cpu_seconds_total', ()), 0)}
+
+
+def print_report(args, result):
+    print(f'engine={args.engine} processes={args.processes} users={args.users} days={args.days} tweets/day={args.tweets_per_day} '
+          f'proxies={args.proxies} faults={args.faults}')
+    print(f'wall {result["wall_seconds"]:.1f}s, worker cpu {result["worker_cpu_seconds"]:.1f}s')
+    print(f'periods ok={result["periods_ok"]} fail={result["periods_fail"]}, errors {result["errors"]}')
+    print(f'tweets saved {result["tweets_saved"]}, in db {result["tweets_in_db"]}, {result["tweets_per_sec"]:.1f} tweets/s')
+    print('period latency ' + ', '.join(f'{p}={s:.2f}s' for p, s in result['period_seconds'].items() if s is not None))
+    for collection, w in sorted(result['mongo_writes'].items()):
+        print(f'mongo {collection:<12} {w["writes_per_sec"]:8.1f} writes/s, mean {w["mean_ms"]:.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--days', type=int, default=60, help='Length of the session, until today')
+    parser.add_argument('--period-days', type=int, default=10, help='time_delta of the session')
+    parser.add_argument('--tweets-per-day', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.2, help='Mean seconds per request of a good proxy')
+    parser.add_argument('--proxies', type=int, default=50)
+    parser.add_argument('--bad-proxies', type=float, default=0.1, help='Fraction of slow proxies that fail more often')
+    parser.add_argument('--faults', type=float, nargs=3, default=[0.01, 0.01, 0.01], metavar=('DISCONNECT', 'PROXY_ERROR', 'TIMEOUT'),
+                        help='Probability per request of each fault on a good proxy')
+    parser.add_argument('--timeout', type=float, default=5, help='Seconds a timeout fault stalls')
+    parser.add_argument('--engine', choices=['twint', 'async'], default='twint')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--port', type=int, default=18000, help='First port of the fake proxies')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve the metrics during the run')
+    parser.add_argument('--profiling', choices=['stages', 'cprofile', 'sampling'], default=None, help='See tools/profiling.py')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    logger.setLevel(args.log_level)
+    for handler in logger.handlers: handler.setLevel(args.log_level)
+    end_date = datetime.today().date()
+    begin_date = end_date - timedelta(days=args.days)
+    usernames = [f'bench_user_{i:04d}' for i in range(args.users)]
+    ports = list(range(args.port, args.port + args.proxies))
+    bad_ports = random.Random(args.seed).sample(ports, int(args.bad_proxies * args.proxies))
+
+    conf_all.update({'database': benchmark_database,
+                     'n_processes': args.processes,
+                     'session_begin_date': begin_date,
+                     'session_end_date': end_date,
+                     'time_delta': args.period_days,
+                     'tweets_per_period': None,  # Fixed periods, the benchmark database has no tweets yet
+                     'scrape_only_missing_dates': False,
+                     'fetch_engine': args.engine,
+                     'metrics_port': None,
+                     'profiling': args.profiling,
+                     'worker_start_method': 'fork'})  # The workers inherit the fault injection and twint.url.base
+
+    fake_twitter = FakeTwitter(ports, args.tweets_per_day, args.page_size, args.latency, bad_ports, seed=args.seed).start()
+    twint.url.base = fake_twitter.base_url
+    conf_all['fetch_base_url'] = fake_twitter.base_url
+    FaultInjector(args.faults, [f'127.0.0.1:{port}' for port in bad_ports], timeout=args.timeout, seed=args.seed).install()
+    setup_database(usernames, begin_date, [('127.0.0.1', str(port)) for port in ports])
+
+    metrics.start_metrics(args.metrics_port, buckets=benchmark_buckets)  # The session leaves it running for the report
+    try:
+        session = TwitterScrapingSession()
+        start_time = time.time()
+        session.tweets.users_list(usernames, only_new=False).start_scraping()
+        wall_time = time.time() - start_time
+        result = report(metrics.snapshot(), wall_time, get_tweets_collection().count_documents({}))
+    finally:
+        metrics.stop_metrics()
+        fake_twitter.stop()
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print_report(args, result)
+
+
+if __name__ == '__main__':
+    main()
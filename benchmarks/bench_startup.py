@@ -0,0 +1,99 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/31
+# src - bench_startup.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from database.config_facade import conf_all
+
+"""
+Startup cost of a scraping session and memory of its workers, without mongodb and without network.
+
+- Import: time, max RSS and nr of modules of 'import business.scraping_controller' in a fresh interpreter, and whether twint got imported.
+- Pool: time to start a worker_pool and run one task on every worker, for the start methods 'fork' and 'forkserver'. The second pool
+  of a session reuses the fork server, the first one also starts it.
+- Workers: RSS, PSS and USS (private memory) of every worker, from /proc/<pid>/smaps_rollup (Linux). The PSS shares the pages a worker
+  shares with its parent and its siblings among them, the sum of the PSS is the memory the pool really costs.
+
+Usage: python -m benchmarks.bench_startup --processes 8 [--json]
+"""
+import_script = """
+import json, resource, sys, time
+start_time = time.perf_counter()
+import business.scraping_controller
+print(json.dumps({'seconds': time.perf_counter() - start_time, 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'modules': len(sys.modules), 'twint': 'twint' in sys.modules}))
+"""
+
+
+def _memory(pid='self'):
+    # {'rss': MB, 'pss': MB, 'uss': MB} of a process
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                values[fields[0].rstrip(':')] = int(fields[1]) / 1024
+    return {'rss': values['Rss'], 'pss': values['Pss'], 'uss': values['Private_Clean'] + values['Private_Dirty']}
+
+
+def _worker_task(delay):
+    # Keeps the worker busy so every worker of the pool gets a task
+    time.sleep(delay)
+    return os.getpid(), 'twint' in sys.modules
+
+
+def import_cost():
+    result = subprocess.run([sys.executable, '-c', import_script], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def pool_cost(start_method, processes):
+    # Starts 2 pools, returns the startup time of both and the memory of the workers of the second one
+    from business.scraping_controller import worker_pool
+    conf_all['worker_start_method'] = start_method
+    result = {}
+    for pool_name in ('first_pool_seconds', 'second_pool_seconds'):
+        start_time = time.perf_counter()
+        with worker_pool(processes) as pool:
+            workers = dict(pool.map(_worker_task, [0.2] * processes, chunksize=1))
+            result[pool_name] = time.perf_counter() - start_time - 0.2
+            memory = [_memory(pid) for pid in workers]
+    result['workers'] = len(workers)
+    result['workers_with_twint'] = sum(workers.values())
+    for key in ('rss', 'pss', 'uss'):
+        result[f'worker_{key}_mb'] = sum(m[key] for m in memory) / len(memory)
+    result['pool_pss_mb'] = sum(m['pss'] for m in memory)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time and worker memory of a scraping session')
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--start-methods', nargs='+', default=['fork', 'forkserver'], choices=['fork', 'forkserver'])
+    parser.add_argument('--json', action='store_true', help='Print the results as one json line')
+    args = parser.parse_args()
+
+    result = {'import': import_cost()}
+    for start_method in args.start_methods:
+        result[start_method] = pool_cost(start_method, args.processes)
+    if args.json:
+        print(json.dumps(result))
+        return
+    i = result['import']
+    print(f'import business.scraping_controller: {i["seconds"]:.2f}s, max RSS {i["max_rss_mb"]:.0f} MB, {i["modules"]} modules, twint={i["twint"]}')
+    print(f'{"start method":<12} {"1st pool s":>10} {"2nd pool s":>10} {"RSS MB":>8} {"PSS MB":>8} {"USS MB":>8} {"pool PSS MB":>12}')
+    for start_method in args.start_methods:
+        r = result[start_method]
+        print(f'{start_method:<12} {r["first_pool_seconds"]:>10.2f} {r["second_pool_seconds"]:>10.2f} {r["worker_rss_mb"]:>8.0f} '
+              f'{r["worker_pss_mb"]:>8.0f} {r["worker_uss_mb"]:>8.0f} {r["pool_pss_mb"]:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
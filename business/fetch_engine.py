@@ -0,0 +1,224 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/29
+# src - fetch_engine.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import asyncio
+from datetime import datetime
+from time import strftime, localtime
+
+import aiohttp
+import pandas as pd
+import twint
+import twint.feed
+import twint.output
+import twint.tweet
+import twint.url
+from twint.storage.elasticsearch import hour
+from twint.storage.panda import weekdays
+
+from database.config_facade import Scraping_cfg
+from tools.logger import logger
+
+"""
+Concurrent tweet searches on one asyncio event loop per process.
+
+twint.run.Search keeps its results in the module globals of twint.storage.panda and its http proxy in twint.get.httpproxy, so only one
+search can run per process. The FetchEngine does the http requests of the search itself and only uses the stateless parts of twint
+(twint.url.Search, twint.feed.Json, twint.tweet.Tweet). Every search collects its tweets in its own list, and the searches that use
+the same proxy share one aiohttp session and its connections.
+The result of a search is the DataFrame twint.run.Search leaves in twint.storage.panda.Tweets_df.
+
+IMPLEMENTED FUNCTIONS
+---------------------
+- FetchEngine(concurrency, base_url, timeout, retries)
+- FetchEngine.fetch_tweets(username, begin_date, end_date, proxy)
+- FetchEngine.stream_tweets(username, begin_date, end_date, proxy, position)
+- FetchEngine.run(jobs)
+- AsyncTweetScraper(username, begin_date, end_date).execute_scraping()
+"""
+scraping_cfg = Scraping_cfg()
+
+
+def _proxy_url(proxy):
+    return f'http://{proxy["ip"]}:{proxy["port"]}' if proxy else None
+
+
+def _day_start(date):
+    return datetime(date.year, date.month, date.day)
+
+
+def _search_config(username, begin_date, end_date):
+    # The twint config of a search, only read by the twint url, parse and datecheck functions
+    c = twint.Config()
+    c.Username = username
+    c.Since = str(_day_start(begin_date))  # 'yyyy-mm-dd hh:mm:ss' like twint.run does with datelock
+    c.Until = str(_day_start(end_date))
+    c.TwitterSearch = True
+    c.Profile = False
+    return c
+
+
+def _tweet_record(tw, config):
+    # The tweet as a row of twint.storage.panda.Tweets_df. None for withheld or hidden tweets and tweets outside the period (twint.output.checkData)
+    if tw.find('div', 'StreamItemContent--withheld') is not None or not twint.output.is_tweet(tw):
+        return None
+    t = twint.tweet.Tweet(tw, config)
+    if not t.datestamp:
+        return None
+    date = f'{t.datestamp} {t.timestamp}'
+    if not twint.output.datecheck(date, config):
+        return None
+    return {'id': str(t.id),
+            'conversation_id': t.conversation_id,
+            'created_at': t.datetime,
+            'date': date,
+            'timezone': t.timezone,
+            'place': t.place,
+            'tweet': t.tweet,
+            'hashtags': t.hashtags,
+            'cashtags': t.cashtags,
+            'user_id': t.user_id,
+            'user_id_str': t.user_id_str,
+            'username': t.username,
+            'name': t.name,
+            'day': weekdays[strftime('%A', localtime(t.datetime / 1000))],
+            'hour': hour(t.datetime / 1000),
+            'link': t.link,
+            'retweet': t.retweet,
+            'nlikes': int(t.likes_count),
+            'nreplies': int(t.replies_count),
+            'nretweets': int(t.retweets_count),
+            'quote_url': t.quote_url,
+            'search': str(config.Search),
+            'near': t.near,
+            'geo': t.geo,
+            'source': t.source,
+            'user_rt_id': t.user_rt_id,
+            'user_rt': t.user_rt,
+            'retweet_id': t.retweet_id,
+            'reply_to': t.reply_to,
+            'retweet_date': t.retweet_date,
+            'translate': t.translate,
+            'trans_src': t.trans_src,
+            'trans_dest': t.trans_dest}
+
+
+class FetchEngine:
+    """
+    Runs many tweet searches at once on the event loop of the process. Use it as an async context manager, it closes the sessions:
+
+        async with FetchEngine() as engine:
+            tweets_df = await engine.fetch_tweets('marcdumon', date(2020, 1, 1), date(2020, 1, 11), proxy)
+
+    The callers keep at most 'concurrency' searches in flight by holding engine.semaphore during a search, as run() does.
+    The errors are the ones of twint.run.Search: aiohttp client errors, TimeoutError, and ValueError when the responses stay
+    unparsable after 'retries' attempts.
+    """
+    user_agent = 'Mozilla/5.0 (Windows NT 6.4; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2225.0 Safari/537.36'  # twint search
+    limit = 200000  # Max nr of tweets per search, as _TwitterScraper.twint_limit
+    backoff_exponent = 3  # Seconds to wait after the nth unparsable response: n ** backoff_exponent, as twint
+
+    def __init__(self, concurrency=None, base_url=None, timeout=None, retries=10):
+        self.concurrency = concurrency or scraping_cfg.fetch_concurrency
+        self.base_url = base_url or scraping_cfg.fetch_base_url
+        self.timeout = timeout or scraping_cfg.fetch_timeout
+        self.retries = retries
+        self.semaphore = None
+        self._sessions = {}  # {proxy url: aiohttp.ClientSession}
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+
+    def _session(self, proxy_url):
+        # One session per proxy, so the connections to the proxy are reused by all the searches through it
+        session = self._sessions.get(proxy_url)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(headers={'User-Agent': self.user_agent},
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._sessions[proxy_url] = session
+        return session
+
+    async def fetch_tweets(self, username, begin_date, end_date, proxy=None):
+        # The tweets of username from begin_date until end_date (excluded) as a DataFrame, through proxy {'ip': ip, 'port': port}
+        tweets = []
+        async for records, _ in self._pages(username, begin_date, end_date, proxy):
+            tweets.extend(records)
+        return pd.DataFrame(tweets)
+
+    async def stream_tweets(self, username, begin_date, end_date, proxy=None, position='-1'):
+        """
+        Yields the tweets of fetch_tweets page by page as (tweets_df, position), position is the cursor of the next page.
+        Pass a yielded position to continue the search after that page. Only one page is held in memory.
+        """
+        async for records, position in self._pages(username, begin_date, end_date, proxy, position):
+            yield pd.DataFrame(records), position
+
+    async def _pages(self, username, begin_date, end_date, proxy, position='-1'):
+        config = _search_config(username, begin_date, end_date)
+        proxy_url = _proxy_url(proxy)
+        session = self._session(proxy_url)
+        n_tweets = 0
+        # twint.run doesn't search when since isn't before until
+        while _day_start(begin_date) < _day_start(end_date) and n_tweets < self.limit:
+            feed, position = await self._fetch_page(session, proxy_url, config, position)
+            if not feed: break
+            n_tweets += len(feed)
+            yield [record for record in (_tweet_record(tw, config) for tw in feed) if record], position
+
+    async def _fetch_page(self, session, proxy_url, config, position):
+        # The tweets of one page of the search timeline and the position of the next page
+        url, params, _ = await twint.url.Search(config, position)
+        url = self.base_url + url[len(twint.url.base):]
+        attempt = 0
+        while True:
+            async with session.get(url, params=params, proxy=proxy_url) as response:
+                text = await response.text()
+            try:
+                return twint.feed.Json(text)
+            except (ValueError, KeyError, TypeError) as e:  # Sometimes Twitter says there is no data. But it's a lie (twint)
+                attempt += 1
+                if attempt >= self.retries:
+                    raise ValueError(f'No search results after {attempt} attempts: {e}')
+                logger.debug(f'Unparsable search page | {config.Username}, attempt={attempt}, {e}')
+                await asyncio.sleep(round(attempt ** self.backoff_exponent, 1))
+
+    async def _fetch_tweets_in_turn(self, username, begin_date, end_date, proxy=None):
+        async with self.semaphore:
+            return await self.fetch_tweets(username, begin_date, end_date, proxy)
+
+    async def _run(self, jobs):
+        async with self:
+            return await asyncio.gather(*[self._fetch_tweets_in_turn(*job) for job in jobs], return_exceptions=True)
+
+    def run(self, jobs):
+        # Runs the jobs [(username, begin_date, end_date, proxy), ...] on a new event loop. Returns a DataFrame or the exception per job.
+        return asyncio.run(self._run(jobs))
+
+
+class AsyncTweetScraper:
+    """
+    TweetScraper on the FetchEngine, with the same interface and result, for one off searches.
+    The scraping_controller shares one engine between the searches of a process iso using this class.
+    """
+    proxy_server = None  # {'ip':'1.1.1.1', 'port': '123'}
+
+    def __init__(self, username, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1), base_url=None):
+        self.username = username
+        self.begin_date, self.end_date = begin_date, end_date
+        self.base_url = base_url
+
+    def execute_scraping(self):
+        result = FetchEngine(concurrency=1, base_url=self.base_url).run([(self.username, self.begin_date, self.end_date, self.proxy_server)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
@@ -0,0 +1,124 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/25
+# src - proxy_checker.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import asyncio
+import ipaddress
+import time
+from asyncio import TimeoutError, CancelledError
+
+import aiohttp
+from aiohttp import ServerDisconnectedError, ClientHttpProxyError, ClientProxyConnectionError, ClientOSError, ClientError
+
+from database.config_facade import Scraping_cfg, SystemCfg
+from database.proxy_facade import save_proxy_tests
+from tools.logger import logger
+
+system_cfg = SystemCfg()
+scraping_cfg = Scraping_cfg()
+
+
+class ProxyChecker:
+    """
+    Tests proxy servers concurrently on one asyncio event loop.
+    Every proxy gets one GET request to 'test_url' with its own connect and read timeout. The delay is the time to receive the response.
+    The page must contain 'expected_content', so a captive portal or an error page of the proxy doesn't pass. With 'ip_url', a service
+    that answers the ip of the caller, the proxy gets a second request to it: its exit ip must differ from the ip of this host, so a
+    proxy that doesn't hide this host doesn't pass. benchmarks/bench_proxy_checker.py checks it against a local stand-in of the proxies.
+    The results are saved in bulk in the proxies collection with the same error_codes as before:
+        - 0: ok
+        - 1: ValueError (bad response: status, content or exit ip)
+        - 2: asyncio TimeoutError or CancelledError
+        - 3: aiohttp connection errors
+        - 9: unknown error
+    """
+
+    def __init__(self, test_url=None, concurrency=None, connect_timeout=None, read_timeout=None, batch_size=None, expected_content=None,
+                 ip_url=None):
+        # expected_content and ip_url: None takes the config, '' switches the check off
+        self.test_url = test_url or scraping_cfg.proxy_test_url
+        self.expected_content = scraping_cfg.proxy_test_content if expected_content is None else expected_content
+        self.ip_url = scraping_cfg.proxy_test_ip_url if ip_url is None else ip_url
+        self.host_ip = None
+        self.concurrency = concurrency or scraping_cfg.proxy_test_concurrency
+        self.connect_timeout = connect_timeout or scraping_cfg.proxy_test_connect_timeout
+        self.read_timeout = read_timeout or scraping_cfg.proxy_test_read_timeout
+        self.batch_size = batch_size or system_cfg.mongo_bulk_batch_size
+
+    def check_proxies(self, proxies, save=True):
+        """
+        Tests a list of proxies [{'ip': ip, 'port': port}, ...]. Returns the list of proxy tests.
+        """
+        return asyncio.run(self._check_proxies(proxies, save))
+
+    async def _check_proxies(self, proxies, save):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, force_close=True)
+        proxy_tests, batch, pending_saves = [], [], []
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            if self.ip_url: self.host_ip = await self._host_ip(session)
+            tasks = [asyncio.ensure_future(self._check_a_proxy(session, semaphore, proxy)) for proxy in proxies]
+            for task in asyncio.as_completed(tasks):
+                proxy_test = await task
+                proxy_tests.append(proxy_test)
+                batch.append(proxy_test)
+                if save and len(batch) >= self.batch_size:
+                    pending_saves.append(loop.run_in_executor(None, save_proxy_tests, batch))
+                    batch = []
+        if save:
+            pending_saves.append(loop.run_in_executor(None, save_proxy_tests, batch))
+            await asyncio.gather(*pending_saves)
+        n_ok = sum(not proxy_test['blacklisted'] for proxy_test in proxy_tests)
+        logger.info(f'Tested {len(proxy_tests)} proxy servers: {n_ok} ok, {len(proxy_tests) - n_ok} blacklisted')
+        return proxy_tests
+
+    async def _host_ip(self, session):
+        # The ip of this host according to ip_url, None when it can't be fetched: the exit ips aren't checked then
+        try:
+            return await self._get_ip(session)
+        except (ValueError, TimeoutError, ClientError) as e:
+            logger.warning(f'No exit ip check, the ip of this host from {self.ip_url} failed: {e!r}')
+            return None
+
+    async def _get_ip(self, session, proxy_url=None):
+        async with session.get(self.ip_url, proxy=proxy_url, allow_redirects=False) as response:
+            if response.status >= 400:
+                raise ValueError(f'Bad response status {response.status} from {self.ip_url}')
+            return str(ipaddress.ip_address((await response.text(errors='replace')).strip()))  # ValueError when it isn't an ip
+
+    async def _check_a_proxy(self, session, semaphore, proxy):
+        ip, port = proxy['ip'], proxy['port']
+        delay, blacklisted, error_code = 0, True, 9
+        async with semaphore:
+            try:
+                start_time = time.monotonic()
+                async with session.get(self.test_url, proxy=f'http://{ip}:{port}', allow_redirects=False) as response:
+                    body = await response.text(errors='replace')
+                    if response.status >= 400:
+                        raise ValueError(f'Bad response status {response.status}')
+                delay = time.monotonic() - start_time
+                if self.expected_content and self.expected_content.lower() not in body.lower():
+                    raise ValueError(f'Unexpected content, status {response.status}: {body[:100]!r}')
+                if self.host_ip:
+                    exit_ip = await self._get_ip(session, f'http://{ip}:{port}')
+                    if exit_ip == self.host_ip:
+                        raise ValueError(f'Transparent proxy, exit ip {exit_ip} is the ip of this host')
+                blacklisted, error_code = False, 0
+            except ValueError as e:
+                error_code = 1
+                logger.debug(f'Error ValueERROR Server: {ip}:{port} | {e}')
+            except (TimeoutError, CancelledError) as e:
+                error_code = 2
+                logger.debug(f'Error: asyncio Server:{ip}:{port} | {e!r}')
+            except (ServerDisconnectedError, ClientHttpProxyError, ClientProxyConnectionError, ClientOSError, ClientError) as e:
+                error_code = 3
+                logger.debug(f'Error aiohttp Server: {ip}:{port} | {e!r}')
+            except Exception as e:
+                logger.error(f'Unknown error Server: {ip}:{port} | {e!r}')
+        return {'ip': ip, 'port': port,
+                'delay': delay,
+                'blacklisted': blacklisted, 'error_code': error_code}
+
@@ -0,0 +1,138 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/25
+# src - proxy_pool.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import math
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+from database.config_facade import Scraping_cfg
+
+scraping_cfg = Scraping_cfg()
+
+
+class ProxyPool:
+    """
+    Pool of proxy servers that hands out the healthiest available proxy.
+
+    Every proxy has a score = success / (1 + latency / latency_scale), with 'success' and 'latency' exponentially weighted moving
+    averages (EWMA) of the scraping results. The success ratio is seeded from the proxy stats in the database (flag_stats, scrape_n_used,
+    scrape_n_failed) and the latency from the proxy test delay.
+    A proxy that fails 'max_consecutive_fails' times in a row is benched for 'cooldown' seconds (circuit breaker). After the cooldown it gets
+    one new chance. If it fails again, the cooldown doubles up to 'max_cooldown'.
+    A proxy is given to one worker at a time. acquire() returns None when no proxy is available.
+
+    The pool lives in a ProxyPoolManager server process, so all the processes of a session share the same pool.
+    """
+
+    def __init__(self, alpha=None, max_consecutive_fails=None, cooldown=None, max_cooldown=None, latency_scale=None):
+        self.alpha = alpha or scraping_cfg.proxy_pool_alpha
+        self.max_consecutive_fails = max_consecutive_fails or scraping_cfg.proxy_max_consecutive_fails
+        self.cooldown = cooldown or scraping_cfg.proxy_cooldown
+        self.max_cooldown = max_cooldown or scraping_cfg.proxy_max_cooldown
+        self.latency_scale = latency_scale or scraping_cfg.proxy_latency_scale
+        self._proxies = {}  # {'ip:port': state}
+        self._lock = threading.Lock()
+
+    def populate(self, proxies):
+        """
+        Adds proxies [{'ip': ip, 'port': port, 'delay': delay, 'flag_stats': {...}, 'scrape_n_used': n, 'scrape_n_failed': n}, ...] to the pool.
+        Proxies already in the pool keep their live state.
+        """
+        with self._lock:
+            for proxy in proxies:
+                key = f"{proxy['ip']}:{proxy['port']}"
+                if key not in self._proxies:
+                    self._proxies[key] = self._seed_state(proxy)
+            return len(self._proxies)
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            best_key, best_score = None, -1
+            for key, state in self._proxies.items():
+                if state['in_use'] or state['benched_until'] > now: continue
+                score = self._score(state)
+                if score > best_score:
+                    best_key, best_score = key, score
+            if best_key is None: return None
+            state = self._proxies[best_key]
+            state['in_use'] = True
+            return {'ip': state['ip'], 'port': state['port']}
+
+    def release(self, proxy, ok, latency=None):
+        # ok=None: the attempt failed on something else than the proxy, its scores don't change
+        with self._lock:
+            state = self._proxies.get(f"{proxy['ip']}:{proxy['port']}")
+            if state is None: return
+            state['in_use'] = False
+            if ok is None: return
+            state['success'] += self.alpha * (float(ok) - state['success'])
+            if ok:
+                state['consecutive_fails'], state['n_trips'] = 0, 0
+                if latency is not None: state['latency'] += self.alpha * (latency - state['latency'])
+            else:
+                state['consecutive_fails'] += 1
+                if state['consecutive_fails'] >= self.max_consecutive_fails:
+                    cooldown = min(self.cooldown * 2 ** state['n_trips'], self.max_cooldown)
+                    state['benched_until'] = time.time() + cooldown
+                    state['n_trips'] += 1
+
+    def remove(self, proxy):
+        with self._lock:
+            self._proxies.pop(f"{proxy['ip']}:{proxy['port']}", None)
+
+    def qsize(self):
+        # Nr of proxies that can be acquired now
+        with self._lock:
+            now = time.time()
+            return sum(1 for state in self._proxies.values() if not state['in_use'] and state['benched_until'] <= now)
+
+    def n_benched(self):
+        with self._lock:
+            now = time.time()
+            return sum(1 for state in self._proxies.values() if state['benched_until'] > now)
+
+    def size(self):
+        with self._lock:
+            return len(self._proxies)
+
+    def scores(self):
+        with self._lock:
+            return {key: self._score(state) for key, state in self._proxies.items()}
+
+    def _score(self, state):
+        return state['success'] / (1 + state['latency'] / self.latency_scale)
+
+    def _seed_state(self, proxy):
+        n_used = _to_int(proxy.get('scrape_n_used'))
+        n_failed = _to_int(proxy.get('scrape_n_failed'))
+        flag_stats = proxy.get('flag_stats')
+        n_ok = _to_int(flag_stats.get('ok')) if isinstance(flag_stats, dict) else n_used - n_failed
+        n_ok = max(min(n_ok, n_used), 0)
+        delay = proxy.get('delay')
+        latency = delay if _is_number(delay) and 0 < delay < 999999 else self.latency_scale
+        return {'ip': proxy['ip'], 'port': proxy['port'],
+                'success': (n_ok + 1) / (n_used + 2),  # Laplace smoothing: an unused proxy starts at 0.5
+                'latency': latency,
+                'consecutive_fails': 0,
+                'n_trips': 0,
+                'benched_until': 0,
+                'in_use': False}
+
+
+def _is_number(x):
+    return isinstance(x, (int, float)) and not math.isnan(x)
+
+
+def _to_int(x):
+    return int(x) if _is_number(x) else 0
+
+
+class ProxyPoolManager(BaseManager):
+    pass
+
+
+ProxyPoolManager.register('ProxyPool', ProxyPool)
@@ -4,146 +4,133 @@
 # md
 # --------------------------------------------------------------------------------------------------------
 
-import multiprocessing as mp
+import asyncio
 import time
-from asyncio import TimeoutError, CancelledError
 from datetime import datetime
 
+import aiohttp
 import pandas as pd
-import requests
-from aiohttp import ServerDisconnectedError, ClientHttpProxyError, ClientProxyConnectionError, ClientOSError
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options
 
-from business.twitter_scraper import TweetScraper
+from business.proxy_checker import ProxyChecker
+from business.proxy_sources import proxy_sources, parse_errors, ChallengeError
 # from config import LOGGING_LEVEL
-from database.config_facade import SystemCfg,Scraping_cfg
-from database.proxy_facade import get_proxies, save_a_proxy_test
+from database.config_facade import SystemCfg, Scraping_cfg
+from database.proxy_facade import get_proxies
 from tools.logger import logger
 from tools.utils import set_pandas_display_options
 
 set_pandas_display_options()
 
-system_cfg=SystemCfg()
+system_cfg = SystemCfg()
+scraping_cfg = Scraping_cfg()
+
+
 class ProxyScraper:
     """
     Class to start_scraping proxy servers from different websites and send that data to the the scraping_controller for further handeling.
-    Currenty implemented websites are:
-        - https://free-proxy-list.net/
-        - https://hidemy.name/en/proxy-list/
+    The websites are the sources in business/proxy_sources.py. The pages of all sources are downloaded concurrently and the proxies are
+    de-duplicated on ip and port, the first source in the list keeps the proxy. The pages with a javascript challenge of the sources
+    with 'browser' are rendered again by a headless firefox (selenium), one after the other.
     """
+    user_agent = 'Mozilla/5.0 (X11; Linux x86_64; rv:78.0) Gecko/20100101 Firefox/78.0'
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or scraping_cfg.proxy_source_timeout
 
-    def __init__(self):
-        # Todo: Generalise to more proxy websites.
-        #       scrape_free_proxy_list uses request and is very fast
-        #       scrape_hide_my_name uses selenium
-        pass
+    def scrape_proxy_sources(self, sources=None):
+        """
+        Scrapes the sources, a list of keys of proxy_sources, by default all. A page that can't be downloaded or parsed is logged and skipped.
+        Returns a DataFrame with the columns datetime, ip, port, source.
+        """
+        sources = list(proxy_sources) if sources is None else sources
+        pages = asyncio.run(self._download_pages([(key, url) for key in sources for url in proxy_sources[key].urls]))
+        now = datetime.now()
+        proxies = {}
+        challenged = self._parse_pages(pages, proxies, now)
+        if challenged:
+            self._parse_pages(self._render_pages(challenged), proxies, now, browser=True)
+        return pd.DataFrame(list(proxies.values()), columns=['datetime', 'ip', 'port', 'source'])
 
     @staticmethod
-    def scrape_free_proxy_list():
-        proxy_url = 'https://free-proxy-list.net/'
-        # logger.debug(f'Start downloading proxy servers from {proxy_url}')
-        response = requests.get(proxy_url)
-        soup = BeautifulSoup(response.text, 'lxml')
-        table = soup.find('table', id='proxylisttable')
-        list_tr = table.find_all('tr')
-        list_td = [elem.find_all('td') for elem in list_tr]
-        list_td = list(filter(None, list_td))
-        proxies_df = pd.DataFrame()
-        proxies_df['ip'] = [elem[0].text for elem in list_td]
-        proxies_df['port'] = [elem[1].text for elem in list_td]
-        proxies_df['source'] = 'free-proxy-list.net'
-        proxies_df['datetime'] = datetime.now()
-        proxies_df = proxies_df[['datetime', 'ip', 'port', 'source']]
-        return proxies_df
+    def _parse_pages(pages, proxies, now, browser=False):
+        # Adds the proxies of the pages to proxies {(ip, port): proxy}. Returns the [(key, url), ...] to render with the browser.
+        challenged = []
+        for key, url, txt in pages:
+            if txt is None: continue
+            try:
+                source_proxies = proxy_sources[key].parse(txt)
+            except ChallengeError as e:
+                if proxy_sources[key].browser and not browser:
+                    challenged.append((key, url))
+                else:
+                    logger.error(f'No proxies from {url}: {e}')
+                continue
+            except parse_errors as e:
+                logger.warning(f'Couldn\'t parse the proxies of {url}: {type(e).__name__} {e}')
+                continue
+            logger.info(f'Scraped {len(source_proxies)} proxies from {url}')
+            for proxy in source_proxies:
+                proxies.setdefault((proxy['ip'], proxy['port']), {'datetime': now, 'ip': proxy['ip'], 'port': proxy['port'], 'source': proxy_sources[key].name})
+        return challenged
 
     @staticmethod
-    def scrape_hide_my_name():
-        # All countries except AUstralia
-        proxy_url = 'https://hidemy.name/en/proxy-list/?country=AFALARAMATAZBDBEBJBOBWBRBGBFKHCMCACLCNCOCGCDCRHRCYCZDJECEGFIFRGEDEGHGRGTHNHKHUINIDIRIQIEILITJ' \
-                    'PKZKEKRKGLVLBLTLUMKMWMYMVMXMDMNMEMZNPNLNZNINGNOPKPSPAPYPEPHPLPTPRRORUSARSSLSGSKSISOZAESCHTWTHTRUGUAAEGBUSUYUZVEVN&maxtime=1000&type=hs&start='
-        pages = 3
+    def _render_pages(key_urls, wait=10):
+        # [(key, url, text or None), ...] of the pages rendered by a headless firefox, 'wait' seconds for the challenge to pass
+        try:
+            from selenium import webdriver
+            from selenium.common.exceptions import WebDriverException
+            from selenium.webdriver.firefox.options import Options
+        except ImportError:
+            logger.error(f'Selenium isn\'t installed, no proxies from {[url for _, url in key_urls]}')
+            return []
         options = Options()
-        options.headless = True
-        driver = webdriver.Firefox(options=options, service_log_path='/dev/null')
-        proxies_df = pd.DataFrame()
-        for start in range(0, 64 * (pages - 1) + 1, 64):
-            # logger.debug(f'Downloading proxy servers from https://hidemy.name/ starting at {start}')
-            driver.get(f'{proxy_url}{start}')
-            time.sleep(10)
-            table = driver.find_element_by_class_name('table_block')
-            body = table.find_element_by_tag_name('tbody')
-            for row in body.find_elements_by_tag_name('tr'):
-                r = row.find_elements_by_tag_name('td')
-                proxies_df = proxies_df.append({'ip': r[0].text,  # Todo: Use list iso DF. Now dict->df->dict ?
-                                                'port': r[1].text,
-                                                'source': 'hidemy.name',
-                                                'datetime': datetime.now()},
-                                               ignore_index=True)
-                proxies_df = proxies_df[['datetime', 'ip', 'port', 'source']]
-        driver.close()
-        return proxies_df
-
-    def test_proxies(self,only_blacklisted=False, processes=25):
-        logger.info('=' * 100)
-        logger.info(f"Start testing {'blacklisted' if only_blacklisted else 'all'} proxy servers")
-        logger.info('=' * 100)
-        proxies = get_proxies(only_blacklisted)
-        proxy_list = []
-        for _, row in proxies.iterrows():
-            proxy = (row['ip'], row['port'])
-            proxy_list.append(proxy)
-        with mp.Pool(processes=processes) as pool:
-            results = pool.starmap(self._test_and_save_proxy, proxy_list)
+        options.add_argument('-headless')
+        pages = []
+        try:
+            driver = webdriver.Firefox(options=options)
+        except WebDriverException as e:
+            logger.error(f'Couldn\'t start firefox, no proxies from {[url for _, url in key_urls]}: {e}')
+            return []
+        try:
+            for key, url in key_urls:
+                try:
+                    driver.get(url)
+                    time.sleep(wait)
+                    pages.append((key, url, driver.page_source))
+                except WebDriverException as e:
+                    logger.warning(f'Couldn\'t render the proxies of {url}: {type(e).__name__} {e}')
+        finally:
+            driver.quit()
+        return pages
 
-    @staticmethod
-    def _test_and_save_proxy(ip, port):
-        logger.info('-' * 100)
-        logger.info(f'Start testing proxy server: {ip}:{port}')
-        logger.info('-' * 100)
-        info = f'{ip}_{port}'
-        delay = -1
-        blacklisted = True
-        error_code = -1
-        # Try and time fetching the last 40 tweets from Donald Trump
-        username = 'realDonaldTrump'
-        limit = 40
-        ts = TweetScraper(username)
-        ts.proxy_server = {'ip': ip, 'port': port}
-        ts.twint_limit = limit
-        ts.twint_hide_terminal_output = True if system_cfg.logging_level != 'Debug' else False
+    async def _download_pages(self, key_urls):
+        # [(key, url, text or None), ...] in the order of key_urls
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(timeout=timeout, headers={'User-Agent': self.user_agent}) as session:
+            return await asyncio.gather(*[self._download_a_page(session, key, url) for key, url in key_urls])
 
+    @staticmethod
+    async def _download_a_page(session, key, url):
         try:
-            start_time = time.time()
-            ts.execute_scraping()
-            delay = time.time() - start_time
-            blacklisted, error_code = False, 0
-        except ValueError as e:
-            delay, blacklisted, error_code = 0, True, 1
-            logger.error(f'Error ValueERROR Server: {ip}:{port}')
-            logger.error(f'Error message: {e}')
-        except (TimeoutError, CancelledError) as e:
-            delay, blacklisted, error_code = 0, True, 2
-            logger.error(f'Error: asyncio Server:{ip}:{port}')
-            logger.error(f'Error message: {e}')
-        except (ServerDisconnectedError, ClientHttpProxyError, ClientProxyConnectionError, ClientOSError) as e:
-            delay, blacklisted, error_code = 0, True, 3
-            logger.error(f'Error aiohttp Server: {ip}:{port}')
-            logger.error(f'Error message: {e}')
-        except:
-            delay, blacklisted, error_code = 0, True, 9
-            raise
-        finally:
-            proxy_test = {'ip': ip, 'port': port,
-                          'delay': delay,
-                          'blacklisted': blacklisted, 'error_code': error_code}
-            save_a_proxy_test(proxy_test)
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return key, url, await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f'Couldn\'t download the proxies from {url}: {type(e).__name__} {e}')
+            return key, url, None
 
+    def scrape_free_proxy_list(self):
+        return self.scrape_proxy_sources(['free_proxy_list'])
 
+    def scrape_hide_my_name(self):
+        return self.scrape_proxy_sources(['hide_my_name'])
 
-if __name__ == '__main__':
-    ps = ProxyScraper()
-    ps.scrape_free_proxy_list()
-    ps.scrape_hide_my_name()
-    ps.test_proxies()
+    @staticmethod
+    def test_proxies(only_blacklisted=False, concurrency=None):
+        logger.info('=' * 100)
+        logger.info(f"Start testing {'blacklisted' if only_blacklisted else 'all'} proxy servers")
+        logger.info('=' * 100)
+        proxies = get_proxies(only_blacklisted)
+        if proxies.empty: return []
+        proxy_list = proxies[['ip', 'port']].to_dict('records')
+        return ProxyChecker(concurrency=concurrency).check_proxies(proxy_list)
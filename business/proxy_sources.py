@@ -0,0 +1,143 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/30
+# src - proxy_sources.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import os
+import re
+
+from lxml import etree, html
+
+from tools.logger import logger
+
+"""
+The websites that publish proxy servers. A source is a parser over the pages it fetches:
+    - urls:       the pages to download
+    - parse(txt): the proxies [{'ip': ip, 'port': port}, ...] in the text of one page
+    - browser:    True when the site can answer with a javascript challenge that only a browser passes
+The ProxyScraper downloads the pages of all sources concurrently. parse() doesn't do any io, a source can be tested offline on a
+saved page with parse_file(path). A page that can't be parsed raises one of 'parse_errors', the ProxyScraper then skips it. A page with
+a javascript challenge iso the proxies raises ChallengeError, the ProxyScraper then renders it again with selenium when the source
+has 'browser'.
+
+The saved pages are in business/proxy_source_pages, with the nr of proxies parse() must find in 'saved_pages', or the error it must
+raise. check_sources() parses all of them: python -m business.proxy_sources. When a site changes its layout, save the new page, update the
+parser and its entry in 'saved_pages'.
+
+A new source is a subclass of ProxySource registered in 'proxy_sources' with the key that switches it on in the config
+'proxies_download_sites', and at least one saved page.
+
+IMPLEMENTED SOURCES
+-------------------
+- free_proxy_list:  https://free-proxy-list.net/
+- hide_my_name:     https://hidemy.name/en/proxy-list/
+- proxyscrape:      https://api.proxyscrape.com/ (plain text)
+"""
+
+
+class ChallengeError(ValueError):
+    # A javascript challenge iso the proxies
+    pass
+
+
+parse_errors = (etree.LxmlError, ValueError)  # ex. ParserError 'Document is empty' on an empty page, ChallengeError
+saved_pages_dir = os.path.join(os.path.dirname(__file__), 'proxy_source_pages')
+ip_port_pattern = re.compile(r'\b(\d{1,3}(?:\.\d{1,3}){3}):(\d{1,5})\b')
+hide_my_name_url = 'https://hidemy.name/en/proxy-list/?country=AFALARAMATAZBDBEBJBOBWBRBGBFKHCMCACLCNCOCGCDCRHRCYCZDJECEGFIFRGEDEGHGRGTHNHKHUINIDIRIQIEILITJ' \
+                   'PKZKEKRKGLVLBLTLUMKMWMYMVMXMDMNMEMZNPNLNZNINGNOPKPSPAPYPEPHPLPTPRRORUSARSSLSGSKSISOZAESCHTWTHTRUGUAAEGBUSUYUZVEVN&maxtime=1000&type=hs&start='
+
+
+class ProxySource:
+    name = ''  # Saved as 'source' in the proxies collection
+    urls = []
+    browser = False
+
+    def parse(self, txt):
+        raise NotImplementedError
+
+    def parse_file(self, path):
+        with open(path, encoding='utf-8') as f:
+            return self.parse(f.read())
+
+    @staticmethod
+    def _parse_table_rows(txt, xpath):
+        # The ip and port of the rows of an html table with the ip in the first and the port in the second column
+        proxies = []
+        for row in html.fromstring(txt).xpath(xpath):
+            cells = [cell.text_content().strip() for cell in row.xpath('./td')]
+            if len(cells) >= 2 and ip_port_pattern.fullmatch(f'{cells[0]}:{cells[1]}'):
+                proxies.append({'ip': cells[0], 'port': cells[1]})
+        return proxies
+
+
+class FreeProxyList(ProxySource):
+    name = 'free-proxy-list.net'
+    urls = ['https://free-proxy-list.net/']
+
+    def parse(self, txt):
+        return self._parse_table_rows(txt, '//table[@id="proxylisttable"]//tr')
+
+
+class HideMyName(ProxySource):
+    # All countries except Australia. The site often answers a download with a javascript challenge iso the list.
+    name = 'hidemy.name'
+    pages = 3
+    urls = [f'{hide_my_name_url}{start}' for start in range(0, 64 * pages, 64)]
+    browser = True
+
+    def parse(self, txt):
+        proxies = self._parse_table_rows(txt, '//div[contains(@class, "table_block")]//tbody/tr')
+        if not proxies and 'table_block' not in txt:
+            raise ChallengeError(f'No proxy list on the page of {self.name}')
+        return proxies
+
+
+class ProxyScrape(ProxySource):
+    # Plain text, one ip:port per line
+    name = 'proxyscrape.com'
+    urls = ['https://api.proxyscrape.com/?request=getproxies&proxytype=http&timeout=10000&country=all&ssl=all&anonymity=all']
+
+    def parse(self, txt):
+        return [{'ip': ip, 'port': port} for ip, port in ip_port_pattern.findall(txt)]
+
+
+proxy_sources = {'free_proxy_list': FreeProxyList(),
+                 'hide_my_name': HideMyName(),
+                 'proxyscrape': ProxyScrape()}
+# (source, file in saved_pages_dir, nr of proxies or the error of parse)
+saved_pages = [('free_proxy_list', 'free_proxy_list.html', 5),
+               ('hide_my_name', 'hide_my_name.html', 4),
+               ('hide_my_name', 'hide_my_name_challenge.html', ChallengeError),
+               ('proxyscrape', 'proxyscrape.txt', 6)]
+
+
+def check_sources():
+    """
+    Parses the saved pages of all sources offline. Returns the failures [(source, file, error)], an empty list when all pages give
+    the expected nr of valid proxies or raise the expected error.
+    """
+    failures = [(key, None, 'no saved page') for key in proxy_sources if key not in {key for key, _, _ in saved_pages}]
+    for key, file, n_expected in saved_pages:
+        try:
+            proxies = proxy_sources[key].parse_file(os.path.join(saved_pages_dir, file))
+        except parse_errors as e:
+            if isinstance(n_expected, type) and isinstance(e, n_expected):
+                logger.info(f'{key} | {file}: {type(e).__name__}')
+            else:
+                failures.append((key, file, f'{type(e).__name__} {e}'))
+            continue
+        if isinstance(n_expected, type):
+            failures.append((key, file, f'{len(proxies)} proxies iso {n_expected.__name__}'))
+            continue
+        invalid = [proxy for proxy in proxies if not ip_port_pattern.fullmatch(f"{proxy['ip']}:{proxy['port']}")]
+        if len(proxies) != n_expected or invalid:
+            failures.append((key, file, f'{len(proxies)} proxies iso {n_expected}, invalid: {invalid}'))
+        else:
+            logger.info(f'{key} | {file}: {len(proxies)} proxies')
+    for failure in failures:
+        logger.error(f'{failure[0]} | {failure[1]}: {failure[2]}')
+    return failures
+
+
+if __name__ == '__main__':
+    exit(1 if check_sources() else 0)
@@ -0,0 +1,106 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/28
+# src - reply_graph.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import numpy as np
+
+from database.twitter_facade import get_reply_edges
+from tools.utils import users_list_usernames
+
+
+class ReplyGraph:
+    """
+    Edge-weighted graph of users based on reply_to, weighted by the nr of replies, in compressed sparse row (CSR) arrays.
+
+    The nodes are sorted usernames. The edges from node i are out_indices[out_indptr[i]:out_indptr[i + 1]] with the weights in
+    out_weights, the edges to node i are in the same way in the in_ arrays (the transpose). The neighbours are sorted on weight,
+    so top_k() is a slice.
+    """
+
+    def __init__(self, from_usernames, to_usernames, counts):
+        self.usernames = np.unique(np.concatenate([np.asarray(from_usernames, dtype=object), np.asarray(to_usernames, dtype=object)]))
+        self._index = {username: i for i, username in enumerate(self.usernames)}
+        sources = np.searchsorted(self.usernames, np.asarray(from_usernames, dtype=object)).astype(np.int32)
+        targets = np.searchsorted(self.usernames, np.asarray(to_usernames, dtype=object)).astype(np.int32)
+        weights = np.asarray(counts, dtype=np.int64)
+        self.out_indptr, self.out_indices, self.out_weights = self._csr(sources, targets, weights)
+        self.in_indptr, self.in_indices, self.in_weights = self._csr(targets, sources, weights)
+
+    @classmethod
+    def load(cls, usernames=None, min_count=1):
+        """
+        Loads the edges from and to 'usernames', by default all accounts in config.USERS_LIST.
+        Users outside the list that are replied to, or that reply, are nodes too.
+        """
+        usernames = users_list_usernames() if usernames is None else [username.lower() for username in usernames]
+        edges_df = get_reply_edges(usernames)
+        edges_df = edges_df[edges_df['count'] >= min_count]
+        return cls(edges_df['from_username'].values, edges_df['to_username'].values, edges_df['count'].values)
+
+    def _csr(self, rows, columns, weights):
+        n = len(self.usernames)
+        # Sort on row, then on descending weight
+        order = np.lexsort((-weights, rows))
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        return indptr, columns[order], weights[order]
+
+    def __len__(self):
+        return len(self.usernames)
+
+    @property
+    def n_edges(self):
+        return len(self.out_indices)
+
+    def _node(self, username):
+        return self._index.get(username.lower())
+
+    def _neighbours(self, username, indptr, indices, weights, k=None):
+        i = self._node(username)
+        if i is None: return []
+        begin, end = indptr[i], indptr[i + 1]
+        if k is not None: end = min(end, begin + k)
+        return list(zip(self.usernames[indices[begin:end]].tolist(), weights[begin:end].tolist()))
+
+    def replies_to(self, username, k=None):
+        # [(username, nr of replies)] the user replied to, most replies first
+        return self._neighbours(username, self.out_indptr, self.out_indices, self.out_weights, k)
+
+    def replied_by(self, username, k=None):
+        # [(username, nr of replies)] that replied to the user, most replies first
+        return self._neighbours(username, self.in_indptr, self.in_indices, self.in_weights, k)
+
+    def neighbours(self, username):
+        # Set of users the user replied to or got replies from
+        return {u for u, _ in self.replies_to(username)} | {u for u, _ in self.replied_by(username)}
+
+    def out_degree(self, username, weighted=False):
+        return self._degree(username, self.out_indptr, self.out_weights, weighted)
+
+    def in_degree(self, username, weighted=False):
+        return self._degree(username, self.in_indptr, self.in_weights, weighted)
+
+    def _degree(self, username, indptr, weights, weighted):
+        i = self._node(username)
+        if i is None: return 0
+        if weighted: return int(weights[indptr[i]:indptr[i + 1]].sum())
+        return int(indptr[i + 1] - indptr[i])
+
+    def degrees(self, direction='in', weighted=False):
+        # Degree of all nodes, in the order of self.usernames
+        indptr, weights = (self.in_indptr, self.in_weights) if direction == 'in' else (self.out_indptr, self.out_weights)
+        if not weighted: return np.diff(indptr)
+        return np.add.reduceat(np.append(weights, 0), indptr[:-1]) * (np.diff(indptr) > 0)
+
+    def top_k(self, username, k=10, direction='out'):
+        # The k users the user replied most to (out), or that replied most to the user (in)
+        return self.replies_to(username, k) if direction == 'out' else self.replied_by(username, k)
+
+    def top_users(self, k=10, direction='in', weighted=True):
+        # The k users with the highest degree, e.g. the most replied to users
+        degrees = self.degrees(direction, weighted)
+        k = min(k, len(degrees))
+        top = np.argpartition(-degrees, k - 1)[:k] if k else np.array([], dtype=np.int64)
+        top = top[np.argsort(-degrees[top], kind='stable')]
+        return list(zip(self.usernames[top].tolist(), degrees[top].tolist()))
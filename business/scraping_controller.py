@@ -4,33 +4,91 @@
 # md
 # --------------------------------------------------------------------------------------------------------
 
+import asyncio
+import contextvars
+import functools
+import importlib
 import multiprocessing as mp
-import sys
+import os
 import time
 from concurrent.futures import TimeoutError
 from datetime import datetime, timedelta
-from queue import Empty
 
 import pandas as pd
-from aiohttp import ServerDisconnectedError, ClientOSError, ClientHttpProxyError
+from aiohttp import ServerDisconnectedError, ClientOSError, ClientHttpProxyError, ClientError
 
-from business.proxy_scraper import ProxyScraper
-from business.twitter_scraper import TweetScraper, ProfileScraper
-from database.config_facade import SystemCfg, Scraping_cfg
+from business.proxy_pool import ProxyPoolManager
+from business.tail_scheduler import TailScheduler
+from database.config_facade import SystemCfg, Scraping_cfg, conf_all
 from database.proxy_facade import get_proxies, update_proxy_stats, reset_proxies_scrape_success_flag
 from database.proxy_facade import save_proxies
-from database.twitter_facade import get_join_date, get_nr_tweets_per_day, save_tweets, save_a_profile, get_a_profile
-from database.log_facade import log_scraping_profile, log_scraping_tweets, get_max_sesion_id, get_failed_periods
-from database.twitter_facade import get_usernames, reset_all_scrape_flags
+from database.twitter_facade import get_join_date, get_nr_tweets_per_day, save_tweets, save_a_profile, get_a_profile, bootstrap_tweet_counts
+from database.log_facade import log_scraping_profile, log_scraping_tweets, get_max_sesion_id, get_failed_periods, start_log_sink, stop_log_sink, \
+    get_log_sink, use_log_sink
+from database.log_facade import get_scrape_checkpoint, save_scrape_checkpoint, delete_scrape_checkpoint
+from database.log_facade import save_session_journal, set_period_status, get_unfinished_periods, get_journal_counts
+from database.twitter_facade import get_usernames, reset_all_scrape_flags, get_last_tweet_datetime
+from tools import metrics, profiling
 from tools.logger import logger
 
 """
 A collection of functions to control scraping and saving proxy servers, Twitter tweets and profiles
+
+twint (business.twitter_scraper, business.fetch_engine) and the proxy scraper are imported where they are used: the session process
+plans the periods, only the workers scrape. The workers start from a fork server that imported only the 'worker_modules' (see worker_pool).
 """
 
 ####################################################################################################################################################################################
 system_cfg = SystemCfg()
 scraping_cfg = Scraping_cfg()
+# The errors of a search that count as a fail of the proxy, in the order of the except clauses of scrape_a_period
+scraping_errors = (ValueError, ServerDisconnectedError, ClientOSError, TimeoutError, ClientHttpProxyError, IndexError)
+# The errors of the async fetch engine that count as a fail of the proxy. Other errors are bugs, they aren't retried.
+fetch_errors = scraping_errors + (ClientError, asyncio.TimeoutError)
+
+
+# Imported by the fork server before it forks the workers
+worker_modules = ('business.scraping_controller', 'business.twitter_scraper', 'business.fetch_engine')
+
+
+def _error_flag(e):
+    return next((error.__name__ for error in scraping_errors if isinstance(e, error)), type(e).__name__)
+
+
+async def _run_blocking(function, *args, **kwargs):
+    # Runs a blocking call (mongodb, a manager RPC) in the default executor, so it doesn't stall the other periods on the event loop.
+    # The call runs in the context of the calling task, its profiling stages count for the period of the task.
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, function, *args, **kwargs))
+
+
+def worker_pool(processes):
+    """
+    The mp.Pool of a session, with the 'worker_start_method' of the config:
+        - 'fork':       the workers are forked from this process after it imported the worker modules. They inherit the config, the
+                        log sink, the metrics and the profiling of the session. The default: the workers start fastest and share
+                        most of their memory with the session process.
+        - 'forkserver': the workers are forked from a server process that only imported the worker modules. They don't carry the
+                        memory of the session process and don't inherit its state: the initializer sets the config, the log sink,
+                        the metrics and the profiling of the session. Scripts must start the session under if __name__ == '__main__'.
+    """
+    if scraping_cfg.worker_start_method == 'forkserver':
+        context = mp.get_context('forkserver')
+        context.set_forkserver_preload(list(worker_modules))
+        state = {'conf': dict(conf_all), 'log_level': logger.level, 'log_sink': get_log_sink(), 'metrics': metrics.get_registry(),
+                 'profiling': profiling.get_settings()}
+        return context.Pool(processes=processes, initializer=_init_worker, initargs=(state,))
+    for module in worker_modules:  # Before the fork, so the workers share them
+        importlib.import_module(module)
+    return mp.Pool(processes=processes)
+
+
+def _init_worker(state):
+    conf_all.update(state['conf'])
+    logger.setLevel(state['log_level'])
+    use_log_sink(state['log_sink'])
+    metrics.use_registry(state['metrics'])
+    profiling.use_settings(state['profiling'])
 
 
 # Todo: Refactor: Now: multiprocessing inside instance. Better oudside and eah process creates instance? What about proxy queue shqring ?
@@ -42,19 +100,25 @@ class TwitterScrapingSession:
         self.usersnames_df = pd.DataFrame()
         self.scrape_profiles = False
         self.scrape_tweets = False
-        manager = mp.Manager()
-        self.proxy_queue = manager.Queue()
+        manager = ProxyPoolManager()
+        manager.start()
+        self.proxy_pool = manager.ProxyPool()
 
         self.n_processes = scraping_cfg.n_processes
         self.rescrape = False
+        self.resumed_periods_df = None
         self.session_begin_date = scraping_cfg.session_begin_date
         self.session_end_date = scraping_cfg.session_end_date
         self.timedelta = scraping_cfg.time_delta
+        self.tweets_per_period = scraping_cfg.tweets_per_period
+        self.max_period_days = scraping_cfg.max_period_days
         self.max_proxy_delay = scraping_cfg.max_proxy_delay
         self.max_fails = scraping_cfg.max_fails
         self.missing_dates = scraping_cfg.missing_dates
         self.min_tweets = scraping_cfg.min_tweets
+        self.streaming = scraping_cfg.fetch_streaming  # Only with the async fetch engine
         self.session_id = get_max_sesion_id() + 1
+        bootstrap_tweet_counts()  # The periods, the missing dates and the tail rates are sized from the counts
         logger.info(
             f'Start Twitter Scraping. | n_processes={self.n_processes}, session_id={self.session_id}, '
             f'session_begin_date={self.session_begin_date}, session_end_date={self.session_end_date}, timedelta={self.timedelta}, missing_dates={self.missing_dates}')
@@ -99,6 +163,15 @@ class TwitterScrapingSession:
         self.scrape_tweets = True
         return self
 
+    def resume(self, session_id):
+        # Scrapes the periods of the journal of a killed or crashed session that aren't done: pending, claimed or failed
+        self.resumed_periods_df = get_unfinished_periods(session_id)
+        self.usersnames_df = self.resumed_periods_df[['username']].drop_duplicates() if not self.resumed_periods_df.empty else pd.DataFrame()
+        logger.info(f'Resume session {session_id} | journal: {get_journal_counts(session_id)}')
+        self.session_id = session_id
+        self.scrape_tweets = True
+        return self
+
     # ------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
     # ENGINE
     # ------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
@@ -115,121 +188,440 @@ class TwitterScrapingSession:
             logger.warning(f'Nothing to do. Did you forget to set "all_users" or "users_list"? Or all users already exist?')
             return None
         processes = min(len(self.usersnames_df), self.n_processes)
-        if self.scrape_profiles:
-            self._populate_proxy_queue()
-            print(self.usersnames_df)
-            # mp_iterable = [(username,) for _, (_, username) in self.usersnames_df.iterrows()]
-            mp_iterable = [(username,) for username in self.usersnames_df['username']]
-            with mp.Pool(processes=processes) as pool:
-                pool.starmap(self.scrape_a_user_profile, mp_iterable)
-        if self.scrape_tweets:
-            self._populate_proxy_queue()
-            if self.rescrape:
-                mp_iterable = [(username, begin_date, end_date) for _, (username, begin_date, end_date) in self.usersnames_df.iterrows()]
-
-            else:
-                mp_iterable = [(username, scraping_cfg.session_begin_date, scraping_cfg.session_end_date) for username in self.usersnames_df['username']]
-            with mp.Pool(processes=processes) as pool:
-                pool.starmap(self.scrape_a_user_tweets, mp_iterable)
+        own_metrics = False
+        try:
+            start_log_sink()  # Before the pools, the workers log to it (see worker_pool)
+            own_metrics = self._start_metrics()
+            self._start_profiling()
+            if self.scrape_profiles:
+                self._populate_proxy_pool()
+                # mp_iterable = [(username,) for _, (_, username) in self.usersnames_df.iterrows()]
+                mp_iterable = [(username,) for username in self.usersnames_df['username']]
+                with worker_pool(processes) as pool:
+                    pool.starmap(self.scrape_a_user_profile, mp_iterable)
+            if self.scrape_tweets:
+                self._populate_proxy_pool()
+                if self.resumed_periods_df is not None:
+                    self._scrape_resumed_periods()
+                else:
+                    if self.rescrape:  # The logged end date is excluded, the end date of a session period is included
+                        users_periods = [(username, begin_date, end_date - timedelta(days=1))
+                                         for _, (username, begin_date, end_date) in self.usersnames_df.iterrows()]
+
+                    else:
+                        users_periods = [(username, scraping_cfg.session_begin_date, scraping_cfg.session_end_date) for username in self.usersnames_df['username']]
+                    self._scrape_scheduled_periods(users_periods)
+        finally:
+            stop_log_sink()
+            if own_metrics: metrics.stop_metrics()
+            profiling.stop()
+
+    def _scrape_scheduled_periods(self, users_periods):
+        """
+        Splits the sessions of all the users in periods up front and lets the pool workers take one period at a time (chunksize=1).
+        A prolific user is scraped by many workers in parallel, so the session ends with the slowest period iso the slowest user.
+        """
+        scheduled_periods, n_periods = self._schedule_periods(users_periods)
+        logger.info(f'Scheduled {len(scheduled_periods)} periods for {len(n_periods)} users')
+        save_session_journal(self.session_id, scheduled_periods)  # Before the first period, so resume() knows them all
+        for username in [u for u, n in n_periods.items() if n == 0]:  # Nothing to scrape
+            log_scraping_tweets(self.session_id, 'begin', 'session', username, self.session_begin_date, self.session_end_date)
+            log_scraping_tweets(self.session_id, 'end', 'session', username, self.session_begin_date, self.session_end_date)
+        self._scrape_periods(scheduled_periods, n_periods)
+
+    def _scrape_resumed_periods(self):
+        # The periods as they were scheduled by the session, they aren't split again
+        columns = ['username', 'begin_date', 'end_date', 'first_period']
+        scheduled_periods = [tuple(period) for period in self.resumed_periods_df[columns].itertuples(index=False)]
+        n_periods = self.resumed_periods_df['username'].value_counts().to_dict()
+        logger.info(f'Resumed {len(scheduled_periods)} periods for {len(n_periods)} users')
+        self._scrape_periods(scheduled_periods, n_periods)
+
+    def _scrape_periods(self, scheduled_periods, n_periods):
+        # Scrapes the scheduled periods with the session pool. Logs the end of the session of a user when all its periods are scraped.
+        if not scheduled_periods: return
+        if scraping_cfg.fetch_engine == 'async':  # A worker scrapes a batch of periods concurrently
+            batch_size = scraping_cfg.fetch_batch_size
+            work_units = [scheduled_periods[i:i + batch_size] for i in range(0, len(scheduled_periods), batch_size)]
+            work = self._scrape_a_batch_of_scheduled_periods
+        else:
+            work_units, work = scheduled_periods, self._scrape_a_scheduled_period
+        processes = min(len(work_units), self.n_processes)
+        with worker_pool(processes) as pool:
+            for usernames in pool.imap_unordered(work, work_units, chunksize=1):
+                for username in [usernames] if isinstance(usernames, str) else usernames:
+                    n_periods[username] -= 1
+                    if n_periods[username] == 0:  # All periods of the user scraped.
+                        log_scraping_tweets(self.session_id, 'end', 'session', username, self.session_begin_date, self.session_end_date)
+
+    def start_tailing(self, max_rounds=None):
+        """
+        Long running tail mode. Polls every user only from the newest stored tweet onward, at an adaptive rate per user (see TailScheduler).
+        Runs until interrupted or until 'max_rounds' rounds of polls are done.
+        """
+        if self.usersnames_df.empty:
+            logger.warning(f'Nothing to do. Did you forget to set "all_users" or "users_list"?')
+            return None
+        self._populate_proxy_pool()
+        scheduler = TailScheduler()
+        history_days = scraping_cfg.tail_history_days
+        history_begin_date = datetime.combine(datetime.today().date() - timedelta(days=history_days), datetime.min.time())
+        for username in self.usersnames_df['username']:
+            nr_tweets_per_day = get_nr_tweets_per_day(username, history_begin_date, datetime.now())
+            rate = nr_tweets_per_day['nr_tweets'].sum() / history_days if not nr_tweets_per_day.empty else 0
+            scheduler.add(username, rate)
+        logger.info(f'Start tailing {len(scheduler)} users')
+
+        n_rounds = 0
+        own_metrics = False
+        try:
+            start_log_sink()
+            own_metrics = self._start_metrics()
+            self._start_profiling()
+            with worker_pool(min(len(scheduler), self.n_processes)) as pool:
+                while max_rounds is None or n_rounds < max_rounds:
+                    usernames = scheduler.pop_due()
+                    if not usernames:
+                        time.sleep(min(scheduler.seconds_to_next_poll(), 60))
+                        continue
+                    for username, n_new_tweets in pool.imap_unordered(self._tail_a_user, usernames, chunksize=1):
+                        scheduler.update(username, n_new_tweets)
+                        logger.info(f'Tail | {username}, new tweets={n_new_tweets}, next poll in {scheduler.interval(username) / 3600:.1f}h')
+                    n_rounds += 1
+        finally:
+            stop_log_sink()
+            if own_metrics: metrics.stop_metrics()
+            profiling.stop()
+
+    def _start_metrics(self):
+        # Before the pools, the workers count in it (see worker_pool). Returns False when the caller started the metrics (ex. a benchmark) and stops them.
+        # Without 'metrics_port' the metrics are off, unless the caller started them.
+        own_metrics = not metrics.is_started()
+        if own_metrics and not system_cfg.metrics_port: return False
+        metrics.start_metrics(system_cfg.metrics_port)
+        metrics.add_collector(self._proxy_pool_metrics)
+        return own_metrics
+
+    def _start_profiling(self):
+        # Before the pools, the workers profile with its settings (see worker_pool)
+        if system_cfg.profiling:
+            profiling.start(self.session_id, system_cfg.profiling, system_cfg.profiling_dir, system_cfg.profiling_interval)
+
+    def _schedule_periods(self, users_periods):
+        # Returns the list of (username, period_begin_date, period_end_date, first_period) and the nr of periods per user
+        scheduled_periods, n_periods = [], {}
+        for username, session_begin_date, session_end_date in users_periods:
+            n_periods.setdefault(username, 0)
+            for period_begin_date, period_end_date in self._calculate_scrape_periods(username, session_begin_date, session_end_date):
+                scheduled_periods.append((username, period_begin_date, period_end_date, n_periods[username] == 0))
+                n_periods[username] += 1
+        return scheduled_periods, n_periods
 
     # ------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
     # PROFILES
     # ------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
     def scrape_a_user_profile(self, username):  # Todo: implement Exception trapping + proxy stats
-        self._check_proxy_queue()
-        proxy = self.proxy_queue.get()
+        from business.twitter_scraper import ProfileScraper
+        proxy = self._get_proxy_server()
         profile_scraper = ProfileScraper(username)
         profile_scraper.proxy_server = proxy
 
-        logger.info(f'Start scraping profile | {username}, {proxy["ip"]}:{proxy["port"]}, queue={self.proxy_queue.qsize()}')
+        logger.info(f'Start scraping profile | {username}, {proxy["ip"]}:{proxy["port"]}, pool={self.proxy_pool.qsize()}')
         log_scraping_profile(self.session_id, 'begin', 'profile', username, proxy=proxy)
 
-        profile_df = profile_scraper.execute_scraping()
-        if not profile_df.empty:
-            logger.info(f'Saving profile | {username}, {proxy["ip"]}:{proxy["port"]}, queue={self.proxy_queue.qsize()}')
-            save_a_profile(profile_df)
+        ok, latency = False, None
+        try:
+            start_time = time.time()
+            profile_df = profile_scraper.execute_scraping()
+            ok, latency = True, time.time() - start_time
+            if not profile_df.empty:
+                logger.info(f'Saving profile | {username}, {proxy["ip"]}:{proxy["port"]}, pool={self.proxy_pool.qsize()}')
+                save_a_profile(profile_df)
+        finally:
+            self._release_proxy_server(proxy, ok, latency)
+            metrics.flush()
 
         log_scraping_profile(self.session_id, 'end', 'profile', username)
-        self._release_proxy_server(proxy)
 
     # ------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
     # TWEETS
     # ------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
     def scrape_a_user_tweets(self, username, session_begin_date, session_end_date):
+        # Scrapes all the periods of a user in this process
         log_scraping_tweets(self.session_id, 'begin', 'session', username, self.session_begin_date, self.session_end_date)
-        self._check_proxy_queue()
         periods_to_scrape = self._calculate_scrape_periods(username, session_begin_date, session_end_date)
         for period_begin_date, period_end_date in periods_to_scrape:
-            fail_counter = 0
-            while fail_counter < self.max_fails:
-                proxy = self.proxy_queue.get()
-                logger.info(
-                    f'Start scraping tweets | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, queue={self.proxy_queue.qsize()}, fail={fail_counter}')
-                tweet_scraper = TweetScraper(username, period_begin_date, period_end_date)
-                tweet_scraper.proxy_server = proxy
-                try:
-                    tweets_df = tweet_scraper.execute_scraping()
-                except ValueError as e:
-                    fail_counter += 1
-                    self.handle_error('ValueError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
-                except ServerDisconnectedError as e:
-                    fail_counter += 1
-                    self.handle_error('ServerDisconnectedError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
-                except ClientOSError as e:
-                    fail_counter += 1
-                    self.handle_error('ClientOSError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
-                except TimeoutError as e:
-                    fail_counter += 1
-                    self.handle_error('TimeoutError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
-                except ClientHttpProxyError as e:
-                    fail_counter += 1
-                    self.handle_error('ClientHttpProxyError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
-                except IndexError as e:
-                    fail_counter += 1
-                    self.handle_error('IndexError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
-                except Empty as e:  # Queue emprt
-                    logger.error(
-                        f'Empty Error | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, queue={self.proxy_queue.qsize()}, fail={fail_counter}')
-                    self._populate_proxy_queue()
-                except:
-                    print('x' * 3000)
-                    print(sys.exc_info()[0])
-                    print(sys.exc_info())
-                else:
-                    logger.info(
-                        f'Saving {len(tweets_df)} tweets | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, queue={self.proxy_queue.qsize()}')
-                    if not tweets_df.empty: save_tweets(tweets_df)
-                    log_scraping_tweets(self.session_id, 'ok', 'period', username, period_begin_date, end_date=period_end_date, n_tweets=len(tweets_df), proxy=proxy)
-                    update_proxy_stats('ok', proxy)
-                    break  # the wile-loop
-                finally:
-                    self._release_proxy_server(proxy)
-                    if fail_counter >= self.max_fails:
-                        txt = f'FAIL | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, queue={self.proxy_queue.qsize()}, fail={fail_counter}'
-                        logger.error(txt)
-                        log_scraping_tweets(self.session_id, 'fail', 'period', username, period_begin_date, period_end_date, proxy=proxy)
-
+            with profiling.period(username, period_begin_date, period_end_date):
+                self.scrape_a_period(username, period_begin_date, period_end_date)
+        profiling.flush()
+        metrics.flush()
         # All periods scraped.
         log_scraping_tweets(self.session_id, 'end', 'session', username, self.session_begin_date, self.session_end_date)
 
+    def _scrape_a_scheduled_period(self, scheduled_period):
+        # Work unit of the session pool. The first period of a user logs the begin of the user session, start_scraping logs the end.
+        username, period_begin_date, period_end_date, first_period = scheduled_period
+        if first_period:
+            log_scraping_tweets(self.session_id, 'begin', 'session', username, self.session_begin_date, self.session_end_date)
+        cpu_start_time = time.process_time()
+        if not set_period_status(self.session_id, username, period_begin_date, period_end_date, 'claimed', pid=os.getpid()):
+            logger.info(f'Period already done | {username}, {period_begin_date} - {period_end_date}')
+            return username
+        with profiling.period(username, period_begin_date, period_end_date):
+            result = self.scrape_a_period(username, period_begin_date, period_end_date)
+        self._journal_period(username, period_begin_date, period_end_date, result)
+        metrics.inc('twitter_worker_cpu_seconds_total', time.process_time() - cpu_start_time)
+        profiling.flush()
+        metrics.flush()
+        return username
+
+    def _scrape_a_batch_of_scheduled_periods(self, scheduled_periods):
+        # Work unit of the session pool with the async fetch engine. Returns the usernames of the scraped periods.
+        cpu_start_time = time.process_time()
+        usernames = asyncio.run(self._scrape_scheduled_periods_async(scheduled_periods))
+        metrics.inc('twitter_worker_cpu_seconds_total', time.process_time() - cpu_start_time)
+        profiling.flush()
+        metrics.flush()
+        return usernames
+
+    async def _scrape_scheduled_periods_async(self, scheduled_periods):
+        from business.fetch_engine import FetchEngine
+        async with FetchEngine() as engine:
+            return await asyncio.gather(*[self._scrape_a_scheduled_period_async(engine, scheduled_period) for scheduled_period in scheduled_periods])
+
+    async def _scrape_a_scheduled_period_async(self, engine, scheduled_period):
+        username, period_begin_date, period_end_date, first_period = scheduled_period
+        if first_period:
+            await _run_blocking(log_scraping_tweets, self.session_id, 'begin', 'session', username, self.session_begin_date, self.session_end_date)
+        async with engine.semaphore:  # Don't take a proxy before the engine can start the search
+            if not await _run_blocking(set_period_status, self.session_id, username, period_begin_date, period_end_date, 'claimed', pid=os.getpid()):
+                logger.info(f'Period already done | {username}, {period_begin_date} - {period_end_date}')
+                return username
+            try:
+                with profiling.period(username, period_begin_date, period_end_date):
+                    result = await self.scrape_a_period_async(engine, username, period_begin_date, period_end_date)
+            except Exception as e:  # A bug on one period doesn't abort the other periods of the batch
+                logger.exception(f'{type(e).__name__} | {username}, {period_begin_date} | {period_end_date}: {e}')
+                await _run_blocking(log_scraping_tweets, self.session_id, 'fail', 'period', username, period_begin_date, period_end_date,
+                                    error=type(e).__name__)
+                result = None
+            await _run_blocking(self._journal_period, username, period_begin_date, period_end_date, result)
+        return username
+
+    def _journal_period(self, username, period_begin_date, period_end_date, result):
+        # result of scrape_a_period, None when the period failed. A period that crashes its worker stays 'claimed'.
+        if result is None:
+            set_period_status(self.session_id, username, period_begin_date, period_end_date, 'failed')
+        else:
+            set_period_status(self.session_id, username, period_begin_date, period_end_date, 'done', **result)
+
+    async def scrape_a_period_async(self, engine, username, period_begin_date, period_end_date):
+        """
+        scrape_a_period for the async fetch engine. The waits for a proxy, after an error and for saving the tweets don't block the
+        other periods on the event loop: the calls to mongodb and to the proxy pool run in the default executor (see _run_blocking).
+        With 'fetch_streaming' the tweets are saved page by page, see _stream_a_period.
+        Call it holding engine.semaphore.
+        """
+        fail_counter = 0
+        period_start_time = time.time()
+        while fail_counter < self.max_fails:
+            proxy = await self._get_proxy_server_async()
+            attempt_start_time = time.time()
+            logger.info(f'Start scraping tweets | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, fail={fail_counter}')
+            ok, latency = False, None
+            try:
+                with profiling.stage('fetch'):
+                    if self.streaming:
+                        n_tweets, result, latency = await self._stream_a_period(engine, username, period_begin_date, period_end_date, proxy)
+                    else:
+                        start_time = time.time()
+                        tweets_df = await engine.fetch_tweets(username, period_begin_date, period_end_date, proxy)
+                        latency = time.time() - start_time
+            except fetch_errors as e:
+                fail_counter += 1
+                await _run_blocking(self._handle_error, _error_flag(e), e, username, period_begin_date, period_end_date, proxy, fail_counter)
+                with profiling.stage('error_sleep'):
+                    await asyncio.sleep(10)
+            except BaseException:
+                ok = None  # A bug or a cancel, not a fail of the proxy
+                raise
+            else:
+                ok = True
+                if not self.streaming:
+                    logger.info(f'Saving {len(tweets_df)} tweets | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}')
+                    n_tweets = len(tweets_df)
+                    with profiling.stage('save'):
+                        result = await _run_blocking(save_tweets, tweets_df) if not tweets_df.empty else {'inserted': 0, 'modified': 0, 'duplicates': 0}
+                await _run_blocking(self._period_ok, username, period_begin_date, period_end_date, n_tweets, proxy, period_start_time)
+                return result
+            finally:
+                await _run_blocking(self._release_proxy_server, proxy, ok, latency, time.time() - attempt_start_time)
+                if fail_counter >= self.max_fails:
+                    await _run_blocking(self._period_fail, username, period_begin_date, period_end_date, proxy, fail_counter, period_start_time)
+        return None
+
+    async def _stream_a_period(self, engine, username, period_begin_date, period_end_date, proxy):
+        """
+        Saves the tweets of the period page by page and checkpoints the cursor of the next page after every saved page.
+        A retry continues from the checkpoint, the saved pages aren't scraped again. The checkpoint is deleted when the period is scraped.
+        Returns the nr of tweets of the period, the save_tweets result of this try and the seconds spent waiting on the proxy.
+        """
+        checkpoint = await _run_blocking(get_scrape_checkpoint, username, period_begin_date, period_end_date)
+        position, n_tweets = (checkpoint['position'], checkpoint['n_tweets']) if checkpoint else ('-1', 0)
+        if checkpoint:
+            logger.info(f'Resume scraping tweets | {username}, {period_begin_date} | {period_end_date}, page={checkpoint["n_pages"] + 1}, n_tweets={n_tweets}')
+        result = {'inserted': 0, 'modified': 0, 'duplicates': 0}
+        start_time, save_time = time.time(), 0
+        async for tweets_df, position in engine.stream_tweets(username, period_begin_date, period_end_date, proxy, position):
+            save_start_time = time.time()
+            with profiling.stage('save'):
+                page_result = await _run_blocking(self._save_a_page, tweets_df, username, period_begin_date, period_end_date, position)
+            result = {key: result[key] + page_result[key] for key in result}
+            n_tweets += len(tweets_df)
+            save_time += time.time() - save_start_time
+        await _run_blocking(delete_scrape_checkpoint, username, period_begin_date, period_end_date)
+        return n_tweets, result, time.time() - start_time - save_time
+
+    @staticmethod
+    def _save_a_page(tweets_df, username, period_begin_date, period_end_date, position):
+        # The checkpoint is saved after the tweets, a crash in between saves the page again, save_tweets is idempotent
+        result = save_tweets(tweets_df) if not tweets_df.empty else {'inserted': 0, 'modified': 0, 'duplicates': 0}
+        save_scrape_checkpoint(username, period_begin_date, period_end_date, position, len(tweets_df))
+        return result
+
+    def scrape_a_period(self, username, period_begin_date, period_end_date):
+        # Returns the save_tweets result {'inserted': n, 'modified': n, 'duplicates': n} when the period is scraped, None after max_fails
+        from business.twitter_scraper import TweetScraper
+        fail_counter = 0
+        period_start_time = time.time()
+        while fail_counter < self.max_fails:
+            proxy = self._get_proxy_server()
+            attempt_start_time = time.time()
+            logger.info(
+                f'Start scraping tweets | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, pool={self.proxy_pool.qsize()}, fail={fail_counter}')
+            tweet_scraper = TweetScraper(username, period_begin_date, period_end_date)
+            tweet_scraper.proxy_server = proxy
+            ok, latency = False, None
+            try:
+                start_time = time.time()
+                with profiling.stage('fetch'):
+                    tweets_df = tweet_scraper.execute_scraping()
+                latency = time.time() - start_time
+            except ValueError as e:
+                fail_counter += 1
+                self.handle_error('ValueError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
+            except ServerDisconnectedError as e:
+                fail_counter += 1
+                self.handle_error('ServerDisconnectedError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
+            except ClientOSError as e:
+                fail_counter += 1
+                self.handle_error('ClientOSError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
+            except TimeoutError as e:
+                fail_counter += 1
+                self.handle_error('TimeoutError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
+            except ClientHttpProxyError as e:
+                fail_counter += 1
+                self.handle_error('ClientHttpProxyError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
+            except IndexError as e:
+                fail_counter += 1
+                self.handle_error('IndexError', e, username, period_begin_date, period_end_date, proxy, fail_counter)
+            except Exception as e:  # Any other error of the search also counts as a fail, so the period ends after max_fails
+                fail_counter += 1
+                self.handle_error(type(e).__name__, e, username, period_begin_date, period_end_date, proxy, fail_counter)
+            else:
+                ok = True
+                logger.info(
+                    f'Saving {len(tweets_df)} tweets | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, pool={self.proxy_pool.qsize()}')
+                with profiling.stage('save'):
+                    result = save_tweets(tweets_df) if not tweets_df.empty else {'inserted': 0, 'modified': 0, 'duplicates': 0}
+                self._period_ok(username, period_begin_date, period_end_date, len(tweets_df), proxy, period_start_time)
+                return result
+            finally:
+                self._release_proxy_server(proxy, ok, latency, time.time() - attempt_start_time)
+                if fail_counter >= self.max_fails:
+                    self._period_fail(username, period_begin_date, period_end_date, proxy, fail_counter, period_start_time)
+        return None
+
+    def _tail_a_user(self, username):
+        # Scrapes the tweets of a user since the day of the newest stored tweet. Returns the nr of new tweets, None when the scraping failed.
+        last_tweet_datetime = get_last_tweet_datetime(username)
+        if last_tweet_datetime:
+            begin_date = last_tweet_datetime.date()
+        else:
+            begin_date = datetime.today().date() - timedelta(days=scraping_cfg.tail_history_days)
+        end_date = datetime.today().date() + timedelta(days=1)  # Until is exclusive
+        with profiling.period(username, begin_date, end_date):
+            result = self.scrape_a_period(username, begin_date, end_date)
+        profiling.flush()
+        metrics.flush()
+        return username, result['inserted'] if result else None
+
     def handle_error(self, flag, e, username, period_begin_date, period_end_date, proxy, fail_counter):
-        txt = f'{flag} | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, queue={self.proxy_queue.qsize()}, fail={fail_counter}'
+        self._handle_error(flag, e, username, period_begin_date, period_end_date, proxy, fail_counter)
+        with profiling.stage('error_sleep'):
+            time.sleep(10)
+
+    def _handle_error(self, flag, e, username, period_begin_date, period_end_date, proxy, fail_counter):
+        txt = f'{flag} | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, pool={self.proxy_pool.qsize()}, fail={fail_counter}'
         logger.warning(txt)
         logger.warning(e)
         update_proxy_stats(flag, proxy)
-        time.sleep(10)
-
-    def _release_proxy_server(self, proxy):
-        logger.info(f'Put back proxy {proxy["ip"]}:{proxy["port"]}')
-        self.proxy_queue.put({'ip': proxy['ip'], 'port': proxy['port']})
-
-    def _check_proxy_queue(self):
-        if self.proxy_queue.qsize() <= 1:
+        metrics.inc('twitter_scrape_errors_total', error=flag)
+
+    def _period_ok(self, username, period_begin_date, period_end_date, n_tweets, proxy, period_start_time):
+        log_scraping_tweets(self.session_id, 'ok', 'period', username, period_begin_date, end_date=period_end_date, n_tweets=n_tweets, proxy=proxy)
+        update_proxy_stats('ok', proxy)
+        self._observe_period('ok', period_start_time)
+
+    def _period_fail(self, username, period_begin_date, period_end_date, proxy, fail_counter, period_start_time):
+        txt = f'FAIL | {username}, {period_begin_date} | {period_end_date}, {proxy["ip"]}:{proxy["port"]}, pool={self.proxy_pool.qsize()}, fail={fail_counter}'
+        logger.error(txt)
+        log_scraping_tweets(self.session_id, 'fail', 'period', username, period_begin_date, period_end_date, proxy=proxy)
+        self._observe_period('fail', period_start_time)
+
+    @staticmethod
+    def _observe_period(status, period_start_time):
+        metrics.inc('twitter_periods_total', status=status)
+        metrics.observe('twitter_period_seconds', time.time() - period_start_time)
+
+    def _get_proxy_server(self):
+        # The healthiest available proxy. Waits when all proxies are in use or benched.
+        with profiling.stage('proxy_pool'):
+            while True:
+                proxy = self.proxy_pool.acquire()
+                if proxy: return proxy
+                self._check_proxy_pool()
+                time.sleep(1)
+
+    async def _get_proxy_server_async(self):
+        with profiling.stage('proxy_pool'):
+            while True:
+                proxy = await _run_blocking(self.proxy_pool.acquire)
+                if proxy: return proxy
+                await _run_blocking(self._check_proxy_pool)
+                await asyncio.sleep(1)
+
+    def _release_proxy_server(self, proxy, ok, latency=None, seconds=None):
+        # seconds: duration of the attempt with the proxy, for the metrics
+        logger.info(f'Put back proxy {proxy["ip"]}:{proxy["port"]}, ok={ok}')
+        with profiling.stage('proxy_pool'):
+            self.proxy_pool.release({'ip': proxy['ip'], 'port': proxy['port']}, ok, latency)
+        if seconds is not None:
+            metrics.observe('twitter_proxy_request_seconds', seconds, proxy=f'{proxy["ip"]}:{proxy["port"]}')
+
+    def _proxy_pool_metrics(self):
+        # Collector of the metrics endpoint
+        return [('twitter_proxy_pool_size', {}, self.proxy_pool.size()),
+                ('twitter_proxy_pool_available', {}, self.proxy_pool.qsize()),
+                ('twitter_proxy_pool_benched', {}, self.proxy_pool.n_benched())]
+
+    def _check_proxy_pool(self):
+        if self.proxy_pool.qsize() <= 1:
             self.max_proxy_delay *= 1.2
-            self._populate_proxy_queue()
-            logger.debug(f' | proxies queue length: {self.proxy_queue.qsize()}')
+            self._populate_proxy_pool()
+            logger.debug(f' | proxies available: {self.proxy_pool.qsize()}, benched: {self.proxy_pool.n_benched()}')
 
     # ----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -243,9 +635,22 @@ class TwitterScrapingSession:
             scrape_periods = self._get_periods_without_min_tweets(username, session_begin_date=session_begin_date, session_end_date=session_end_date)
         else:
             scrape_periods = [(session_begin_date, session_end_date)]
-        scrape_periods = self._split_periods(scrape_periods)
+        density = self._tweet_density(username)
+        if density:
+            scrape_periods = self._split_periods_by_density(scrape_periods, *density)
+        else:  # New user or fixed periods
+            scrape_periods = self._split_periods(scrape_periods)
         return scrape_periods
 
+    def _tweet_density(self, username):
+        # ({date: nr of tweets}, average nr of tweets per day) of the stored tweets of the user. None for a user without stored tweets.
+        if not self.tweets_per_period: return None
+        nr_tweets_per_day = get_nr_tweets_per_day(username)
+        if nr_tweets_per_day.empty: return None
+        days = nr_tweets_per_day['date'].dt.date
+        rate = nr_tweets_per_day['nr_tweets'].sum() / ((days.max() - days.min()).days + 1)
+        return dict(zip(days, nr_tweets_per_day['nr_tweets'])), rate
+
     def _get_periods_without_min_tweets(self, username, session_begin_date, session_end_date):
         """
         Gets all the dates when 'username' has 'min_tweets' nr of tweets stored in the database.
@@ -271,31 +676,46 @@ class TwitterScrapingSession:
             return [(session_begin_date, session_end_date)]
 
     def _split_periods(self, periods):
-        # Split the periods into parts with a maximal length of 'TIME_DELTA' days
-        td = self.timedelta
+        """
+        Splits the periods into parts of at most 'timedelta' days.
+        The periods include their end date. The end date of a part is the until of the search, excluded, and the begin of the next part.
+        """
+        td = timedelta(days=self.timedelta)
         splitted_periods = []
         for b, e in periods:
-            if e - b <= timedelta(days=td):
-                splitted_periods.append((b, e))
-            else:
-                while e - b >= timedelta(days=self.timedelta):
-                    splitted_periods.append((b, b + timedelta(days=td - 1)))
-                    b = b + timedelta(days=td)
-                    # The last part of the splitting
-                    if e - b < timedelta(td):
-                        splitted_periods.append((b, e))
+            e = e + timedelta(days=1)
+            while e - b > td:
+                splitted_periods.append((b, b + td))
+                b = b + td
+            splitted_periods.append((b, e))
+        return splitted_periods
+
+    def _split_periods_by_density(self, periods, nr_tweets_per_day, rate):
+        """
+        Splits the periods into parts with about 'tweets_per_period' expected tweets and at most 'max_period_days' days.
+        The expected nr of tweets of a day is its stored count, or the average 'rate' of the user for a day without stored tweets.
+        The periods include their end date. The end date of a part is the until of the search, excluded, and the begin of the next part.
+        """
+        splitted_periods = []
+        for b, e in periods:
+            e = e + timedelta(days=1)
+            day, expected = b, 0
+            while day < e:
+                expected += nr_tweets_per_day.get(day, rate)
+                day += timedelta(days=1)
+                if day < e and (expected >= self.tweets_per_period or (day - b).days >= self.max_period_days):
+                    splitted_periods.append((b, day))
+                    b, expected = day, 0
+            splitted_periods.append((b, e))
         return splitted_periods
 
     # ----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
-    def _populate_proxy_queue(self): # Todo: Trow out every proxy with problems. Reload fast besed on ratio ok/fail
+    def _populate_proxy_pool(self):
+        # Proxies already in the pool keep their score, new ones are seeded with their stats in the db
         proxy_df = get_proxies(max_delay=self.max_proxy_delay)
-        # Shuffle the proxies otherwise always same order
-        proxy_df = proxy_df.sample(frac=1., replace=False)
-        for _, proxy in proxy_df.iterrows():
-            # self.proxy_queue.put((proxy['ip'], proxy['port']))
-            self.proxy_queue.put({'ip': proxy['ip'], 'port': proxy['port']})
-        logger.warning(f'Proxy queue poulates. Contains {self.proxy_queue.qsize()} servers')
+        size = self.proxy_pool.populate(proxy_df.to_dict('records'))
+        logger.warning(f'Proxy pool populated. Contains {size} servers, {self.proxy_pool.qsize()} available, {self.proxy_pool.n_benched()} benched')
 
 
 # ----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
@@ -303,27 +723,25 @@ class TwitterScrapingSession:
 
 ####################################################################################################################################################################################
 def scrape_proxies():
+    from business.proxy_scraper import ProxyScraper
     ps = ProxyScraper()
     logger.info('=' * 100)
     logger.info('Start scrapping Proxies')
     logger.info('=' * 100)
-    if scraping_cfg.proxies_download_sites['free_proxy_list']:
-        logger.info(f'Start scraping proxies from free_proxy_list.net')
-        proxies_df = ps.scrape_free_proxy_list()
-        save_proxies(proxies_df)
-    if scraping_cfg.proxies_download_sites['hide_my_name']:
-        logger.info(f'Start scraping proxies from hidemy.name')
-        proxies_df = ps.scrape_hide_my_name()
+    sources = [source for source, enabled in scraping_cfg.proxies_download_sites.items() if enabled]
+    if sources:
+        logger.info(f'Start scraping proxies from {", ".join(sources)}')
+        proxies_df = ps.scrape_proxy_sources(sources)
         save_proxies(proxies_df)
     ps.test_proxies()
 
 
-def reset_proxy_servers():
-    reset_proxies_scrape_success_flag()
+def reset_proxy_servers(totals=False, blacklisted=None):
+    return reset_proxies_scrape_success_flag(totals, blacklisted)
 
 
-def reset_scrape_flag():
-    reset_all_scrape_flags()
+def reset_scrape_flag(party=None):
+    return reset_all_scrape_flags(party)
 
 
 ####################################################################################################################################################################################
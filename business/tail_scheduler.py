@@ -0,0 +1,72 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/26
+# src - tail_scheduler.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import heapq
+import time
+
+from database.config_facade import Scraping_cfg
+
+scraping_cfg = Scraping_cfg()
+
+
+class TailScheduler:
+    """
+    Decides when to poll each user for new tweets in tail mode.
+    The poll interval of a user is the time the user needs to post 'new_tweets_per_poll' tweets, clamped between 'min_interval' and 'max_interval'.
+    The posting rate (tweets/day) is seeded from the history in the database and updated with an EWMA of the new tweets found at every poll.
+    A party leader that tweets 50 times a day is polled every 'min_interval' (1 hour), a quiet backbencher every 'max_interval' (1 day).
+    """
+
+    def __init__(self, min_interval=None, max_interval=None, new_tweets_per_poll=None, alpha=None):
+        self.min_interval = min_interval or scraping_cfg.tail_min_interval
+        self.max_interval = max_interval or scraping_cfg.tail_max_interval
+        self.new_tweets_per_poll = new_tweets_per_poll or scraping_cfg.tail_new_tweets_per_poll
+        self.alpha = alpha or scraping_cfg.tail_rate_alpha
+        self._rates = {}  # {username: tweets/day}
+        self._last_poll = {}  # {username: timestamp}
+        self._queue = []  # heap of (due timestamp, username)
+
+    def add(self, username, rate, due=None):
+        self._rates[username] = rate
+        self._last_poll[username] = None
+        heapq.heappush(self._queue, (due if due is not None else time.time(), username))
+
+    def interval(self, username):
+        rate = self._rates[username]
+        if rate <= 0: return self.max_interval
+        interval = self.new_tweets_per_poll / rate * 24 * 3600
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def pop_due(self, now=None):
+        # Returns the users that have to be polled now
+        now = now or time.time()
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            _, username = heapq.heappop(self._queue)
+            due.append(username)
+        return due
+
+    def seconds_to_next_poll(self, now=None):
+        if not self._queue: return None
+        return max(self._queue[0][0] - (now or time.time()), 0)
+
+    def update(self, username, n_new_tweets, now=None):
+        """
+        Updates the posting rate with the nr of new tweets since the last poll and schedules the next poll.
+        n_new_tweets=None means the poll failed. The user is retried after min_interval.
+        """
+        now = now or time.time()
+        if n_new_tweets is None:
+            heapq.heappush(self._queue, (now + self.min_interval, username))
+            return
+        if self._last_poll[username] is not None:  # The first poll catches up since the last stored tweet. It says nothing about the rate.
+            elapsed_days = max(now - self._last_poll[username], 1) / (24 * 3600)
+            observed_rate = n_new_tweets / elapsed_days
+            self._rates[username] += self.alpha * (observed_rate - self._rates[username])
+        self._last_poll[username] = now
+        heapq.heappush(self._queue, (now + self.interval(username), username))
+
+    def __len__(self):
+        return len(self._rates)
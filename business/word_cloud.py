@@ -0,0 +1,30 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/28
+# src - word_cloud.py
+# md
+# --------------------------------------------------------------------------------------------------------
+from datetime import datetime
+
+from database.twitter_facade import get_top_terms
+from tools.utils import users_list_usernames
+
+
+def top_terms(username=None, party=None, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1), n=100):
+    """
+    The n most used terms of a user, a party (a key of config.USERS_LIST) or all users, between begin_date and end_date.
+    Merges the precomputed term counts per user and day, the tweets are not read. Returns a DataFrame with the columns term, count.
+    Dutch stopwords and config.WORDCLOUD_BLACKLIST are left out.
+    """
+    if username is not None:
+        usernames = [username.lower()]
+    elif party is not None:
+        usernames = users_list_usernames(party)
+    else:
+        usernames = None
+    return get_top_terms(usernames, begin_date, end_date, n)
+
+
+def word_frequencies(username=None, party=None, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1), n=100):
+    # {term: count}, the input of wordcloud.WordCloud().generate_from_frequencies()
+    top_terms_df = top_terms(username, party, begin_date, end_date, n)
+    return dict(zip(top_terms_df['term'], top_terms_df['count']))
@@ -3,46 +3,203 @@
 # src - backup_collections.py
 # md
 # --------------------------------------------------------------------------------------------------------
+import argparse
+import gzip
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 
-from pymongo import MongoClient
+import bson
+from pymongo import InsertOne
 
+from database.config_facade import SystemCfg
+from database.connection import get_database
+from database.db_management import q_bulk_write
 from tools.logger import logger
 
-# collection_names = ['profiles', 'proxies']
+"""
+Backup of the collections, either to a backup database or to compressed archives on disk.
+
+- backup_database() copies the collections in parallel. Every copy reads with large cursor batches and writes with unordered bulk insert
+  batches in background threads. The indexes are built after the load.
+- dump_database() streams every collection to a gzipped archive '<collection>.bson.gz'. The first document of the archive is a header with
+  the collection name and the indexes, followed by the documents in BSON (the format of mongodump).
+- restore_database() loads the archives back the same way as a copy.
+The throughput is reported in docs/sec.
+
+Usage:
+    python -m database.backup_collections copy [--collections profiles proxies tweets] [--backup-database name]
+    python -m database.backup_collections dump --dir /path/to/backup
+    python -m database.backup_collections restore --dir /path/to/backup [--database name]
+
+IMPLEMENTED FUNCTIONS
+---------------------
+- backup_database(collection_names, source_database, backup_database, n_threads, batch_size, n_writers)
+- backup_collection(collection_name, source_database, backup_database, batch_size, n_writers)
+- dump_database(collection_names, directory, database, n_threads, batch_size)
+- dump_collection(collection_name, path, database, batch_size)
+- restore_database(directory, database, n_threads, batch_size, n_writers)
+- restore_collection(path, database, batch_size, n_writers)
+"""
+system_cfg = SystemCfg()
+
 collection_names = ['profiles', 'proxies', 'tweets']
+_default_batch_size = 10000  # Docs per cursor batch and per bulk insert
+_default_n_writers = 4  # Bulk insert batches in flight per collection
+_log_every = 500000  # docs
+
+
+def _index_specs(collection):
+    # [(keys, options)] of all indexes except _id_
+    specs = []
+    for name, index_info in collection.index_information().items():
+        if name == '_id_': continue
+        keys = index_info.pop('key')
+        for option in ['ns', 'v']:
+            index_info.pop(option, None)
+        index_info['name'] = name
+        specs.append((keys, index_info))
+    return specs
 
-source_database = 'twitter_database'
-backup_database = f'twitter_database_backup_{datetime.now().date()}'
 
-client = MongoClient()
-source_db = client[source_database]
-backup_db = client[backup_database]
+def _create_indexes(collection, specs):
+    for keys, options in specs:
+        collection.create_index(keys, **options)
+        logger.info(f'Index {options["name"]} for {collection.name} created')
 
-for collection_name in collection_names:
-    source_collection = source_db[collection_name]
-    backup_collection = backup_db[collection_name]
-    # check if source exists. If so, do nothing
+
+def _insert_batch(collection, docs):
+    # Docs that are already in the collection are skipped
+    return q_bulk_write(collection, [InsertOne(doc) for doc in docs], retry_duplicates=False)['nInserted']
+
+
+def _bulk_insert(docs, collection, batch_size, n_writers):
+    """
+    Inserts an iterable of docs with unordered bulk insert batches. Up to 'n_writers' batches are written in background threads while
+    the next batch is read. Returns the nr of inserted docs and the docs/sec.
+    """
+    start_time = time.time()
+    n_inserted, n_read = 0, 0
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=n_writers) as executor:
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            n_read += 1
+            if len(batch) >= batch_size:
+                if len(in_flight) >= n_writers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    n_inserted += sum(f.result() for f in done)
+                in_flight.add(executor.submit(_insert_batch, collection, batch))
+                batch = []
+            if n_read % _log_every == 0:
+                logger.info(f'{collection.name}: {n_read} docs read, {n_read / (time.time() - start_time):.0f} docs/sec')
+        if batch: in_flight.add(executor.submit(_insert_batch, collection, batch))
+        n_inserted += sum(f.result() for f in in_flight)
+    docs_per_sec = n_inserted / max(time.time() - start_time, 1e-6)
+    return n_inserted, docs_per_sec
+
+
+def backup_collection(collection_name, source_database, backup_database, batch_size=_default_batch_size, n_writers=_default_n_writers):
+    source_db, backup_db = get_database(source_database), get_database(backup_database)
+    source_collection, backup_collection = source_db[collection_name], backup_db[collection_name]
+    # check if the backup exists. If so, do nothing
     if collection_name in backup_db.list_collection_names():
-        logger.warning(f'{collection_name} already exists in {backup_db}')
+        logger.warning(f'{collection_name} already exists in {backup_database}')
+        return 0
+    cursor = source_collection.find({}, batch_size=batch_size, no_cursor_timeout=True)
+    try:
+        n, docs_per_sec = _bulk_insert(cursor, backup_collection, batch_size, n_writers)
+    finally:
+        cursor.close()
+    logger.info(f'Copied total of {n} documents from {collection_name} collection ({docs_per_sec:.0f} docs/sec)')
+    # Indexes after the load, it's faster to build them once than to maintain them during the load
+    _create_indexes(backup_collection, _index_specs(source_collection))
+    return n
 
-    else:
-        # Create indices
-        for name, index_info in source_collection.index_information().items():
-            keys = index_info['key']
-            del (index_info['ns'])
-            del (index_info['v'])
-            del (index_info['key'])
-            backup_collection.create_index(keys, name=name, **index_info)
-            logger.info(f'Index {name} for {collection_name} created')
-        # Copy documents
-        i = 0
-        for doc in source_collection.find({}):
-            backup_collection.insert_one(doc)
-            i += 1
-            if i % 50000 == 0: logger.info(f'Copied {i} documents from {collection_name} collection')
-        logger.info(f'Copied total of {i} documents from {collection_name} collection')
+
+def backup_database(collection_names=collection_names, source_database=None, backup_database=None, n_threads=None, batch_size=_default_batch_size,
+                    n_writers=_default_n_writers):
+    source_database = source_database or system_cfg.database
+    backup_database = backup_database or f'{source_database}_backup_{datetime.now().date()}'
+    logger.info(f'Start backup of {collection_names} from {source_database} to {backup_database}')
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=n_threads or len(collection_names)) as executor:
+        futures = {name: executor.submit(backup_collection, name, source_database, backup_database, batch_size, n_writers) for name in collection_names}
+        counts = {name: future.result() for name, future in futures.items()}
+    elapsed = time.time() - start_time
+    logger.info(f'Backup done: {counts} in {elapsed:.0f} sec ({sum(counts.values()) / max(elapsed, 1e-6):.0f} docs/sec)')
+    return counts
+
+
+def dump_collection(collection_name, path, database=None, batch_size=_default_batch_size):
+    collection = get_database(database)[collection_name]
+    header = {'collection': collection_name,
+              'indexes': [{'keys': list(keys), 'options': options} for keys, options in _index_specs(collection)],
+              'datetime': datetime.now()}
+    start_time = time.time()
+    n = 0
+    tmp_path = f'{path}.tmp'
+    cursor = collection.find({}, batch_size=batch_size, no_cursor_timeout=True)
+    try:
+        with gzip.open(tmp_path, 'wb', compresslevel=1) as f:  # Level 1: the dump is bound by the compression otherwise
+            f.write(bson.encode(header))
+            for raw in cursor:
+                f.write(bson.encode(raw))
+                n += 1
+                if n % _log_every == 0:
+                    logger.info(f'{collection_name}: {n} docs dumped, {n / (time.time() - start_time):.0f} docs/sec')
+    finally:
+        cursor.close()
+    os.replace(tmp_path, path)  # An interrupted dump doesn't leave a valid looking archive
+    docs_per_sec = n / max(time.time() - start_time, 1e-6)
+    logger.info(f'Dumped total of {n} documents from {collection_name} collection to {path} ({docs_per_sec:.0f} docs/sec)')
+    return n
+
+
+def dump_database(collection_names=collection_names, directory='.', database=None, n_threads=None, batch_size=_default_batch_size):
+    os.makedirs(directory, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=n_threads or len(collection_names)) as executor:
+        futures = {name: executor.submit(dump_collection, name, os.path.join(directory, f'{name}.bson.gz'), database, batch_size)
+                   for name in collection_names}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def restore_collection(path, database=None, batch_size=_default_batch_size, n_writers=_default_n_writers):
+    with gzip.open(path, 'rb') as f:
+        docs = bson.decode_file_iter(f)
+        header = next(docs)
+        collection_name = header['collection']
+        collection = get_database(database)[collection_name]
+        n, docs_per_sec = _bulk_insert(docs, collection, batch_size, n_writers)
+    logger.info(f'Restored total of {n} documents in {collection_name} collection from {path} ({docs_per_sec:.0f} docs/sec)')
+    _create_indexes(collection, [([tuple(key) for key in index['keys']], index['options']) for index in header['indexes']])
+    return n
+
+
+def restore_database(directory='.', database=None, n_threads=None, batch_size=_default_batch_size, n_writers=_default_n_writers):
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.bson.gz'))
+    with ThreadPoolExecutor(max_workers=n_threads or max(len(paths), 1)) as executor:
+        futures = {path: executor.submit(restore_collection, path, database, batch_size, n_writers) for path in paths}
+        return {path: future.result() for path, future in futures.items()}
 
 
 if __name__ == '__main__':
-    pass
+    parser = argparse.ArgumentParser(description='Backup the collections to a backup database or to compressed archives')
+    parser.add_argument('command', choices=['copy', 'dump', 'restore'])
+    parser.add_argument('--collections', nargs='+', default=collection_names)
+    parser.add_argument('--database', default=None, help='Source database for copy and dump, target database for restore')
+    parser.add_argument('--backup-database', default=None, help='Target database for copy')
+    parser.add_argument('--dir', default='.', help='Directory of the archives for dump and restore')
+    parser.add_argument('--threads', type=int, default=None, help='Nr of collections processed in parallel')
+    parser.add_argument('--batch-size', type=int, default=_default_batch_size)
+    parser.add_argument('--writers', type=int, default=_default_n_writers, help='Nr of bulk insert batches in flight per collection')
+    args = parser.parse_args()
+
+    if args.command == 'copy':
+        backup_database(args.collections, args.database, args.backup_database, args.threads, args.batch_size, args.writers)
+    elif args.command == 'dump':
+        dump_database(args.collections, args.dir, args.database, args.threads, args.batch_size)
+    else:
+        restore_database(args.dir, args.database, args.threads, args.batch_size, args.writers)
@@ -0,0 +1,77 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/29
+# src - checkpoint_queries.py
+# md
+# --------------------------------------------------------------------------------------------------------
+from datetime import datetime
+
+from pymongo import ASCENDING
+
+from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes
+
+"""
+Group of queries to store and retrief the checkpoints of the periods that are scraped page by page.
+A checkpoint is {'username': u, 'begin_date': datetime, 'end_date': datetime, 'position': cursor of the next results page,
+'n_pages': n, 'n_tweets': n, 'timestamp': datetime}. It's saved after every saved page and deleted when the period is scraped.
+The queries start with 'q_'
+Queries accept and return a dict or a lists of dicts when suitable
+
+Convention:
+-----------
+- documnet:     d
+- query:        q
+- projection:   p
+- sort:         s
+- filter:       f
+- update:       u
+- pipeline      pl
+- match         m
+- group:        g
+
+IMPLEMENTED QUERIES
+-------------------
+- q_save_checkpoint(username, begin_date, end_date, position, n_tweets)
+- q_get_checkpoint(username, begin_date, end_date)
+- q_delete_checkpoint(username, begin_date, end_date)
+"""
+system_cfg = SystemCfg()
+database = system_cfg.database
+collection_name = 'scrape_checkpoints'
+indexes = [{'keys': [('username', ASCENDING), ('begin_date', ASCENDING), ('end_date', ASCENDING)], 'unique': True}]  # all queries
+
+
+def get_collection():
+    return get_db_collection(collection_name)
+
+
+def setup_collection(drop_unknown=False):
+    return q_setup_indexes(collection_name, indexes, drop_unknown)
+
+
+def _period_filter(username, begin_date, end_date):
+    return {'username': username, 'begin_date': begin_date, 'end_date': end_date}
+
+
+def q_save_checkpoint(username, begin_date, end_date, position, n_tweets):
+    # Sets the position of the next page and adds the page with n_tweets to the checkpoint of the period
+    collection = get_collection()
+    u = {'$set': {'position': position, 'timestamp': datetime.now()},
+         '$inc': {'n_pages': 1, 'n_tweets': n_tweets}}
+    collection.update_one(_period_filter(username, begin_date, end_date), u, upsert=True)
+
+
+def q_get_checkpoint(username, begin_date, end_date):
+    collection = get_collection()
+    p = {'_id': 0}
+    return collection.find_one(_period_filter(username, begin_date, end_date), p)
+
+
+def q_delete_checkpoint(username, begin_date, end_date):
+    collection = get_collection()
+    collection.delete_one(_period_filter(username, begin_date, end_date))
+
+
+if __name__ == '__main__':
+    setup_collection()
@@ -18,19 +18,70 @@ conf_all = {
     'scrape_with_proxy': True,  # Todo: obsolete?
     'session_end_date': datetime.today().date(),
     'session_begin_date': (datetime.now() - timedelta(days=20)).date(),
-    'time_delta': 10,
+    'time_delta': 10,  # days per period for users without stored tweets, or for all users when tweets_per_period is None
+    'tweets_per_period': 1000,  # Size the periods of a user to this expected nr of tweets, from the stored daily counts
+    'max_period_days': 365,
     'max_fails': 10,
     'max_proxy_delay': 30,
+    'proxy_pool_alpha': 0.3,  # EWMA weight of the last scraping result
+    'proxy_max_consecutive_fails': 3,  # Bench a proxy after n fails in a row
+    'proxy_cooldown': 120,  # seconds, doubles every time a proxy is benched again
+    'proxy_max_cooldown': 3600,  # seconds
+    'proxy_latency_scale': 10,  # seconds, latency that halves the score of a proxy
     'scrape_only_missing_dates': False,
     'min_tweets': 1,
+    # Fetch engine
+    'fetch_engine': 'twint',  # 'twint': one twint.run.Search per process, 'async': concurrent searches on one event loop per process
+    'fetch_concurrency': 50,  # Nr of searches in flight per process with the async engine
+    'fetch_batch_size': 200,  # Nr of scheduled periods a process takes at once with the async engine
+    'fetch_timeout': 120,  # seconds, per request
+    'fetch_base_url': 'https://twitter.com/i',  # Point the async engine at a stand-in server for tests
+    'fetch_streaming': True,  # With the async engine: save every results page when it arrives and checkpoint the cursor of the next page
+    'fetch_checkpoint_max_age': 24 * 3600,  # seconds, older checkpoints are ignored and the period is scraped from the start
+    # Worker processes
+    'worker_start_method': 'fork',  # 'fork': fork the session process, 'forkserver': fork a server that only imported the worker modules
+    # Tail mode
+    'tail_min_interval': 3600,  # seconds
+    'tail_max_interval': 24 * 3600,  # seconds
+    'tail_new_tweets_per_poll': 3,  # Poll a user when he has posted this nr of tweets on average
+    'tail_history_days': 30,  # Nr of days to seed the posting rate
+    'tail_rate_alpha': 0.3,  # EWMA weight of the last poll
     # Proxies
     'scrape_proxies': True,
-    'proxies_download_sites': {'free_proxy_list': False, 'hide_my_name': False},
+    'proxies_download_sites': {'free_proxy_list': False, 'hide_my_name': False, 'proxyscrape': False},  # See business/proxy_sources.py
+    'proxy_source_timeout': 60,  # seconds, to download a page of a proxy source
+    'proxy_test_url': 'https://mobile.twitter.com/',
+    'proxy_test_content': 'twitter',  # Text the page of proxy_test_url must contain (case insensitive), None = any page
+    'proxy_test_ip_url': 'http://api.ipify.org/',  # Answers the ip of the caller as text, the exit ip of a proxy must differ, None = no check
+    'proxy_test_concurrency': 1000,  # Nr of proxy tests in flight
+    'proxy_test_connect_timeout': 10,  # seconds
+    'proxy_test_read_timeout': 20,  # seconds
 
     # System
     'database': 'twitter_database_xxx',
     'logging_level': 'Info',
     # 'logging_level': 'Debug',
+    # Mongodb connection pool (one client per process)
+    'mongo_uri': None,  # None = localhost:27017
+    'mongo_max_pool_size': 20,
+    'mongo_min_pool_size': 0,
+    'mongo_connect_timeout_ms': 20000,
+    'mongo_socket_timeout_ms': None,  # None = no timeout
+    'mongo_server_selection_timeout_ms': 30000,
+    'mongo_bulk_batch_size': 1000,  # Nr of operations per bulk_write
+    # Buffered log writer
+    'log_buffer_size': 10000,  # Max nr of logs waiting in the queue
+    'log_flush_size': 500,  # Flush when this nr of logs is buffered
+    'log_flush_interval': 2,  # seconds, flush at least this often
+    'log_put_timeout': 1,  # seconds a worker waits on a full queue before dropping the log
+    # Profile statistics time series
+    'profile_stats_bucket_size': 200,  # Max nr of samples in a monthly bucket
+    # Metrics
+    'metrics_port': None,  # ex. 9108: serves the session metrics on http://127.0.0.1:9108/metrics, None = no metrics
+    # Profiling of the scraping workers (see tools/profiling.py)
+    'profiling': None,  # None, 'stages': time per stage of every period, 'cprofile' or 'sampling': stages + a profile of every worker
+    'profiling_dir': 'profiles',
+    'profiling_interval': 0.005,  # seconds of CPU time between the samples of 'sampling'
 
 }
 conf = conf_all
@@ -58,6 +109,34 @@ class Scraping_cfg(_Config):
     def proxies_download_sites(self):
         return self.get_property('proxies_download_sites')
 
+    @property
+    def proxy_test_url(self):
+        return self.get_property('proxy_test_url')
+
+    @property
+    def proxy_test_content(self):
+        return self.get_property('proxy_test_content')
+
+    @property
+    def proxy_test_ip_url(self):
+        return self.get_property('proxy_test_ip_url')
+
+    @property
+    def proxy_test_concurrency(self):
+        return self.get_property('proxy_test_concurrency')
+
+    @property
+    def proxy_test_connect_timeout(self):
+        return self.get_property('proxy_test_connect_timeout')
+
+    @property
+    def proxy_test_read_timeout(self):
+        return self.get_property('proxy_test_read_timeout')
+
+    @property
+    def proxy_source_timeout(self):
+        return self.get_property('proxy_source_timeout')
+
     # ------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
     @property
@@ -76,6 +155,26 @@ class Scraping_cfg(_Config):
     def max_proxy_delay(self):
         return self.get_property('max_proxy_delay')
 
+    @property
+    def proxy_pool_alpha(self):
+        return self.get_property('proxy_pool_alpha')
+
+    @property
+    def proxy_max_consecutive_fails(self):
+        return self.get_property('proxy_max_consecutive_fails')
+
+    @property
+    def proxy_cooldown(self):
+        return self.get_property('proxy_cooldown')
+
+    @property
+    def proxy_max_cooldown(self):
+        return self.get_property('proxy_max_cooldown')
+
+    @property
+    def proxy_latency_scale(self):
+        return self.get_property('proxy_latency_scale')
+
     def min_tweets(selfs):
         return selfs.get_property('min_tweets')
 
@@ -91,6 +190,14 @@ class Scraping_cfg(_Config):
     def time_delta(self):
         return self.get_property('time_delta')
 
+    @property
+    def tweets_per_period(self):
+        return self.get_property('tweets_per_period')
+
+    @property
+    def max_period_days(self):
+        return self.get_property('max_period_days')
+
     @property
     def max_fails(self):
         return self.get_property('max_fails')
@@ -99,6 +206,58 @@ class Scraping_cfg(_Config):
     def n_processes(self):
         return self.get_property('n_processes')
 
+    @property
+    def tail_min_interval(self):
+        return self.get_property('tail_min_interval')
+
+    @property
+    def tail_max_interval(self):
+        return self.get_property('tail_max_interval')
+
+    @property
+    def tail_new_tweets_per_poll(self):
+        return self.get_property('tail_new_tweets_per_poll')
+
+    @property
+    def tail_history_days(self):
+        return self.get_property('tail_history_days')
+
+    @property
+    def tail_rate_alpha(self):
+        return self.get_property('tail_rate_alpha')
+
+    @property
+    def fetch_engine(self):
+        return self.get_property('fetch_engine')
+
+    @property
+    def fetch_concurrency(self):
+        return self.get_property('fetch_concurrency')
+
+    @property
+    def fetch_batch_size(self):
+        return self.get_property('fetch_batch_size')
+
+    @property
+    def fetch_timeout(self):
+        return self.get_property('fetch_timeout')
+
+    @property
+    def fetch_base_url(self):
+        return self.get_property('fetch_base_url')
+
+    @property
+    def fetch_streaming(self):
+        return self.get_property('fetch_streaming')
+
+    @property
+    def fetch_checkpoint_max_age(self):
+        return self.get_property('fetch_checkpoint_max_age')
+
+    @property
+    def worker_start_method(self):
+        return self.get_property('worker_start_method')
+
     @property
     def session_id(self):
         return self.get_property('session_id')
@@ -115,6 +274,70 @@ class SystemCfg(_Config):
     def logging_level(self):
         return self.get_property('logging_level')
 
+    @property
+    def mongo_uri(self):
+        return self.get_property('mongo_uri')
+
+    @property
+    def mongo_max_pool_size(self):
+        return self.get_property('mongo_max_pool_size')
+
+    @property
+    def mongo_min_pool_size(self):
+        return self.get_property('mongo_min_pool_size')
+
+    @property
+    def mongo_connect_timeout_ms(self):
+        return self.get_property('mongo_connect_timeout_ms')
+
+    @property
+    def mongo_socket_timeout_ms(self):
+        return self.get_property('mongo_socket_timeout_ms')
+
+    @property
+    def mongo_server_selection_timeout_ms(self):
+        return self.get_property('mongo_server_selection_timeout_ms')
+
+    @property
+    def mongo_bulk_batch_size(self):
+        return self.get_property('mongo_bulk_batch_size')
+
+    @property
+    def log_buffer_size(self):
+        return self.get_property('log_buffer_size')
+
+    @property
+    def log_flush_size(self):
+        return self.get_property('log_flush_size')
+
+    @property
+    def log_flush_interval(self):
+        return self.get_property('log_flush_interval')
+
+    @property
+    def log_put_timeout(self):
+        return self.get_property('log_put_timeout')
+
+    @property
+    def profile_stats_bucket_size(self):
+        return self.get_property('profile_stats_bucket_size')
+
+    @property
+    def metrics_port(self):
+        return self.get_property('metrics_port')
+
+    @property
+    def profiling(self):
+        return self.get_property('profiling')
+
+    @property
+    def profiling_dir(self):
+        return self.get_property('profiling_dir')
+
+    @property
+    def profiling_interval(self):
+        return self.get_property('profiling_interval')
+
 
 if __name__ == '__main__':
     s_cfg = Scraping_cfg()
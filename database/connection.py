@@ -0,0 +1,86 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/24
+# src - connection.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import os
+import threading
+
+from pymongo import MongoClient
+
+from database.config_facade import SystemCfg
+
+"""
+Data-access layer that holds one pooled MongoClient per process.
+All query modules get their collections from here iso creating a new MongoClient for every query.
+
+MongoClient is thread-safe but not fork-safe. A client created before a fork (ex. by the parent of a mp.Pool) can't be used
+in the child. The client is therefore tagged with the pid of the process that created it and rebuilt when a process
+detects it inherited a client from its parent.
+
+IMPLEMENTED FUNCTIONS
+---------------------
+- get_client()
+- get_database(database=None)
+- get_collection(collection_name, database=None)
+- close_client()
+"""
+system_cfg = SystemCfg()
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def _create_client():
+    kwargs = {'maxPoolSize': system_cfg.mongo_max_pool_size,
+              'minPoolSize': system_cfg.mongo_min_pool_size,
+              'connectTimeoutMS': system_cfg.mongo_connect_timeout_ms,
+              'socketTimeoutMS': system_cfg.mongo_socket_timeout_ms,
+              'serverSelectionTimeoutMS': system_cfg.mongo_server_selection_timeout_ms,
+              'connect': False}  # Connect lazily on the first operation
+    return MongoClient(system_cfg.mongo_uri, **kwargs)
+
+
+def get_client():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                # Don't close an inherited client. Its sockets belong to the parent process.
+                _client = _create_client()
+                _client_pid = pid
+    return _client
+
+
+def get_database(database=None):
+    client = get_client()
+    return client[database or system_cfg.database]
+
+
+def get_collection(collection_name, database=None):
+    db = get_database(database)
+    return db[collection_name]
+
+
+def close_client():
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client, _client_pid = None, None
+
+
+def _reset_after_fork():
+    # Forget the parent's client and lock in the child. get_client() builds a new one on first use.
+    global _client, _client_pid, _lock
+    _client, _client_pid = None, None
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+if __name__ == '__main__':
+    print(get_client().server_info()['version'])
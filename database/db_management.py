@@ -25,27 +25,28 @@ IMPLEMENTED QUERIES AND FUNCTIONS
 - q_add_field(collection_name, field_name, value)
 - q_remove_field(collection_name, field_name)
 - q_rename_field(collection_name, old_field_name, new_field_name)
+- q_setup_indexes(collection_name, indexes, drop_unknown)
+- q_bulk_write(collection, operations, retry_duplicates)
 
 # - q_copy_field
 """
 
-from pymongo import MongoClient
-
 # from config import DATABASE
+from pymongo.errors import BulkWriteError
+
 from database.config_facade import Scraping_cfg, SystemCfg
+from database.connection import get_collection as get_db_collection
 from tools.logger import logger
 
 system_cfg = SystemCfg()
 database = system_cfg.database
+DUPLICATE_KEY_ERROR = 11000
 
 
 # Todo: Refactor: put everything in a class. DbManagement.copy_collection().xxx
 
-def get_collection(collection_name):  # Todo: same function in many modules. Put in tools?
-    client = MongoClient()
-    db = client[database]
-    collection = db[collection_name]
-    return collection
+def get_collection(collection_name):
+    return get_db_collection(collection_name)
 
 
 def q_remove_field(collection_name, field_name):
@@ -72,6 +73,60 @@ def q_add_field(collection_name, field_name, value=None):
     logger.info(f'Result adding field {field_name} to value {value}: {result.raw_result}')
 
 
+def _index_name(keys):
+    return '_'.join(f'{k}_{d}' for k, d in keys)
+
+
+def _normalize_keys(keys):
+    return [(k, int(d) if isinstance(d, (int, float)) else d) for k, d in keys]
+
+
+_index_options = ['unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds']
+
+
+def _same_options(index_info, options):
+    return all(index_info.get(o, False) == options.get(o, False) for o in _index_options)
+
+
+def q_setup_indexes(collection_name, indexes, drop_unknown=False):
+    """
+    Creates or migrates the declared indexes of a collection. Running it again changes nothing.
+    An existing index with the same keys and options is kept, whatever its name. An existing index with the same name or keys but other options
+    is dropped and created again. With drop_unknown=True the indexes that are not declared (except _id_) are dropped.
+    indexes = [{'keys': [('tweet_id', ASCENDING)], 'unique': True}, ...]
+    Returns a dict with the names of the created, migrated, unchanged and dropped indexes.
+    """
+    collection = get_collection(collection_name)
+    existing = collection.index_information()
+    result = {'created': [], 'migrated': [], 'unchanged': [], 'dropped': []}
+    kept = {'_id_'}
+    for index in indexes:
+        keys = _normalize_keys(index['keys'])
+        options = {k: v for k, v in index.items() if k != 'keys'}
+        name = options.pop('name', None) or _index_name(keys)
+        same_keys = [n for n, info in existing.items() if _normalize_keys(info['key']) == keys]
+        unchanged = [n for n in same_keys if _same_options(existing[n], options)]
+        if unchanged:
+            kept.add(unchanged[0])
+            result['unchanged'].append(unchanged[0])
+            continue
+        conflicts = set(same_keys) | ({name} & set(existing))
+        for conflict in conflicts:
+            collection.drop_index(conflict)
+            logger.warning(f'Index {conflict} on {collection_name} dropped to migrate to {name}: {keys} {options}')
+        collection.create_index(keys, name=name, **options)
+        kept.add(name)
+        result['migrated' if conflicts else 'created'].append(name)
+        logger.info(f'Index {name} on {collection_name} created: {keys} {options}')
+    if drop_unknown:
+        for name in set(existing) - kept:
+            if name in collection.index_information():
+                collection.drop_index(name)
+                result['dropped'].append(name)
+                logger.warning(f'Undeclared index {name} on {collection_name} dropped')
+    return result
+
+
 # def q_copy_field(collection_name, from_field_name, to_field_name): # Todo:  f'${from_field_name}'}} doesn't work
 #     collection = get_collection(collection_name)
 #     f = {}
@@ -80,6 +135,33 @@ def q_add_field(collection_name, field_name, value=None):
 #     logger.info(f'Result copy field {from_field_name} to {to_field_name}: {result.raw_result}')
 
 
+def q_bulk_write(collection, operations, retry_duplicates=True):
+    """
+    Writes the operations with one unordered bulk_write and returns its bulk_api_result. Write errors other than a duplicate key and
+    write concern errors are logged and raised.
+    Two processes that upsert the same new document at the same time make one of them fail on the unique index. With
+    retry_duplicates=True those operations are retried once, the retry finds the document and updates it, its counts are added to the
+    result and their indexes to result['retried']. With retry_duplicates=False the duplicates stay in result['writeErrors'] (ex. inserts of documents that already exist).
+    """
+    try:
+        return collection.bulk_write(operations, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        r = e.details
+        errors = [error for error in r['writeErrors'] if error['code'] != DUPLICATE_KEY_ERROR] + r.get('writeConcernErrors', [])
+        if errors:
+            logger.error(f'Bulk write error on {collection.name}: {errors[0]}')
+            raise
+    if not retry_duplicates or not r['writeErrors']: return r
+    indexes = [error['index'] for error in r['writeErrors']]
+    retry = collection.bulk_write([operations[i] for i in indexes], ordered=False).bulk_api_result
+    for key in ('nInserted', 'nUpserted', 'nMatched', 'nModified'):
+        r[key] += retry[key]
+    r['upserted'] += [{**upserted, 'index': indexes[upserted['index']]} for upserted in retry['upserted']]
+    r['writeErrors'] = []
+    r['retried'] = indexes
+    return r
+
+
 if __name__ == '__main__':
     pass
     # q_remove_field('profiles', 'scrape_ok')
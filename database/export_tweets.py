@@ -0,0 +1,220 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/28
+# src - export_tweets.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import argparse
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from database.twitter_facade import tweets_columns
+from database.tweet_queries import q_get_tweets_inserted_since
+from tools.logger import logger
+
+"""
+Streams the tweets collection to Parquet files for analysis, partitioned by username and month:
+
+    <directory>/<username>/<yyyy-mm>/part-<run_id>-<n>.parquet
+
+The columns are in the order of tweets_columns. Read them with pd.read_parquet(directory) or pd.read_parquet(f'{directory}/{username}').
+The cursor is read in batches of 'batch_size' tweets and every batch is appended to the open file of its partitions, so the memory
+is bounded by the batch size and 'max_open_files', whatever the size of the collection.
+
+The export follows the 'inserted_at' stamp of the tweets (see tweet_queries): the newest exported inserted_at is kept in
+<directory>/_export_state.json, with the tweet_ids inserted at that same millisecond. A rerun only appends the tweets inserted since,
+whatever their tweet_id or date: the history of a new user, a backfill of missing dates and a rescrape of failed periods are exported too.
+Tweets that changed after their export (likes, replies, ...) are only refreshed with full=True, which rewrites the export.
+The files of an interrupted run are removed at the next run, since the high-water mark wasn't saved for them.
+The stamps come from the clocks of the scraping hosts, a host whose clock runs behind can stamp tweets before the high-water mark.
+
+An export state of before the stamps holds the highest exported tweet_id. Its first rerun exports the unstamped tweets after that
+tweet_id and all stamped tweets.
+
+Usage:
+    python -m database.export_tweets --dir /path/to/export [--full]
+
+IMPLEMENTED FUNCTIONS
+---------------------
+- export_tweets(directory, full, batch_size, max_open_files)
+"""
+_state_file = '_export_state.json'
+_default_batch_size = 50000
+_default_max_open_files = 256
+
+_string_columns = ['tweet_id', 'conversation_id', 'user_id', 'username', 'name', 'date', 'time', 'timezone', 'hour',
+                   'tweet', 'quote_url', 'link', 'search', 'source', 'near', 'geo', 'place',
+                   'user_rt_id', 'user_rt', 'retweet_id', 'retweet_date', 'translate', 'trans_src', 'trans_dest']
+_column_types = {**{column: pa.string() for column in _string_columns},
+                 'created_at': pa.int64(),
+                 'datetime': pa.timestamp('ms'),
+                 'day': pa.int64(),
+                 'hashtags': pa.list_(pa.string()),
+                 'cashtags': pa.list_(pa.string()),
+                 'reply_to': pa.list_(pa.struct([('user_id', pa.string()), ('username', pa.string())])),
+                 'is_reply': pa.bool_(),
+                 'retweet': pa.bool_(),
+                 'nlikes': pa.int64(),
+                 'nreplies': pa.int64(),
+                 'nretweets': pa.int64()}
+tweets_schema = pa.schema([(column, _column_types[column]) for column in tweets_columns])
+
+
+def _read_state(directory):
+    path = os.path.join(directory, _state_file)
+    if not os.path.exists(path): return {'inserted_at': None, 'tweet_ids_at_mark': [], 'runs': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_state(directory, state):
+    path = os.path.join(directory, _state_file)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def _part_files(directory):
+    # [(run_id, path)] of all exported files
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if file.startswith('part-') and file.endswith('.parquet'):
+                yield file.split('-')[1], os.path.join(root, file)
+
+
+def _remove_part_files(directory, keep_runs):
+    n = 0
+    for run_id, path in list(_part_files(directory)):
+        if run_id not in keep_runs:
+            os.remove(path)
+            n += 1
+    return n
+
+
+def _column_array(values, column):
+    type = _column_types[column]
+    try:
+        return pa.array(values, type=type, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if type != pa.string(): raise
+        # Mixed types in older documents, e.g. a dict in 'place'
+        return pa.array([None if value is None else str(value) for value in values], type=type)
+
+
+def _to_table(tweets):
+    return pa.Table.from_arrays([_column_array([tweet.get(column) for tweet in tweets], column) for column in tweets_columns],
+                                schema=tweets_schema)
+
+
+class _PartitionWriters:
+    """
+    Open ParquetWriters per (username, month), at most 'max_open_files'. The least recently used writer is closed when a new one is needed.
+    A partition that is written again after its writer was closed gets a new part file.
+    """
+
+    def __init__(self, directory, run_id, max_open_files):
+        self.directory = directory
+        self.run_id = run_id
+        self.max_open_files = max_open_files
+        self._writers = OrderedDict()
+        self._n_files = 0
+
+    def write(self, partition, table):
+        writer = self._writers.pop(partition, None)
+        if writer is None:
+            if len(self._writers) >= self.max_open_files:
+                _, lru_writer = self._writers.popitem(last=False)
+                lru_writer.close()
+            username, month = partition
+            path = os.path.join(self.directory, username, month, f'part-{self.run_id}-{self._n_files:06d}.parquet')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = pq.ParquetWriter(path, tweets_schema, compression='snappy')
+            self._n_files += 1
+        writer.write_table(table)
+        self._writers[partition] = writer
+
+    def close(self):
+        while self._writers:
+            _, writer = self._writers.popitem()
+            writer.close()
+        return self._n_files
+
+
+def _write_batch(tweets, writers):
+    partitions = {}
+    for tweet in tweets:
+        month = f"{tweet['datetime']:%Y-%m}" if tweet.get('datetime') else 'unknown'
+        partitions.setdefault((tweet['username'], month), []).append(tweet)
+    for partition, partition_tweets in partitions.items():
+        writers.write(partition, _to_table(partition_tweets))
+
+
+def export_tweets(directory, full=False, batch_size=_default_batch_size, max_open_files=_default_max_open_files):
+    """
+    Exports the tweets inserted since the high-water mark, or all tweets with full=True. Returns the nr of exported tweets.
+    """
+    os.makedirs(directory, exist_ok=True)
+    state = _read_state(directory)
+    n_removed = _remove_part_files(directory, state['runs'])
+    if n_removed: logger.warning(f'Removed {n_removed} files of an interrupted export')
+    run_start = datetime.now()
+    run_id = run_start.strftime('%Y%m%d%H%M%S%f')
+    inserted_at = None if full or not state.get('inserted_at') else datetime.fromisoformat(state['inserted_at'])
+    legacy_tweet_id = None if full or inserted_at else state.get('tweet_id')
+    exported_at_mark = set(state.get('tweet_ids_at_mark', [])) if inserted_at else set()
+    high_water_mark, ids_at_mark = inserted_at, set(exported_at_mark)
+    logger.info(f'Export tweets inserted since {inserted_at} (legacy tweet_id {legacy_tweet_id}) to {directory}, run {run_id}')
+
+    start_time = time.time()
+    n = 0
+    writers = _PartitionWriters(directory, run_id, max_open_files)
+    cursor = q_get_tweets_inserted_since(inserted_at, legacy_tweet_id, batch_size)
+    try:
+        batch = []
+        for tweet in cursor:
+            tweet_inserted_at = tweet.pop('inserted_at', None)
+            if tweet['tweet_id'] in exported_at_mark and tweet_inserted_at == inserted_at: continue  # Exported by the previous run
+            batch.append(tweet)
+            if tweet_inserted_at is not None:
+                if high_water_mark is None or tweet_inserted_at > high_water_mark:
+                    high_water_mark, ids_at_mark = tweet_inserted_at, {tweet['tweet_id']}
+                elif tweet_inserted_at == high_water_mark:
+                    ids_at_mark.add(tweet['tweet_id'])
+            if len(batch) >= batch_size:
+                _write_batch(batch, writers)
+                n += len(batch)
+                batch = []
+                logger.info(f'Exported {n} tweets, {n / (time.time() - start_time):.0f} tweets/sec')
+        if batch:
+            _write_batch(batch, writers)
+            n += len(batch)
+    finally:
+        cursor.close()
+        n_files = writers.close()
+
+    if high_water_mark is None:  # No stamped tweets. Mongodb keeps milliseconds, the tweets inserted after the start are all stamped.
+        high_water_mark = run_start.replace(microsecond=run_start.microsecond // 1000 * 1000)
+    # The run only counts once the state is saved. A full export replaces the files of the previous runs.
+    runs = [run_id] if full else state['runs'] + [run_id]
+    _write_state(directory, {'inserted_at': high_water_mark.isoformat(), 'tweet_ids_at_mark': sorted(ids_at_mark), 'runs': runs,
+                             'datetime': datetime.now().isoformat()})
+    if full: _remove_part_files(directory, runs)
+    logger.info(f'Exported total of {n} tweets in {n_files} files ({n / max(time.time() - start_time, 1e-6):.0f} tweets/sec), '
+                f'high-water mark {high_water_mark}')
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the tweets collection to Parquet files partitioned by username and month')
+    parser.add_argument('--dir', required=True, help='Directory of the export')
+    parser.add_argument('--full', action='store_true', help='Rewrite the export, refreshes the tweets that changed')
+    parser.add_argument('--batch-size', type=int, default=_default_batch_size)
+    parser.add_argument('--max-open-files', type=int, default=_default_max_open_files)
+    args = parser.parse_args()
+
+    export_tweets(args.dir, args.full, args.batch_size, args.max_open_files)
@@ -0,0 +1,130 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/26
+# src - index_management.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import argparse
+import sys
+from datetime import datetime
+
+from database import checkpoint_queries, journal_queries, log_queries, profile_queries, profile_stat_queries, proxy_queries, reply_edge_queries, term_count_queries, tweet_count_queries, tweet_queries
+from database.connection import get_database
+from tools.logger import logger
+
+"""
+Creates the declared indexes of all collections and verifies that the hot queries use them.
+
+The indexes are declared in the 'indexes' list of every query module. setup_indexes() creates or migrates them idempotently.
+check_query_plans() runs explain on every q_ query in 'query_plans' and reports the queries that fall back to a COLLSCAN.
+The explained filters, sorts and pipelines come from the builders the q_ queries use themselves (ex. journal_queries._period_filter),
+so a changed query is explained as it runs. A new hot query gets a builder and an entry in 'query_plans'.
+
+Usage:
+    python -m database.index_management              # create or migrate the indexes
+    python -m database.index_management --check      # + verify the query plans, exit code 1 on a COLLSCAN
+
+IMPLEMENTED FUNCTIONS
+---------------------
+- setup_indexes(drop_unknown)
+- check_query_plans()
+"""
+query_modules = [tweet_queries, profile_queries, proxy_queries, log_queries, reply_edge_queries, term_count_queries, tweet_count_queries,
+                 profile_stat_queries, checkpoint_queries, journal_queries]
+
+
+def _find(collection_name, f, s=None, limit=None):
+    command = {'find': collection_name, 'filter': f}
+    if s: command['sort'] = dict(s)
+    if limit: command['limit'] = limit
+    return collection_name, command
+
+
+def _aggregate(collection_name, pipeline):
+    return collection_name, {'aggregate': collection_name, 'pipeline': pipeline, 'cursor': {}}
+
+
+# (query, collection, explain command) built with the filter builders of the q_ queries and representative arguments
+day, next_day, next_month = datetime(2020, 1, 1), datetime(2020, 1, 11), datetime(2020, 2, 1)
+query_plans = [
+    ('q_get_nr_tweets_per_day', *_find(tweet_count_queries.collection_name, *tweet_count_queries._nr_tweets_per_day_query('x', day, next_month))),
+    ('q_inc_tweet_counts', *_find(tweet_count_queries.collection_name, tweet_count_queries._day_filter('x', day))),
+    ('q_get_nr_tweets_per_day (tweets)',
+     *_aggregate(tweet_queries.collection_name, tweet_queries._nr_tweets_per_day_pipeline('x', day, next_month))),
+    ('q_get_last_tweet_datetime', *_find(tweet_queries.collection_name, *tweet_queries._last_tweet_query('x'), limit=1)),
+    ('q_update_a_tweet', *_find(tweet_queries.collection_name, tweet_queries._tweet_filter('1'))),
+    ('q_get_tweets_after_id', *_find(tweet_queries.collection_name, tweet_queries._after_id_filter('1234567890123456'))),
+    ('q_get_tweets_inserted_since', *_find(tweet_queries.collection_name, tweet_queries._inserted_since_filter(day, None))),
+    ('q_inc_reply_edges', *_find(reply_edge_queries.collection_name, reply_edge_queries._edge_filter('x', 'y'))),
+    ('q_get_reply_edges', *_find(reply_edge_queries.collection_name, reply_edge_queries._reply_edges_filter(['x', 'y']))),
+    ('q_inc_term_counts', *_find(term_count_queries.collection_name, term_count_queries._day_filter('x', day))),
+    ('q_get_top_terms', *_aggregate(term_count_queries.collection_name, term_count_queries._top_terms_pipeline(['x', 'y'], day, next_month, 100, None))),
+    ('q_get_a_profile', *_find(profile_queries.collection_name, profile_queries._username_filter('x'))),
+    ('q_save_a_profile', *_find(profile_queries.collection_name, profile_queries._user_id_filter('1'))),
+    ('q_set_profile_scrape_flag', *_find(profile_queries.collection_name, profile_queries._username_filter('x'))),
+    ('q_get_profile_stats', *_find(profile_stat_queries.collection_name, *profile_stat_queries._profile_stats_query('1', day, next_month))),
+    ('q_get_proxies(max_delay)', *_find(proxy_queries.collection_name, proxy_queries._proxies_filter(max_delay=30))),
+    ('q_update_proxy_stats', *_find(proxy_queries.collection_name, proxy_queries._proxy_filter('1.1.1.1', '80'))),
+    ('q_get_max_sesion_id', *_find(log_queries.collection_name, *log_queries._max_session_id_query(), limit=1)),
+    ('q_get_failed_periods_logs', *_find(log_queries.collection_name, *log_queries._failed_periods_query(1))),
+    ('q_get_checkpoint', *_find(checkpoint_queries.collection_name, checkpoint_queries._period_filter('x', day, next_day))),
+    ('q_set_journal_status', *_find(journal_queries.collection_name, journal_queries._period_filter(1, 'x', day, next_day))),
+    ('q_get_journal', *_find(journal_queries.collection_name, *journal_queries._journal_query(1, ['pending', 'claimed', 'failed']))),
+]
+
+def setup_indexes(drop_unknown=False):
+    results = {}
+    for module in query_modules:
+        results[module.collection_name] = module.setup_collection(drop_unknown=drop_unknown)
+        logger.info(f'Indexes {module.collection_name}: {results[module.collection_name]}')
+    return results
+
+
+def _winning_plans(explain):
+    # The winningPlan(s) can be nested in the stages of an aggregation or a sharded explain
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                yield value
+            else:
+                yield from _winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from _winning_plans(value)
+
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan: yield plan['stage']
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+def check_query_plans():
+    """
+    Explains every query in 'query_plans'. Returns a dict {query: [stages]} with the queries that use a COLLSCAN.
+    """
+    db = get_database()
+    collscans = {}
+    for query, collection_name, command in query_plans:
+        explain = db.command('explain', command, verbosity='queryPlanner')
+        stages = [stage for plan in _winning_plans(explain) for stage in _stages(plan)]
+        if 'COLLSCAN' in stages:
+            collscans[query] = stages
+            logger.error(f'{query} on {collection_name} uses a COLLSCAN: {stages}')
+        else:
+            logger.info(f'{query} on {collection_name}: {stages}')
+    return collscans
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create or migrate the indexes and verify the query plans')
+    parser.add_argument('--check', action='store_true', help='Verify that no q_ query falls back to a COLLSCAN')
+    parser.add_argument('--drop-unknown', action='store_true', help='Drop the indexes that are not declared')
+    args = parser.parse_args()
+
+    setup_indexes(drop_unknown=args.drop_unknown)
+    if args.check and check_query_plans():
+        sys.exit(1)
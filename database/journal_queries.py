@@ -0,0 +1,108 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/31
+# src - journal_queries.py
+# md
+# --------------------------------------------------------------------------------------------------------
+from datetime import datetime
+
+from pymongo import ASCENDING, UpdateOne
+
+from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes
+
+"""
+Group of queries to store and retrief the journal of the scraping sessions: one document per scheduled period of a session
+{'session_id': n, 'username': u, 'begin_date': datetime, 'end_date': datetime, 'first_period': bool, 'status': s, 'timestamp': datetime}.
+The status goes from 'pending' (planned) to 'claimed' (a worker scrapes it, + 'pid') to 'done' (+ the save_tweets result) or 'failed'.
+A period is claimed only when it isn't 'done', a 'done' period never goes back.
+The queries start with 'q_'
+Queries accept and return a dict or a lists of dicts when suitable
+
+Convention:
+-----------
+- documnet:     d
+- query:        q
+- projection:   p
+- sort:         s
+- filter:       f
+- update:       u
+- pipeline      pl
+- match         m
+- group:        g
+
+IMPLEMENTED QUERIES
+-------------------
+- q_save_journal(session_id, periods)
+- q_set_journal_status(session_id, username, begin_date, end_date, status, from_statuses, **kwargs)
+- q_get_journal(session_id, statuses)
+- q_count_journal(session_id)
+"""
+system_cfg = SystemCfg()
+database = system_cfg.database
+collection_name = 'session_journal'
+indexes = [{'keys': [('session_id', ASCENDING), ('username', ASCENDING), ('begin_date', ASCENDING), ('end_date', ASCENDING)],
+            'unique': True}]  # all queries
+
+
+def get_collection():
+    return get_db_collection(collection_name)
+
+
+def setup_collection(drop_unknown=False):
+    return q_setup_indexes(collection_name, indexes, drop_unknown)
+
+
+def _period_filter(session_id, username, begin_date, end_date):
+    return {'session_id': session_id, 'username': username, 'begin_date': begin_date, 'end_date': end_date}
+
+
+def q_save_journal(session_id, periods):
+    """
+    Adds the periods [{'username': u, 'begin_date': datetime, 'end_date': datetime, 'first_period': bool}, ...] of a session as 'pending'
+    with one unordered bulk_write. Periods that are already in the journal keep their status.
+    """
+    if not periods: return {'upserted': 0}
+    collection = get_collection()
+    now = datetime.now()
+    operations = [UpdateOne(_period_filter(session_id, period['username'], period['begin_date'], period['end_date']),
+                            {'$setOnInsert': {'first_period': period['first_period'], 'status': 'pending', 'timestamp': now}}, upsert=True)
+                  for period in periods]
+    r = collection.bulk_write(operations, ordered=False).bulk_api_result
+    return {'upserted': r['nUpserted']}
+
+
+def q_set_journal_status(session_id, username, begin_date, end_date, status, from_statuses=None, **kwargs):
+    # Sets the status of the period when its status is one of from_statuses (any status when None). Returns True when it was set.
+    collection = get_collection()
+    f = _period_filter(session_id, username, begin_date, end_date)
+    if from_statuses: f['status'] = {'$in': list(from_statuses)}
+    u = {'$set': {'status': status, 'timestamp': datetime.now(), **kwargs}}
+    return collection.update_one(f, u).modified_count == 1
+
+
+def _journal_query(session_id, statuses):
+    f = {'session_id': session_id}
+    if statuses: f['status'] = {'$in': list(statuses)}
+    s = [('username', ASCENDING), ('begin_date', ASCENDING)]
+    return f, s
+
+
+def q_get_journal(session_id, statuses=None):
+    # The periods of the session, with one of the statuses when given, sorted on username and begin_date
+    collection = get_collection()
+    f, s = _journal_query(session_id, statuses)
+    p = {'_id': 0}
+    return list(collection.find(f, p).sort(s))
+
+
+def q_count_journal(session_id):
+    # {status: nr of periods} of the session
+    collection = get_collection()
+    m = {'$match': {'session_id': session_id}}
+    g = {'$group': {'_id': '$status', 'n': {'$sum': 1}}}
+    return {d['_id']: d['n'] for d in collection.aggregate([m, g])}
+
+
+if __name__ == '__main__':
+    setup_collection()
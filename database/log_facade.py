@@ -3,9 +3,13 @@
 # src - log_facade.py
 # md
 # --------------------------------------------------------------------------------------------------------
-from datetime import datetime
+from datetime import datetime, timedelta
+from database.checkpoint_queries import q_save_checkpoint, q_get_checkpoint, q_delete_checkpoint
 from database.config_facade import SystemCfg, Scraping_cfg
+from database.journal_queries import q_save_journal, q_set_journal_status, q_get_journal, q_count_journal
 from database.log_queries import q_save_log, q_get_max_sesion_id, q_get_failed_periods_logs
+from database.log_sink import LogSink
+from tools import profiling
 import pandas as pd
 
 """
@@ -15,10 +19,60 @@ Functions accept and return dataframes when suitable
 
 IMPLEMENTED FUNCTIONS
 ---------------------
-
+- log_scraping_profile(session_id, flag, category, username, **kwargs)
+- log_scraping_tweets(session_id, flag, category, username, begin_date, end_date, **kwargs)
+- start_log_sink()
+- stop_log_sink()
+- get_log_sink()
+- use_log_sink(log_sink)
+- get_failed_periods(session_id)
+- get_max_sesion_id()
+- get_scrape_checkpoint(username, begin_date, end_date)
+- save_scrape_checkpoint(username, begin_date, end_date, position, n_tweets)
+- delete_scrape_checkpoint(username, begin_date, end_date)
+- save_session_journal(session_id, scheduled_periods)
+- set_period_status(session_id, username, begin_date, end_date, status, **kwargs)
+- get_unfinished_periods(session_id)
+- get_journal_counts(session_id)
 """
 system_cfg = SystemCfg()
 scraping_cfg = Scraping_cfg()
+_log_sink = None  # When started, the logs are buffered and saved in bulk
+
+
+def start_log_sink():
+    # Start before creating the mp.Pool, so the workers inherit the sink
+    global _log_sink
+    if _log_sink is None:
+        _log_sink = LogSink().start()
+    return _log_sink
+
+
+def stop_log_sink():
+    # Flushes the buffered logs and returns the stats of the sink
+    global _log_sink
+    if _log_sink is None: return None
+    _log_sink.close()
+    stats, _log_sink = _log_sink.stats, None
+    return stats
+
+
+def get_log_sink():
+    return _log_sink
+
+
+def use_log_sink(log_sink):
+    # In a worker that didn't inherit the sink of the session
+    global _log_sink
+    _log_sink = log_sink
+
+
+def _save_log(log):
+    with profiling.stage('log'):
+        if _log_sink is not None:
+            _log_sink.put(log)
+        else:
+            q_save_log(log)
 
 
 def log_scraping_profile(session_id, flag, category, username, **kwargs):
@@ -29,7 +83,7 @@ def log_scraping_profile(session_id, flag, category, username, **kwargs):
            'flag': flag,
            'timestamp': datetime.now()}
     log.update(kwargs)
-    q_save_log(log)
+    _save_log(log)
 
 
 def log_scraping_tweets(session_id, flag, category, username, begin_date, end_date, **kwargs):
@@ -42,15 +96,16 @@ def log_scraping_tweets(session_id, flag, category, username, begin_date, end_da
            'flag': flag,
            'timestamp': datetime.now()}
     log.update(kwargs)
-    q_save_log(log)
+    _save_log(log)
 
 
 def get_failed_periods(session_id):
+    # The failed periods of the session [username, begin_date, end_date], end_date is the until of the search, excluded
     failed_periods_logs = q_get_failed_periods_logs(session_id)
     if failed_periods_logs:
         usernames_df = pd.DataFrame(failed_periods_logs)
-        usernames_df['end_date'] = usernames_df['end_date'].dt.date
-        usernames_df['begin_date'] = usernames_df['begin_date'].dt.date
+        usernames_df['begin_date'] = usernames_df.pop('session_begin_date').dt.date
+        usernames_df['end_date'] = usernames_df.pop('session_end_date').dt.date
         return usernames_df
     else:
         return pd.DataFrame()
@@ -58,3 +113,57 @@ def get_failed_periods(session_id):
 
 def get_max_sesion_id():
     return q_get_max_sesion_id()
+
+
+def _as_datetime(date):
+    return datetime.combine(date, datetime.min.time())
+
+
+def get_scrape_checkpoint(username, begin_date, end_date):
+    # The checkpoint of the period, None when there's none or when it's older than 'fetch_checkpoint_max_age' (the cursor may have expired).
+    # An expired checkpoint is deleted, the search starts from the first page and its pages mustn't add up to the old counts.
+    checkpoint = q_get_checkpoint(username, _as_datetime(begin_date), _as_datetime(end_date))
+    if checkpoint and checkpoint['timestamp'] < datetime.now() - timedelta(seconds=scraping_cfg.fetch_checkpoint_max_age):
+        q_delete_checkpoint(username, _as_datetime(begin_date), _as_datetime(end_date))
+        return None
+    return checkpoint
+
+
+def save_scrape_checkpoint(username, begin_date, end_date, position, n_tweets):
+    q_save_checkpoint(username, _as_datetime(begin_date), _as_datetime(end_date), position, n_tweets)
+
+
+def delete_scrape_checkpoint(username, begin_date, end_date):
+    q_delete_checkpoint(username, _as_datetime(begin_date), _as_datetime(end_date))
+
+
+def save_session_journal(session_id, scheduled_periods):
+    # Journals the scheduled periods [(username, begin_date, end_date, first_period), ...] of a session as 'pending'
+    periods = [{'username': username, 'begin_date': _as_datetime(begin_date), 'end_date': _as_datetime(end_date), 'first_period': first_period}
+               for username, begin_date, end_date, first_period in scheduled_periods]
+    return q_save_journal(session_id, periods)
+
+
+def set_period_status(session_id, username, begin_date, end_date, status, **kwargs):
+    """
+    status: 'claimed', 'done' or 'failed'. Returns True when the status was set.
+    A period that is 'done' is never claimed or failed again, so a worker scrapes it only when the claim returns True.
+    """
+    from_statuses = None if status == 'done' else ['pending', 'claimed', 'failed']
+    return q_set_journal_status(session_id, username, _as_datetime(begin_date), _as_datetime(end_date), status, from_statuses, **kwargs)
+
+
+def get_unfinished_periods(session_id):
+    # The periods of the session that aren't 'done', sorted on username and begin_date
+    periods = q_get_journal(session_id, statuses=['pending', 'claimed', 'failed'])
+    if periods:
+        periods_df = pd.DataFrame(periods)
+        periods_df['begin_date'] = periods_df['begin_date'].dt.date
+        periods_df['end_date'] = periods_df['end_date'].dt.date
+        return periods_df
+    else:
+        return pd.DataFrame()
+
+
+def get_journal_counts(session_id):
+    return q_count_journal(session_id)
@@ -25,29 +25,30 @@ Convention:
 IMPLEMENTED QUERIES
 -------------------
 - q_save_log(log)
+- q_save_logs(logs)
 -
 """
 from pprint import pprint
 
-from pymongo import MongoClient, DESCENDING
+from pymongo import ASCENDING, DESCENDING
 
 from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes
 
 system_cfg = SystemCfg()
 database = system_cfg.database
 collection_name = 'logs'
+indexes = [{'keys': [('session_id', DESCENDING), ('username', ASCENDING)]},  # q_get_max_sesion_id
+           {'keys': [('session_id', ASCENDING), ('task', ASCENDING), ('category', ASCENDING), ('flag', ASCENDING), ('username', ASCENDING)]}]  # q_get_failed_periods_logs
 
 
-def get_collection():  # Todo: same function in many modules. Put in tools?
-    client = MongoClient()
-    db = client[database]
-    collection = db[collection_name]
-    return collection
+def get_collection():
+    return get_db_collection(collection_name)
 
 
-def setup_collection():
-    collection = get_collection()
-    # collection.create_index([('ip', DESCENDING), ('port', DESCENDING)], unique=True)
+def setup_collection(drop_unknown=False):
+    return q_setup_indexes(collection_name, indexes, drop_unknown)
 
 
 def q_save_log(log):
@@ -55,9 +56,29 @@ def q_save_log(log):
     collection.insert_one(log)
 
 
+def q_save_logs(logs):
+    # ordered=True keeps the logs in the order they were buffered
+    collection = get_collection()
+    if logs: collection.insert_many(logs, ordered=True)
+
+
+def _max_session_id_query():
+    return {}, [('session_id', -1), ('username', 1)]
+
+
+def _failed_periods_query(session_id):
+    f = {'session_id': session_id,
+         'task': 'tweets',
+         'category': 'period',
+         'flag': 'fail'}
+    s = [('username', 1), ('session_begin_date', 1)]
+    return f, s
+
+
 def q_get_max_sesion_id():
     collection = get_collection()
-    cursor = collection.find({},{'_id':0,'session_id':1}).sort([('session_id', -1),('username',1)]).limit(1)
+    f, s = _max_session_id_query()
+    cursor = collection.find(f,{'_id':0,'session_id':1}).sort(s).limit(1)
     doc=list(cursor)
     max_session_id=doc[0]['session_id'] if doc else -1
     return max_session_id
@@ -65,15 +86,12 @@ def q_get_max_sesion_id():
 
 def q_get_failed_periods_logs(session_id):
     collection = get_collection()
-    f = {'session_id': session_id,
-         'task': 'tweets',
-         'category': 'period',
-         'flag': 'fail'}
+    f, s = _failed_periods_query(session_id)
     p = {'_id': 0,
          'username': 1,
-         'begin_date': 1,
-         'end_date': 1         }
-    cursor = collection.find(f, p).sort([('username', 1), ('start_period', 1)])
+         'session_begin_date': 1,
+         'session_end_date': 1}
+    cursor = collection.find(f, p).sort(s)
     return list(cursor)
 
 
@@ -0,0 +1,110 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/27
+# src - log_sink.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import multiprocessing as mp
+import threading
+import time
+from queue import Empty, Full
+
+from database.config_facade import SystemCfg
+from database.log_queries import q_save_logs
+from tools import metrics
+from tools.logger import logger
+
+system_cfg = SystemCfg()
+
+
+class LogSink:
+    """
+    Buffered log writer that can be fed from many processes.
+
+    put() sends a log document to a bounded queue in a Manager process. A writer thread in the process that started the sink
+    collects the logs and saves them with insert_many when 'flush_size' logs are buffered or every 'flush_interval' seconds.
+    There is only one writer and the queue is FIFO, so the logs of a session are saved in the order they were put.
+
+    Backpressure: when the queue is full, put() waits up to 'put_timeout' seconds (delayed) and then drops the log (dropped).
+    The counts are kept in the producing process and sent along with its next log, so they don't cost an extra round trip.
+    close() flushes everything that is still buffered.
+    The sink must be started before the mp.Pool, so the forked workers inherit it, or be passed to the workers of a forkserver pool.
+    A pickled sink can only put(), it has no manager and no writer thread.
+    """
+    _stop = None  # Sentinel
+
+    def __init__(self, buffer_size=None, flush_size=None, flush_interval=None, put_timeout=None):
+        self.flush_size = flush_size or system_cfg.log_flush_size
+        self.flush_interval = flush_interval or system_cfg.log_flush_interval
+        self.put_timeout = put_timeout or system_cfg.log_put_timeout
+        self._manager = mp.Manager()
+        self._queue = self._manager.Queue(maxsize=buffer_size or system_cfg.log_buffer_size)
+        self._thread = None
+        # Counters of this process, reset when they are sent to the writer
+        self._n_dropped, self._n_delayed = 0, 0
+        # Totals, only kept by the writer thread
+        self.stats = {'written': 0, 'dropped': 0, 'delayed': 0, 'flushes': 0}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_manager'], state['_thread'] = None, None
+        return state
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write, name='log_sink', daemon=True)
+        self._thread.start()
+        return self
+
+    def put(self, log):
+        try:
+            self._queue.put_nowait((log, self._n_dropped, self._n_delayed))
+        except Full:
+            try:
+                self._queue.put((log, self._n_dropped, self._n_delayed + 1), timeout=self.put_timeout)
+            except Full:
+                self._n_dropped += 1
+                return False
+        self._n_dropped, self._n_delayed = 0, 0
+        return True
+
+    def close(self):
+        if self._thread is None: return
+        self._queue.put(self._stop)
+        self._thread.join()
+        self._thread = None
+        logger.info(f'Log sink closed: {self.stats}')
+        self._manager.shutdown()
+
+    def _write(self):
+        buffer = []
+        last_flush = time.time()
+        stop = False
+        while not stop:
+            timeout = max(self.flush_interval - (time.time() - last_flush), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+                if item is self._stop:
+                    stop = True
+                else:
+                    log, n_dropped, n_delayed = item
+                    buffer.append(log)
+                    self.stats['dropped'] += n_dropped
+                    self.stats['delayed'] += n_delayed
+            except Empty:
+                pass
+            if buffer and (stop or len(buffer) >= self.flush_size or time.time() - last_flush >= self.flush_interval):
+                self._flush(buffer)
+                buffer = []
+            if not buffer: last_flush = time.time()
+        # Report the drops of the process that closes the sink
+        self.stats['dropped'] += self._n_dropped
+        self.stats['delayed'] += self._n_delayed
+
+    def _flush(self, buffer):
+        try:
+            with metrics.timer('twitter_mongo_write_seconds', collection='logs'):
+                q_save_logs(buffer)
+            self.stats['written'] += len(buffer)
+        except Exception as e:
+            self.stats['dropped'] += len(buffer)
+            logger.error(f'Couldn\'t save {len(buffer)} logs: {e!r}')
+        self.stats['flushes'] += 1
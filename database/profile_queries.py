@@ -6,10 +6,13 @@
 import sys
 from datetime import datetime
 
-from pymongo import MongoClient
+from pymongo import ASCENDING
 from pymongo.errors import DuplicateKeyError
 
 from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes
+from database.profile_stat_queries import q_add_profile_stats, stat_fields
 from tools.logger import logger
 
 """
@@ -33,43 +36,61 @@ IMPLEMENTED QUERIES
 -------------------
 - q_get_a_profile(username)
 - q_get_profiles()
+- q_get_usernames()
 - q_save_a_profile(username)
 - q_set_profile_scrape_flag(username, flag)
+- q_set_profiles_scrape_flag(f, flag)
 
 """
 system_cfg = SystemCfg()
 database = system_cfg.database
 collection_name = 'profiles'
+indexes = [{'keys': [('username', ASCENDING)]},  # q_get_a_profile, q_get_profiles, q_set_profile_scrape_flag
+           {'keys': [('user_id', ASCENDING)]}]  # q_save_a_profile
 
 
 def get_collection():
-    client = MongoClient()
-    db = client[database]
-    collection = db[collection_name]
-    return collection
+    return get_db_collection(collection_name)
 
 
-def setup_collection():  # Todo: add indexes
-    pass
+def setup_collection(drop_unknown=False):
+    return q_setup_indexes(collection_name, indexes, drop_unknown)
+
+
+def _username_filter(username):
+    return {'username': username}
+
+
+def _user_id_filter(user_id):
+    return {'user_id': user_id}
 
 
 def q_get_a_profile(username):
     collection = get_collection()
-    q = {'username': username}
+    q = _username_filter(username)
     doc = collection.find_one(q)
     return doc
 
 
 def q_get_profiles():
+    # Without the stats arrays of the profiles that are not migrated to profile_stats yet
+    collection = get_collection()
+    p = {'timestamp': 0, **{field: 0 for field in stat_fields}}
+    cursor = collection.find({}, p).sort([('username', 1)])
+    return list(cursor)
+
+
+def q_get_usernames():
     collection = get_collection()
-    cursor = collection.find().sort([('username', 1)])
+    p = {'_id': 0, 'user_id': 1, 'username': 1}
+    cursor = collection.find({}, p).sort([('username', 1)])
     return list(cursor)
 
 
 def q_save_a_profile(profile):
     collection = get_collection()
     try:
-        f = {'user_id': profile['id']}
+        f = _user_id_filter(profile['id'])
         u = {'$set': {'username': profile['username'],
                       'name': profile['name'],
                       'bio': profile['bio'],
@@ -82,17 +103,20 @@ def q_save_a_profile(profile):
                       'verified': profile['verified'],
                       'background_image': profile['background_image'],
                       'avatar': profile['avatar'],
-                      'scrape_ok': 0},
-             '$push': {'timestamp': datetime.now(),
-                       'followers': int(profile['followers']),
-                       'following': int(profile['following']),
-                       'likes': int(profile['likes']),
-                       'tweets': int(profile['tweets']),
-                       'media': int(profile['media']), }}
+                      'scrape_ok': 0}}
+        # The profile keeps the current stats, the history goes to the profile_stats buckets
+        stats = {'timestamp': datetime.now(),
+                 'followers': int(profile['followers']),
+                 'following': int(profile['following']),
+                 'likes': int(profile['likes']),
+                 'tweets': int(profile['tweets']),
+                 'media': int(profile['media']), }
+        u['$set']['stats'] = stats
         try:
             collection.update_one(f, u, upsert=True)
         except DuplicateKeyError as e:
             raise
+        q_add_profile_stats(profile['id'], profile['username'], stats)
 
     except:
         logger.error(f'Unknown error: {sys.exc_info()[0]}')
@@ -101,11 +125,19 @@ def q_save_a_profile(profile):
 
 def q_set_profile_scrape_flag(username, flag):  # Todo: Refactor: prefer dict arguments here
     collection = get_collection()
-    f = {'username': username}
+    f = _username_filter(username)
     u = {'$set': {'scrape_flag': flag}}
     collection.update_one(f, u)
 
 
+def q_set_profiles_scrape_flag(f, flag):
+    # Sets the scrape_flag of all profiles that match the filter with one update_many
+    collection = get_collection()
+    u = {'$set': {'scrape_flag': flag}}
+    result = collection.update_many(f, u)
+    return {'matched': result.matched_count, 'modified': result.modified_count}
+
+
 if __name__ == '__main__':
     u = 'franckentheo'
     p = q_get_a_profile(u)
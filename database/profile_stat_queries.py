@@ -0,0 +1,136 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/29
+# src - profile_stat_queries.py
+# md
+# --------------------------------------------------------------------------------------------------------
+from datetime import datetime
+from itertools import zip_longest
+
+from pymongo import ASCENDING
+
+from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes
+from tools.logger import logger
+
+"""
+Group of queries to store and retrief data from the profile_stats collection, the time series of the profile statistics.
+The samples {'timestamp': datetime, 'followers': n, 'following': n, 'likes': n, 'tweets': n, 'media': n} of a user are stored in
+monthly buckets of at most 'profile_stats_bucket_size' samples:
+{'user_id': id, 'username': u, 'bucket_start': first day of the month, 'n': nr of samples, 'first': datetime, 'last': datetime, 'samples': [...]}
+A full bucket is followed by a new bucket of the same month. The profile document only keeps the last sample in 'stats'.
+The queries start with 'q_'
+Queries accept and return a dict or a lists of dicts when suitable
+
+Convention:
+-----------
+- documnet:     d
+- query:        q
+- projection:   p
+- sort:         s
+- filter:       f
+- update:       u
+- pipeline      pl
+- match         m
+- group:        g
+
+IMPLEMENTED QUERIES
+-------------------
+- q_add_profile_stats(user_id, username, sample)
+- q_get_profile_stats(user_id, begin_date, end_date)
+- q_migrate_profile_stats()
+"""
+system_cfg = SystemCfg()
+database = system_cfg.database
+collection_name = 'profile_stats'
+stat_fields = ['followers', 'following', 'likes', 'tweets', 'media']
+indexes = [{'keys': [('user_id', ASCENDING), ('bucket_start', ASCENDING)]}]  # q_add_profile_stats, q_get_profile_stats
+
+
+def get_collection():
+    return get_db_collection(collection_name)
+
+
+def setup_collection(drop_unknown=False):
+    return q_setup_indexes(collection_name, indexes, drop_unknown)
+
+
+def _bucket_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+def q_add_profile_stats(user_id, username, sample):
+    # Pushes the sample in the bucket of its month that isn't full, or creates a new bucket
+    collection = get_collection()
+    f = {'user_id': user_id, 'bucket_start': _bucket_start(sample['timestamp']), 'n': {'$lt': system_cfg.profile_stats_bucket_size}}
+    u = {'$push': {'samples': sample},
+         '$inc': {'n': 1},
+         '$set': {'username': username},
+         '$min': {'first': sample['timestamp']},
+         '$max': {'last': sample['timestamp']}}
+    collection.update_one(f, u, upsert=True)
+
+
+def _profile_stats_query(user_id, begin_date, end_date):
+    f = {'user_id': user_id, 'bucket_start': {'$gte': _bucket_start(begin_date), '$lte': end_date}}
+    s = [('bucket_start', ASCENDING)]
+    return f, s
+
+
+def q_get_profile_stats(user_id, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1)):
+    # The samples of the user between begin_date and end_date, both included, sorted on timestamp
+    collection = get_collection()
+    f, s = _profile_stats_query(user_id, begin_date, end_date)
+    p = {'_id': 0, 'samples': 1}
+    samples = [sample for bucket in collection.find(f, p, sort=s) for sample in bucket['samples']
+               if begin_date <= sample['timestamp'] <= end_date]
+    return sorted(samples, key=lambda sample: sample['timestamp'])
+
+
+def _buckets(user_id, username, samples, bucket_size):
+    buckets = []
+    for sample in sorted(samples, key=lambda sample: sample['timestamp']):
+        bucket_start = _bucket_start(sample['timestamp'])
+        if not buckets or buckets[-1]['bucket_start'] != bucket_start or buckets[-1]['n'] >= bucket_size:
+            buckets.append({'user_id': user_id, 'username': username, 'bucket_start': bucket_start, 'n': 0,
+                            'first': sample['timestamp'], 'last': sample['timestamp'], 'samples': [], 'migrated': True})
+        bucket = buckets[-1]
+        bucket['samples'].append(sample)
+        bucket['n'] += 1
+        bucket['last'] = sample['timestamp']
+    return buckets
+
+
+def q_migrate_profile_stats():
+    """
+    One time migration of the arrays 'timestamp', 'followers', ... in the profiles to buckets.
+    The profile keeps the last sample in 'stats' and the arrays are removed. The buckets of the migration are marked 'migrated',
+    an interrupted migration replaces them when it's run again. Returns the nr of migrated profiles.
+    """
+    profiles = get_db_collection('profiles')
+    collection = get_collection()
+    bucket_size = system_cfg.profile_stats_bucket_size
+    f = {'timestamp': {'$type': 'array'}}
+    p = {'user_id': 1, 'username': 1, 'stats': 1, 'timestamp': 1, **{field: 1 for field in stat_fields}}
+    n = 0
+    for profile in profiles.find(f, p, no_cursor_timeout=True):
+        columns = [profile['timestamp']] + [profile.get(field) or [] for field in stat_fields]
+        samples = [dict(zip(['timestamp'] + stat_fields, values)) for values in zip_longest(*columns) if values[0] is not None]
+        buckets = _buckets(profile['user_id'], profile['username'], samples, bucket_size)
+        collection.delete_many({'user_id': profile['user_id'], 'migrated': True})
+        if buckets: collection.insert_many(buckets)
+        u = {'$unset': {field: '' for field in ['timestamp'] + stat_fields}}
+        last_sample = buckets[-1]['samples'][-1] if buckets else None
+        stats_timestamp = (profile.get('stats') or {}).get('timestamp')
+        if last_sample and (stats_timestamp is None or stats_timestamp < last_sample['timestamp']):  # Don't overwrite a newer scrape
+            u['$set'] = {'stats': last_sample}
+        profiles.update_one({'_id': profile['_id']}, u)
+        n += 1
+        logger.info(f'Migrated {len(samples)} profile stats of {profile["username"]} in {len(buckets)} buckets')
+    logger.info(f'Migrated the stats of {n} profiles')
+    return n
+
+
+if __name__ == '__main__':
+    setup_collection()
+    q_migrate_profile_stats()
@@ -7,8 +7,10 @@ from datetime import datetime
 
 import pandas as pd
 
-from database.proxy_queries import q_save_a_proxy, q_get_proxies, q_update_a_proxy_test, \
-    q_reset_proxy_stats, q_update_proxy_stats  # , q_update_proxy_stats, q_reset_proxy_stats
+from database.proxy_queries import q_bulk_upsert_proxies, q_get_proxies, q_update_a_proxy_test, \
+    q_reset_proxies_stats, q_set_proxies, q_update_proxy_stats, q_bulk_update_proxy_tests, _proxies_filter
+from tools import profiling
+from tools.logger import logger
 from tools.utils import set_pandas_display_options
 
 set_pandas_display_options()
@@ -20,19 +22,17 @@ Functions accept and return dataframes when suitable
 IMPLEMENTED FUNCTIONS
 ---------------------
 - get_proxies(blacklisted=None, max_delay=None)
+- reset_proxies_scrape_success_flag(totals, blacklisted, max_delay)
 - save_a_proxy_test(proxy, delay)
-- save_proxies(tweets_df)
+- save_proxy_tests(proxy_tests)
+- save_proxies(proxies_df)
 - set_a_proxy_scrape_success_flag(proxy, flag)
-- set_proxies(delay, blacklisted, error_code)
+- set_proxies(delay, blacklisted, error_code, only_blacklisted, max_delay)
 """
 
 
 def get_proxies(blacklisted=None, max_delay=None):
-    q = {}
-    if blacklisted: q['blacklisted'] = blacklisted
-    if max_delay: q['$and'] = [{'delay': {'$gt': 0}},
-                               {'delay': {'$lte': max_delay}}]
-
+    q = _proxies_filter(blacklisted or None, max_delay)  # blacklisted=False doesn't filter
     proxies = q_get_proxies(q)
     proxies_df = pd.DataFrame(proxies)
     return proxies_df
@@ -43,31 +43,36 @@ def save_a_proxy_test(proxy_test):
     q_update_a_proxy_test(proxy_test)
 
 
+def save_proxy_tests(proxy_tests):
+    # proxy_tests = [{'ip': ip, 'port': port, 'delay': delay, 'blacklisted': blacklisted, 'error_code': error_code}, ...]
+    q_bulk_update_proxy_tests(proxy_tests)
+
+
 def save_proxies(proxies_df):
-    for _, row in proxies_df.iterrows():
-        proxy = row.to_dict()
-        q_save_a_proxy(proxy)
+    # Inserts the new proxies in one bulk upsert. Returns {'inserted': n, 'existing': n}
+    result = q_bulk_upsert_proxies(proxies_df.to_dict('records'))
+    logger.info(f'Saved {len(proxies_df)} proxies: {result}')
+    return result
 
 
-def set_proxies(delay=999999, blacklisted=False, error_code=-1): # Todo: Name is not clear and use update_many in the query iso loop
-    for proxy in q_get_proxies({}):
-        proxy_test = proxy
-        proxy_test['delay'] = delay
-        proxy_test['blacklisted'] = blacklisted
-        proxy_test['error_code'] = error_code
-        q_update_a_proxy_test(proxy_test)
+def set_proxies(delay=999999, blacklisted=False, error_code=-1, only_blacklisted=None, max_delay=None):  # Todo: Name is not clear
+    # Sets delay, blacklisted and error_code of all proxies, or of the proxies that match only_blacklisted and max_delay
+    # Returns {'matched': n, 'modified': n}
+    return q_set_proxies(_proxies_filter(only_blacklisted, max_delay), delay, blacklisted, error_code)
 
 def update_proxy_stats(flag, proxy):
-    q_update_proxy_stats(flag, proxy)
+    with profiling.stage('proxy_stats'):
+        q_update_proxy_stats(flag, proxy)
 
 
 
 
-def reset_proxies_scrape_success_flag(totals=False): # todo: Refactor: Use update_multi iso looping
-    for proxy in q_get_proxies({}):
-        print(proxy)
-        # proxy = {'ip': proxy['ip'], 'port': proxy['port']}
-        q_reset_proxy_stats(proxy, totals=totals)
+def reset_proxies_scrape_success_flag(totals=False, blacklisted=None, max_delay=None):
+    # Resets the scrape stats of all proxies, or of the proxies that match blacklisted and max_delay
+    # Returns {'matched': n, 'modified': n}
+    result = q_reset_proxies_stats(_proxies_filter(blacklisted, max_delay), totals=totals)
+    logger.info(f'Reset scrape stats of proxies: {result}')
+    return result
 
 
 if __name__ == '__main__':
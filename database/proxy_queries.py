@@ -6,10 +6,12 @@
 from datetime import datetime
 from pprint import pprint
 
-from pymongo import MongoClient, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateOne
 from pymongo.errors import DuplicateKeyError
 
 from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes, q_bulk_write
 from tools.logger import logger
 
 """
@@ -33,39 +35,53 @@ IMPLEMENTED QUERIES
 -------------------
 - q_get_proxies(q)
 - q_save_a_proxy(proxy)
+- q_bulk_upsert_proxies(proxies)
 - q_update_a_proxy_test(proxy_test)
+- q_bulk_update_proxy_tests(proxy_tests)
 - q_reset_proxy_stats(proxy)
+- q_reset_proxies_stats(f, totals)
+- q_set_proxies(f, delay, blacklisted, error_code)
 - q_update_proxy_stats(proxy, flag)
 """
 system_cfg = SystemCfg()
 database = system_cfg.database
 collection_name = 'proxies'
+indexes = [{'keys': [('ip', DESCENDING), ('port', DESCENDING)], 'unique': True},
+           {'keys': [('delay', ASCENDING)]}]  # q_get_proxies with max_delay
 
 
-def get_collection():  # Todo: same function in many modules. Put in tools?
-    client = MongoClient()
-    db = client[database]
-    collection = db[collection_name]
-    return collection
+def get_collection():
+    return get_db_collection(collection_name)
 
 
-def setup_collection():
-    collection = get_collection()
-    collection.create_index([('ip', DESCENDING), ('port', DESCENDING)], unique=True)
+def setup_collection(drop_unknown=False):
+    return q_setup_indexes(collection_name, indexes, drop_unknown)
+
+
+def _proxy_filter(ip, port):
+    return {'ip': ip, 'port': port}
+
+
+def _proxies_filter(blacklisted=None, max_delay=None):
+    # Filter on the blacklisted flag (True or False) and on a tested delay, None means no filter
+    f = {}
+    if blacklisted is not None: f['blacklisted'] = blacklisted
+    if max_delay: f['$and'] = [{'delay': {'$gt': 0}},
+                               {'delay': {'$lte': max_delay}}]
+    return f
 
 
 def q_get_proxies(q):  # Todo: remove q here ?
     collection = get_collection()
-    p = {'ip': 1, 'port': 1, 'delay': 1, 'blacklisted': 1, '_id': 0}
+    p = {'ip': 1, 'port': 1, 'delay': 1, 'blacklisted': 1, 'scrape_n_used': 1, 'scrape_n_failed': 1, 'flag_stats': 1, '_id': 0}
     cursor = collection.find(q, p)
     proxies = list(cursor)
 
     return proxies
 
 
-def q_save_a_proxy(proxy):
-    collection = get_collection()
-    d = proxy
+def _new_proxy(proxy):
+    d = dict(proxy)
     # New proxies have not been tested
     d['delay'] = 999999
     d['blacklisted'] = True
@@ -77,27 +93,58 @@ def q_save_a_proxy(proxy):
     d['scrape_n_failed'] = 0
     d['scrape_n_used_total'] = 0
     d['scrape_n_failed_total'] = 0
+    return d
+
+
+def q_save_a_proxy(proxy):
+    collection = get_collection()
+    d = _new_proxy(proxy)
     try:
         collection.insert_one(d)
     except DuplicateKeyError as e:
         logger.warning(f"Duplicate proxy: {proxy['ip']}:{proxy['port']}")
 
 
-def q_update_a_proxy_test(proxy_test):
+def q_bulk_upsert_proxies(proxies):
+    """
+    Inserts the new proxies of a list [{'ip': ip, 'port': port, 'source': s, 'datetime': datetime}, ...] with one unordered bulk_write
+    (q_bulk_write). The proxies that are already in the collection aren't changed.
+    Returns {'inserted': n, 'existing': n}
+    """
+    if not proxies: return {'inserted': 0, 'existing': 0}
     collection = get_collection()
-    f = {'ip': proxy_test['ip'],
-         'port': proxy_test['port']}
+    operations = [UpdateOne(_proxy_filter(proxy['ip'], proxy['port']), {'$setOnInsert': _new_proxy(proxy)}, upsert=True) for proxy in proxies]
+    r = q_bulk_write(collection, operations)
+    return {'inserted': r['nUpserted'], 'existing': len(proxies) - r['nUpserted']}
+
+
+def _proxy_test_update(proxy_test):
+    f = _proxy_filter(proxy_test['ip'], proxy_test['port'])
     u = {'$set': {'delay': proxy_test['delay'],
                   'blacklisted': proxy_test['blacklisted'],
                   'error_code': proxy_test['error_code']},
          '$inc': {'test_n_blacklisted': int(proxy_test['blacklisted']),
                   'test_n_tested': 1}}
+    return f, u
+
+
+def q_update_a_proxy_test(proxy_test):
+    collection = get_collection()
+    f, u = _proxy_test_update(proxy_test)
     collection.update_one(f, u, upsert=True)
 
 
+def q_bulk_update_proxy_tests(proxy_tests):
+    collection = get_collection()
+    if not proxy_tests: return None
+    operations = [UpdateOne(*_proxy_test_update(proxy_test), upsert=True) for proxy_test in proxy_tests]
+    result = collection.bulk_write(operations, ordered=False)
+    return result.bulk_api_result
+
+
 def q_update_proxy_stats(flag, proxy):
     collection = get_collection()
-    f = {'ip': proxy['ip'], 'port': proxy['port']}
+    f = _proxy_filter(proxy['ip'], proxy['port'])
     u = {'$set': {'last_flag': flag,
                   'last_update': datetime.now()}}
     if flag == 'ok':
@@ -113,19 +160,41 @@ def q_update_proxy_stats(flag, proxy):
     collection.update_one(f, u, upsert=True)
 
 
-def q_reset_proxy_stats(proxy, totals=False):
-    collection = get_collection()
-    f = {'ip': proxy['ip'], 'port': proxy['port']}
+def _reset_proxy_stats_update(totals):
     u = {'$set': {'last_flag': '',
                   'scrape_n_used': 0,
                   'scrape_n_failed': 0}}
     if totals: u['$set'].update({'scrape_n_used_total': 0,
                                  'scrape_n_failed_total': 0,
                                  'flag_stats': {}})
+    return u
 
+
+def q_reset_proxy_stats(proxy, totals=False):
+    collection = get_collection()
+    f = {'ip': proxy['ip'], 'port': proxy['port']}
+    u = _reset_proxy_stats_update(totals)
     collection.update_one(f, u, upsert=True)
 
 
+def q_reset_proxies_stats(f, totals=False):
+    # Resets the stats of all proxies that match the filter with one update_many
+    collection = get_collection()
+    u = _reset_proxy_stats_update(totals)
+    result = collection.update_many(f, u)
+    return {'matched': result.matched_count, 'modified': result.modified_count}
+
+
+def q_set_proxies(f, delay=999999, blacklisted=False, error_code=-1):
+    # Sets the test result of all proxies that match the filter with one update_many
+    collection = get_collection()
+    u = {'$set': {'delay': delay,
+                  'blacklisted': blacklisted,
+                  'error_code': error_code}}
+    result = collection.update_many(f, u)
+    return {'matched': result.matched_count, 'modified': result.modified_count}
+
+
 def q_temp():
     collection = get_collection()
     f = {'delay': 0}
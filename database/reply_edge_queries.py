@@ -0,0 +1,116 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/28
+# src - reply_edge_queries.py
+# md
+# --------------------------------------------------------------------------------------------------------
+from pymongo import ASCENDING, UpdateOne
+
+from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes, q_bulk_write
+from tools.logger import logger
+
+"""
+Group of queries to store and retrief data from the reply_edges collection.
+A reply edge is {'from_username': u, 'to_username': v, 'count': n, 'first_seen': datetime, 'last_seen': datetime}: u replied n times to v,
+first and last seen are the datetimes of the first and last reply tweet.
+The edges are updated with $inc when new tweets are saved, and can be rebuilt from the tweets collection.
+The queries start with 'q_'
+Queries accept and return a dict or a lists of dicts when suitable
+
+Convention:
+-----------
+- documnet:     d
+- query:        q
+- projection:   p
+- sort:         s
+- filter:       f
+- update:       u
+- pipeline      pl
+- match         m
+- group:        g
+
+IMPLEMENTED QUERIES
+-------------------
+- q_inc_reply_edges(edges)
+- q_get_reply_edges(usernames)
+- q_rebuild_reply_edges()
+"""
+system_cfg = SystemCfg()
+database = system_cfg.database
+collection_name = 'reply_edges'
+indexes = [{'keys': [('from_username', ASCENDING), ('to_username', ASCENDING)], 'unique': True},  # q_inc_reply_edges, q_get_reply_edges
+           {'keys': [('to_username', ASCENDING)]}]  # q_get_reply_edges
+
+
+def get_collection():
+    return get_db_collection(collection_name)
+
+
+def setup_collection(drop_unknown=False):
+    return q_setup_indexes(collection_name, indexes, drop_unknown)
+
+
+def _edge_filter(from_username, to_username):
+    return {'from_username': from_username, 'to_username': to_username}
+
+
+def _reply_edges_filter(usernames):
+    if usernames is None: return {}
+    return {'$or': [{'from_username': {'$in': usernames}}, {'to_username': {'$in': usernames}}]}
+
+
+def _inc_reply_edge(edge):
+    f = _edge_filter(edge['from_username'], edge['to_username'])
+    u = {'$inc': {'count': edge['count']},
+         '$min': {'first_seen': edge['first_seen']},
+         '$max': {'last_seen': edge['last_seen']}}
+    return UpdateOne(f, u, upsert=True)
+
+
+def q_inc_reply_edges(edges):
+    """
+    Adds the counts of a list of edges with one unordered bulk_write (q_bulk_write).
+    """
+    if not edges: return {'upserted': 0, 'modified': 0}
+    collection = get_collection()
+    operations = [_inc_reply_edge(edge) for edge in edges]
+    r = q_bulk_write(collection, operations)
+    return {'upserted': r['nUpserted'], 'modified': r['nModified']}
+
+
+def q_get_reply_edges(usernames=None):
+    # All edges from or to one of the usernames, all edges when usernames is None
+    collection = get_collection()
+    f = _reply_edges_filter(usernames)
+    p = {'_id': 0}
+    return list(collection.find(f, p))
+
+
+def q_rebuild_reply_edges():
+    """
+    Recomputes all edges from the tweets collection and replaces the reply_edges collection. $out keeps the indexes of the collection.
+    Edges incremented by save_tweets while the rebuild runs are lost, so don't rebuild during a scraping session.
+    """
+    tweets = get_db_collection('tweets')
+    m = {'$match': {'is_reply': True}}
+    uw = {'$unwind': '$reply_to'}
+    p = {'$project': {'_id': 0, 'from_username': '$username', 'to_username': '$reply_to.username', 'datetime': 1,
+                      'self': {'$eq': ['$username', '$reply_to.username']}}}
+    m_self = {'$match': {'self': False, 'to_username': {'$ne': None}}}
+    g = {'$group': {'_id': {'from_username': '$from_username', 'to_username': '$to_username'},
+                    'count': {'$sum': 1},
+                    'first_seen': {'$min': '$datetime'},
+                    'last_seen': {'$max': '$datetime'}}}
+    p_out = {'$project': {'_id': 0, 'from_username': '$_id.from_username', 'to_username': '$_id.to_username',
+                          'count': 1, 'first_seen': 1, 'last_seen': 1}}
+    out = {'$out': collection_name}
+    tweets.aggregate([m, uw, p, m_self, g, p_out, out], allowDiskUse=True)
+    n = get_collection().estimated_document_count()
+    logger.info(f'Rebuilt {n} reply edges')
+    return n
+
+
+if __name__ == '__main__':
+    setup_collection()
+    # q_rebuild_reply_edges()
@@ -0,0 +1,111 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/28
+# src - term_count_queries.py
+# md
+# --------------------------------------------------------------------------------------------------------
+from datetime import datetime
+
+from pymongo import ASCENDING, UpdateOne
+
+from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes, q_bulk_write
+from tools.logger import logger
+
+"""
+Group of queries to store and retrief data from the term_counts collection, the word counts of the tweets for word clouds.
+A document holds the counts of a user on a day: {'username': u, 'date': datetime, 'n_tweets': n, 'terms': {term: count, ...}}.
+The counts are incremented when new tweets are saved. Top terms are the sum of the counts of the documents in scope.
+The queries start with 'q_'
+Queries accept and return a dict or a lists of dicts when suitable
+
+Convention:
+-----------
+- documnet:     d
+- query:        q
+- projection:   p
+- sort:         s
+- filter:       f
+- update:       u
+- pipeline      pl
+- match         m
+- group:        g
+
+IMPLEMENTED QUERIES
+-------------------
+- q_inc_term_counts(term_counts)
+- q_get_top_terms(usernames, begin_date, end_date, n, exclude)
+- q_delete_term_counts()
+"""
+system_cfg = SystemCfg()
+database = system_cfg.database
+collection_name = 'term_counts'
+indexes = [{'keys': [('username', ASCENDING), ('date', ASCENDING)], 'unique': True}]  # q_inc_term_counts, q_get_top_terms
+
+
+def get_collection():
+    return get_db_collection(collection_name)
+
+
+def setup_collection(drop_unknown=False):
+    return q_setup_indexes(collection_name, indexes, drop_unknown)
+
+
+def _day_filter(username, date):
+    return {'username': username, 'date': date}
+
+
+def _inc_term_count(term_count):
+    f = _day_filter(term_count['username'], term_count['date'])
+    u = {'$inc': {'n_tweets': term_count['n_tweets'], **{f'terms.{term}': n for term, n in term_count['terms'].items()}}}
+    return UpdateOne(f, u, upsert=True)
+
+
+def q_inc_term_counts(term_counts):
+    """
+    Adds the counts of a list of (username, date) documents with one unordered bulk_write (q_bulk_write).
+    The terms are letters only, so they are valid field names.
+    """
+    if not term_counts: return {'upserted': 0, 'modified': 0}
+    collection = get_collection()
+    operations = [_inc_term_count(term_count) for term_count in term_counts]
+    r = q_bulk_write(collection, operations)
+    return {'upserted': r['nUpserted'], 'modified': r['nModified']}
+
+
+def _day_start(date):
+    # The counts are stored on the midnight of their day, a date or datetime bound becomes the start of its day
+    return datetime(date.year, date.month, date.day)
+
+
+def _top_terms_pipeline(usernames, begin_date, end_date, n, exclude):
+    f = {'date': {'$gte': _day_start(begin_date), '$lte': _day_start(end_date)}}
+    if usernames is not None: f['username'] = {'$in': usernames}
+    m = {'$match': f}
+    p = {'$project': {'_id': 0, 'terms': {'$objectToArray': '$terms'}}}
+    uw = {'$unwind': '$terms'}
+    g = {'$group': {'_id': '$terms.k', 'count': {'$sum': '$terms.v'}}}
+    s = {'$sort': {'count': -1, '_id': 1}}
+    pl = [m, p, uw]
+    if exclude: pl.append({'$match': {'terms.k': {'$nin': list(exclude)}}})
+    pl += [g, s, {'$limit': n}, {'$project': {'_id': 0, 'term': '$_id', 'count': 1}}]
+    return pl
+
+
+def q_get_top_terms(usernames=None, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1), n=100, exclude=None):
+    """
+    The n most used terms of the usernames (all users when None) between begin_date and end_date, both included.
+    'exclude' drops terms that were blacklisted after they were counted.
+    """
+    collection = get_collection()
+    return list(collection.aggregate(_top_terms_pipeline(usernames, begin_date, end_date, n, exclude), allowDiskUse=True))
+
+
+def q_delete_term_counts():
+    collection = get_collection()
+    result = collection.delete_many({})
+    return result.deleted_count
+
+
+if __name__ == '__main__':
+    setup_collection()
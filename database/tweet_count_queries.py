@@ -0,0 +1,125 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/28
+# src - tweet_count_queries.py
+# md
+# --------------------------------------------------------------------------------------------------------
+from datetime import datetime
+
+from pymongo import ASCENDING, UpdateOne
+
+from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes, q_bulk_write
+from tools.logger import logger
+
+"""
+Group of queries to store and retrief data from the tweet_counts collection, the materialized nr of tweets per user per day.
+A document is {'username': u, 'date': datetime, 'nr_tweets': n}. The counts are incremented when new tweets are saved and can be
+rebuilt from the tweets collection. A database with tweets but without counts gets them built by setup_collection() and at the start of
+every scraping session (q_bootstrap_tweet_counts).
+The queries start with 'q_'
+Queries accept and return a dict or a lists of dicts when suitable
+
+Convention:
+-----------
+- documnet:     d
+- query:        q
+- projection:   p
+- sort:         s
+- filter:       f
+- update:       u
+- pipeline      pl
+- match         m
+- group:        g
+
+IMPLEMENTED QUERIES
+-------------------
+- q_inc_tweet_counts(tweet_counts)
+- q_get_nr_tweets_per_day(username, begin_date, end_date)
+- q_rebuild_tweet_counts()
+- q_bootstrap_tweet_counts()
+"""
+system_cfg = SystemCfg()
+database = system_cfg.database
+collection_name = 'tweet_counts'
+indexes = [{'keys': [('username', ASCENDING), ('date', ASCENDING)], 'unique': True}]  # q_inc_tweet_counts, q_get_nr_tweets_per_day
+
+
+def get_collection():
+    return get_db_collection(collection_name)
+
+
+def setup_collection(drop_unknown=False):
+    result = q_setup_indexes(collection_name, indexes, drop_unknown)
+    q_bootstrap_tweet_counts()
+    return result
+
+
+def _day_filter(username, date):
+    return {'username': username, 'date': date}
+
+
+def q_inc_tweet_counts(tweet_counts):
+    """
+    Adds a list of counts [{'username': u, 'date': datetime, 'nr_tweets': n}, ...] with one unordered bulk_write (q_bulk_write).
+    """
+    if not tweet_counts: return {'upserted': 0, 'modified': 0}
+    collection = get_collection()
+    operations = [UpdateOne(_day_filter(tweet_count['username'], tweet_count['date']), {'$inc': {'nr_tweets': tweet_count['nr_tweets']}},
+                            upsert=True)
+                  for tweet_count in tweet_counts]
+    r = q_bulk_write(collection, operations)
+    return {'upserted': r['nUpserted'], 'modified': r['nModified']}
+
+
+def _day_start(date):
+    # The counts are stored on the midnight of their day, a date or datetime bound becomes the start of its day
+    return datetime(date.year, date.month, date.day)
+
+
+def _nr_tweets_per_day_query(username, begin_date, end_date):
+    f = {'username': username, 'date': {'$gte': _day_start(begin_date), '$lte': _day_start(end_date)}}
+    s = [('date', ASCENDING)]
+    return f, s
+
+
+def q_get_nr_tweets_per_day(username, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1)):
+    # [{'date': datetime, 'nr_tweets': n}, ...] of the days from the day of begin_date until the day of end_date, sorted on date
+    collection = get_collection()
+    f, s = _nr_tweets_per_day_query(username, begin_date, end_date)
+    p = {'_id': 0, 'date': 1, 'nr_tweets': 1}
+    return list(collection.find(f, p, sort=s))
+
+
+def q_rebuild_tweet_counts():
+    """
+    Recounts the tweets per user per day from the tweets collection and replaces the tweet_counts collection. $out keeps the indexes.
+    Counts incremented by save_tweets while the rebuild runs are lost, so don't rebuild during a scraping session.
+    """
+    tweets = get_db_collection('tweets')
+    g = {'$group': {'_id': {'username': '$username', 'date': '$date'},
+                    'nr_tweets': {'$sum': 1}}}
+    p = {'$project': {'_id': 0, 'username': '$_id.username',
+                      'date': {'$dateFromString': {'dateString': '$_id.date'}},
+                      'nr_tweets': 1}}
+    out = {'$out': collection_name}
+    tweets.aggregate([g, p, out], allowDiskUse=True)
+    n = get_collection().estimated_document_count()
+    logger.info(f'Rebuilt {n} tweet counts')
+    return n
+
+
+def q_bootstrap_tweet_counts():
+    """
+    Builds the counts of a database that has tweets but no counts yet. Returns the nr of counts built, 0 when there were counts.
+    Counts that were incremented before the first bootstrap only cover the tweets saved since, q_rebuild_tweet_counts() repairs them.
+    """
+    if get_collection().find_one({}, {'_id': 1}) is not None: return 0
+    if get_db_collection('tweets').find_one({}, {'_id': 1}) is None: return 0
+    logger.warning(f'No tweet counts yet, building them from the tweets')
+    return q_rebuild_tweet_counts()
+
+
+if __name__ == '__main__':
+    setup_collection()
+    q_rebuild_tweet_counts()
@@ -6,14 +6,17 @@
 import sys
 from datetime import datetime
 
-from pymongo import MongoClient, ASCENDING
+from pymongo import ASCENDING, DESCENDING, InsertOne, UpdateOne
 from pymongo.errors import DuplicateKeyError
 
 from database.config_facade import SystemCfg
+from database.connection import get_collection as get_db_collection
+from database.db_management import q_setup_indexes, q_bulk_write
 from tools.logger import logger
 
 """
 Group of queries to store and retrief data from the tweets collections.
+The writes stamp a new tweet with 'inserted_at', the datetime it was inserted. Updates of a tweet keep it.
 The queries start with 'q_' 
 Queries accept and return a dict or a lists of dicts when suitable
 
@@ -32,29 +35,35 @@ Convention:
 IMPLEMENTED QUERIES
 -------------------
 - q_get_nr_tweets_per_day(username, session_begin_date, session_end_date)
+- q_get_last_tweet_datetime(username)
 - q_save_a_tweet(tweet)
 - q_update_a_tweet(tweet)
+- q_bulk_write_tweets(tweets, update, batch_size)
+- q_get_tweets_after_id(tweet_id, batch_size)
+- q_get_tweets_inserted_since(inserted_at, tweet_id, batch_size)
+- q_get_tweets_text(batch_size)
 """
 system_cfg = SystemCfg()
 database = system_cfg.database
 collection_name = 'tweets'
+indexes = [{'keys': [('tweet_id', ASCENDING)], 'unique': True},
+           {'keys': [('username', ASCENDING), ('datetime', DESCENDING)]},  # q_get_nr_tweets_per_day, q_get_last_tweet_datetime
+           {'keys': [('inserted_at', ASCENDING)]}]  # q_get_tweets_inserted_since
 
 
 def get_collection():
-    client = MongoClient()
-    db = client[database]
-    collection = db[collection_name]
-    return collection
+    return get_db_collection(collection_name)
 
 
-def setup_collection():  # Todo: add indexes
-    collection = get_collection()
-    collection.create_index('tweet_id', unique=True)
+def setup_collection(drop_unknown=False):
+    return q_setup_indexes(collection_name, indexes, drop_unknown)
 
 
-def q_get_nr_tweets_per_day(username, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1)):
-    collection = get_collection()
+def _tweet_filter(tweet_id):
+    return {'tweet_id': tweet_id}
 
+
+def _nr_tweets_per_day_pipeline(username, begin_date, end_date):
     m = {'$match': {'username': username,
                     'datetime': {'$gte': begin_date,
                                  '$lte': end_date}}}
@@ -63,15 +72,34 @@ def q_get_nr_tweets_per_day(username, begin_date=datetime(2000, 1, 1), end_date=
     p = {'$project': {'date': {'$dateFromString': {'dateString': '$_id'}},
                       'nr_tweets': 1, '_id': 0}}
     s = {'$sort': {'date': ASCENDING}}
+    return [m, g, p, s]
+
 
-    cursor = collection.aggregate([m, g, p, s])
+def q_get_nr_tweets_per_day(username, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1)):
+    # Aggregation on the tweets. get_nr_tweets_per_day uses the materialized counts of tweet_count_queries.
+    collection = get_collection()
+    cursor = collection.aggregate(_nr_tweets_per_day_pipeline(username, begin_date, end_date))
     return list(cursor)
 
 
+def _last_tweet_query(username):
+    f = {'username': username}
+    s = [('datetime', -1)]
+    return f, s
+
+
+def q_get_last_tweet_datetime(username):
+    collection = get_collection()
+    f, s = _last_tweet_query(username)
+    p = {'_id': 0, 'datetime': 1}
+    doc = collection.find_one(f, p, sort=s)
+    return doc['datetime'] if doc else None
+
+
 def q_save_a_tweet(tweet):
     collection = get_collection()
     try:
-        result = collection.insert_one(tweet)
+        result = collection.insert_one({**tweet, 'inserted_at': datetime.now()})
     except DuplicateKeyError as e:
         logger.debug(f"Duplicate: {tweet['tweet_id']} - {tweet['date']} - {tweet['name']}")
     except:
@@ -81,8 +109,8 @@ def q_save_a_tweet(tweet):
 
 def q_update_a_tweet(tweet):
     collection = get_collection()
-    f = {'tweet_id': tweet['tweet_id']}
-    u = {'$set': tweet}
+    f = _tweet_filter(tweet['tweet_id'])
+    u = {'$set': tweet, '$setOnInsert': {'inserted_at': datetime.now()}}
     try:
         result = collection.update_one(f, u, upsert=True)
         logger.debug(f"Updated: {result.raw_result} - {tweet['tweet_id']} - {tweet['date']} - {tweet['name']}")
@@ -90,6 +118,87 @@ def q_update_a_tweet(tweet):
         logger.debug(f"Duplicate: {tweet['tweet_id']} - {tweet['date']} - {tweet['name']}")
 
 
+def q_bulk_write_tweets(tweets, update=True, batch_size=None):
+    """
+    Writes a list of tweets with unordered bulk_write batches of 'batch_size' operations.
+    update=True upserts the tweets on tweet_id (same documents as q_update_a_tweet), update=False only inserts new tweets (as q_save_a_tweet).
+    Returns a dict with the nr of inserted, modified and duplicate tweets. Duplicates are tweets that were already in the collection.
+    'new' is the list of indexes in 'tweets' of the inserted tweets. When the same tweet is written concurrently, only one writer gets it as new.
+    """
+    collection = get_collection()
+    batch_size = batch_size or system_cfg.mongo_bulk_batch_size
+    result = {'inserted': 0, 'modified': 0, 'duplicates': 0, 'new': []}
+    for i in range(0, len(tweets), batch_size):
+        batch = tweets[i:i + batch_size]
+        now = datetime.now()
+        if update:
+            operations = [UpdateOne(_tweet_filter(tweet['tweet_id']), {'$set': tweet, '$setOnInsert': {'inserted_at': now}}, upsert=True)
+                          for tweet in batch]
+        else:
+            operations = [InsertOne({**tweet, 'inserted_at': now}) for tweet in batch]
+        r = q_bulk_write(collection, operations, retry_duplicates=update)  # A retried upsert writes the fresher stats of its tweet
+        result['inserted'] += r['nInserted'] + r['nUpserted']
+        result['modified'] += r['nModified']
+        result['duplicates'] += len(r['writeErrors']) + r['nMatched']
+        if update:
+            # Only the first pass, a retried tweet was inserted by the concurrent writer that counts it as new
+            retried = set(r.get('retried', []))
+            result['new'] += [i + upserted['index'] for upserted in r['upserted'] if upserted['index'] not in retried]
+        else:
+            failed = {error['index'] for error in r['writeErrors']}
+            result['new'] += [i + j for j in range(len(batch)) if j not in failed]
+    logger.debug(f'Bulk write {len(tweets)} tweets: {result["inserted"]} inserted, {result["modified"]} modified, {result["duplicates"]} duplicates')
+    return result
+
+
+def _after_id_filter(tweet_id):
+    # One branch per length of the greater tweet_ids, up to 19 digits (int64). The index bounds of a branch are the range of that length,
+    # the regex drops the shorter and longer ids inside the range.
+    def branch(n, bounds):
+        return {'tweet_id': {**bounds, '$regex': f'^[0-9]{{{n}}}$'}}
+    branches = [branch(len(tweet_id), {'$gt': tweet_id, '$lte': '9' * len(tweet_id)})]
+    branches += [branch(n, {'$gte': '1' + '0' * (n - 1), '$lte': '9' * n}) for n in range(len(tweet_id) + 1, 20)]
+    return {'$or': branches}
+
+
+def q_get_tweets_after_id(tweet_id=None, batch_size=None):
+    """
+    Returns a cursor on all tweets with a tweet_id numerically greater than 'tweet_id', or on all tweets when tweet_id is None.
+    tweet_id is a string without leading zeros: a longer tweet_id is greater, a tweet_id of the same length compares as a string.
+    """
+    collection = get_collection()
+    f = _after_id_filter(tweet_id) if tweet_id is not None else {}
+    p = {'_id': 0}
+    return collection.find(f, p, batch_size=batch_size or system_cfg.mongo_bulk_batch_size, no_cursor_timeout=True)
+
+
+def _inserted_since_filter(inserted_at, tweet_id):
+    if inserted_at is not None:
+        return {'inserted_at': {'$gte': inserted_at}}
+    if tweet_id is not None:
+        return {'$or': [{'inserted_at': {'$exists': True}}, {'inserted_at': {'$exists': False}, **_after_id_filter(tweet_id)}]}
+    return {}
+
+
+def q_get_tweets_inserted_since(inserted_at=None, tweet_id=None, batch_size=None):
+    """
+    Returns a cursor on the tweets inserted at or after the datetime 'inserted_at', or on all tweets when both arguments are None.
+    Without inserted_at, tweet_id selects the tweets of before the 'inserted_at' stamp (without it) after that tweet_id, plus all
+    the stamped tweets.
+    """
+    collection = get_collection()
+    f = _inserted_since_filter(inserted_at, tweet_id)
+    p = {'_id': 0}
+    return collection.find(f, p, batch_size=batch_size or system_cfg.mongo_bulk_batch_size, no_cursor_timeout=True)
+
+
+def q_get_tweets_text(batch_size=None):
+    # Cursor on the username, date and text of all tweets
+    collection = get_collection()
+    p = {'_id': 0, 'username': 1, 'date': 1, 'tweet': 1}
+    return collection.find({}, p, batch_size=batch_size or system_cfg.mongo_bulk_batch_size, no_cursor_timeout=True)
+
+
 def q_tweets_scraping_log():
     pass
 
@@ -3,14 +3,23 @@
 # src - twitter_facade.py
 # md
 # --------------------------------------------------------------------------------------------------------
+from collections import Counter
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
-from database.profile_queries import q_get_a_profile, q_save_a_profile, q_get_profiles, q_set_profile_scrape_flag
-from database.tweet_queries import q_get_nr_tweets_per_day, q_save_a_tweet, q_update_a_tweet
+import config
+from database.profile_queries import q_get_a_profile, q_save_a_profile, q_get_profiles, q_get_usernames, q_set_profiles_scrape_flag
+from database.profile_stat_queries import q_get_profile_stats
+from database.reply_edge_queries import q_inc_reply_edges, q_get_reply_edges, q_rebuild_reply_edges
+from database.term_count_queries import q_inc_term_counts, q_get_top_terms, q_delete_term_counts
+from database.tweet_count_queries import q_inc_tweet_counts, q_get_nr_tweets_per_day, q_rebuild_tweet_counts, q_bootstrap_tweet_counts
+from database.tweet_queries import q_bulk_write_tweets, q_get_last_tweet_datetime, q_get_tweets_text
+from tools import metrics, profiling
 from tools.logger import logger
-from tools.utils import set_pandas_display_options
+from tools.text import DUTCH_STOPWORDS, count_terms
+from tools.utils import set_pandas_display_options, users_list_usernames
 
 set_pandas_display_options()
 """
@@ -23,86 +32,172 @@ IMPLEMENTED FUNCTIONS
 - get_join_date(username)
 - get_a_profile(username)
 - get_profiles()
+- get_profile_stats(username, begin_date, end_date)
+- get_usernames()
 - get_nr_tweets_per_day(username, session_begin_date, session_end_date)
-- reset_all_scrape_flags()
+- get_last_tweet_datetime(username)
+- get_reply_edges(usernames)
+- get_top_terms(usernames, begin_date, end_date, n)
+- rebuild_reply_edges()
+- rebuild_term_counts(batch_size)
+- rebuild_tweet_counts()
+- bootstrap_tweet_counts()
+- reset_all_scrape_flags(party, usernames)
 - save_a_profile(profiles_df)
-- save_tweets(tweets_df)
+- save_tweets(tweets_df, update, batch_size)
 - set_profile_scrape_flag(username, flag)
 """
 
 
-def save_tweets(tweets_df, update=True):
+# Column order of the tweets, to have the fields in Mongodb in the right order
+tweets_columns = ['tweet_id',
+                  'conversation_id',
+                  'user_id',
+                  'username',
+                  'name',
+                  'created_at',
+                  'datetime',
+                  'date',
+                  'time',
+                  'timezone',
+                  'day',
+                  'hour',
+
+                  'tweet',
+                  'hashtags',
+                  'cashtags',
+                  'reply_to',
+                  'is_reply',
+                  'quote_url',
+                  'link',
+
+                  'retweet',
+                  'nlikes',
+                  'nreplies',
+                  'nretweets',
+
+                  'search',
+                  'source',
+                  'near',
+                  'geo',
+                  'place',
+
+                  'user_rt_id',
+                  'user_rt',
+                  'retweet_id',
+
+                  'retweet_date',
+                  'translate',
+                  'trans_src',
+                  'trans_dest',
+                  ]
+
+
+def _format_tweets_df(df):
+    """
+    Normalizes a twint tweets_df with columnar operations.
+    The rename doesn't copy the data, so the columns that are not replaced are shared with the twint tweets_df. Like before,
+    the reply_to dicts are lowercased in place.
+    """
+    df = df.rename(columns={'id': 'tweet_id'}, copy=False)
+
+    # Make user_id string
+    df['user_id'] = df['user_id'].astype(str)
+    # Make all usernamers lowercase
+    df['username'] = df['username'].str.lower()
+    # reply_to: [{'user_id': '11767', 'username': 'xxx'}, ... ]
+    replies = df['reply_to'].explode().dropna()
+    reply_usernames = replies.str.get('username').str.lower()
+    for dct, username in zip(replies.tolist(), reply_usernames.tolist()):
+        dct['username'] = username
+    # Add is_reply
+    df['is_reply'] = df['tweet_id'] != df['conversation_id']
+    # Add datetime columns
+    df['datetime'] = pd.to_datetime(df['date'], format='%Y-%m-%d %H:%M:%S')
+    df['date'], df['time'] = _split_datetimes(df['datetime'].values)
+    return df
+
+
+def _split_datetimes(values):
+    """
+    Splits a datetime64 array in 'yyyy-mm-dd' and 'hh:mm:ss' string arrays, without creating a python object per value.
+    Gives the same strings as str(date) and str(time) because the twint dates have no microseconds.
+    """
+    iso = np.datetime_as_string(values, unit='s').astype('<U19')  # 'yyyy-mm-ddThh:mm:ss'
+    chars = iso.view('<U1').reshape(-1, 19)
+    dates = np.ascontiguousarray(chars[:, :10]).view('<U10').ravel()
+    times = np.ascontiguousarray(chars[:, 11:]).view('<U8').ravel()
+    return dates.astype(object), times.astype(object)
+
+
+def _reorder_tweets_df_columns(df):
+    return df[tweets_columns]
+
+
+def _tweets_df_to_records(df):
+    # Same records as _reorder_tweets_df_columns(df).to_dict('records') without the copy of the reordered frame
+    columns = [df[column].tolist() for column in tweets_columns]
+    return [dict(zip(tweets_columns, values)) for values in zip(*columns)]
+
+
+def _reply_edges(tweets):
+    # Aggregates the replies of the tweets into edges from the user to every user in reply_to. Replies to yourself (threads) are no edges.
+    edges = {}
+    for tweet in tweets:
+        if not tweet['is_reply']: continue
+        for reply_to in tweet['reply_to'] or []:
+            to_username = reply_to.get('username')
+            if not to_username or to_username == tweet['username']: continue
+            key = (tweet['username'], to_username)
+            edge = edges.get(key)
+            if edge is None:
+                edges[key] = {'from_username': key[0], 'to_username': key[1], 'count': 1,
+                              'first_seen': tweet['datetime'], 'last_seen': tweet['datetime']}
+            else:
+                edge['count'] += 1
+                edge['first_seen'] = min(edge['first_seen'], tweet['datetime'])
+                edge['last_seen'] = max(edge['last_seen'], tweet['datetime'])
+    return list(edges.values())
+
+
+def _tweet_counts(tweets):
+    # Nr of tweets per (username, date)
+    tweet_counts = Counter((tweet['username'], tweet['date']) for tweet in tweets)
+    return [{'username': username, 'date': datetime.strptime(date, '%Y-%m-%d'), 'nr_tweets': n} for (username, date), n in tweet_counts.items()]
+
+
+def _wordcloud_blacklist():
+    return {word.lower() for word in config.WORDCLOUD_BLACKLIST}
+
+
+def _term_counts(tweets, stopwords):
+    # Word counts of the tweets per (username, date)
+    texts = {}
+    for tweet in tweets:
+        texts.setdefault((tweet['username'], tweet['date']), []).append(tweet['tweet'])
+    return [{'username': username, 'date': datetime.strptime(date, '%Y-%m-%d'), 'n_tweets': len(day_texts), 'terms': count_terms(day_texts, stopwords)}
+            for (username, date), day_texts in texts.items()]
+
+
+def save_tweets(tweets_df, update=True, batch_size=None):
     # Update necessary to have correct likes, replies, etc
-    def _format_tweets_df(df):
-        df = df.rename(columns={'id': 'tweet_id'})
-
-        # Make user_id string
-        df['user_id'] = df['user_id'].apply(str)
-        # Make all usernamers lowercase
-        df['username'] = df['username'].str.lower()
-
-        def f(lst):  # [{'user_id': '11767', 'username': 'xxx'}, ... ]
-            for dct in lst:
-                dct['username'] = dct['username'].lower()
-
-        df['reply_to'].apply(lambda x: f(x))
-        # Add is_reply
-        df['is_reply'] = df['tweet_id'] != df['conversation_id']
-        # Add datetime columns
-        df['datetime'] = pd.to_datetime(df['date'], format='%Y-%m-%d %H:%M:%S')
-        df['date'] = df['datetime'].dt.date.apply(str)
-        df['time'] = df['datetime'].dt.time.apply(str)
-        return df
-
-    def _reorder_tweets_df_columns(df):
-        # Reorder the columns, to have the fields in Mongodb in the right order
-        columns = ['tweet_id',
-                   'conversation_id',
-                   'user_id',
-                   'username',
-                   'name',
-                   'created_at',
-                   'datetime',
-                   'date',
-                   'time',
-                   'timezone',
-                   'day',
-                   'hour',
-
-                   'tweet',
-                   'hashtags',
-                   'cashtags',
-                   'reply_to',
-                   'is_reply',
-                   'quote_url',
-                   'link',
-
-                   'retweet',
-                   'nlikes',
-                   'nreplies',
-                   'nretweets',
-
-                   'search',
-                   'source',
-                   'near',
-                   'geo',
-                   'place',
-
-                   'user_rt_id',
-                   'user_rt',
-                   'retweet_id',
-
-                   'retweet_date',
-                   'translate',
-                   'trans_src',
-                   'trans_dest',
-                   ]
-        return df[columns]
-
-    tweets_df = _format_tweets_df(tweets_df)
-    tweets_df = _reorder_tweets_df_columns(tweets_df)
-    for _, row in tweets_df.iterrows():
-        q_update_a_tweet(row.to_dict()) if update else q_save_a_tweet(row.to_dict())
+    # Returns a dict with the nr of inserted, modified and duplicate tweets
+    # Only the tweets that are new in the collection update the tweet counts, reply edges and term counts, so saving a period twice doesn't count it twice
+    with profiling.stage('format'):
+        tweets_df = _format_tweets_df(tweets_df)
+        tweets = _tweets_df_to_records(tweets_df)
+    with metrics.timer('twitter_mongo_write_seconds', collection='tweets'):
+        result = q_bulk_write_tweets(tweets, update=update, batch_size=batch_size)
+    new_tweets = [tweets[i] for i in result.pop('new')]
+    with metrics.timer('twitter_mongo_write_seconds', collection='tweet_counts'):
+        q_inc_tweet_counts(_tweet_counts(new_tweets))
+    with metrics.timer('twitter_mongo_write_seconds', collection='reply_edges'):
+        q_inc_reply_edges(_reply_edges(new_tweets))
+    term_counts = _term_counts(new_tweets, DUTCH_STOPWORDS | _wordcloud_blacklist())
+    with metrics.timer('twitter_mongo_write_seconds', collection='term_counts'):
+        q_inc_term_counts(term_counts)
+    metrics.inc('twitter_tweets_saved_total', len(tweets))
+    return result
 
 
 def save_a_profile(profiles_df):
@@ -129,11 +224,18 @@ def get_a_profile(username):
 
 
 def get_usernames():
-    profiles_df = get_profiles() # Todo: refactor: inconsistent nameing for same profiles_df, username_df
-    usernames_df = profiles_df[['user_id', 'username']]
+    usernames = q_get_usernames()
+    usernames_df = pd.DataFrame(usernames, columns=['user_id', 'username'])
     return usernames_df
 
 
+def get_profile_stats(username, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1)):
+    # DataFrame with the columns timestamp, followers, following, likes, tweets, media of the user between begin_date and end_date
+    profile = q_get_a_profile(username)
+    samples = q_get_profile_stats(profile['user_id'], begin_date, end_date) if profile else []
+    return pd.DataFrame(samples, columns=['timestamp', 'followers', 'following', 'likes', 'tweets', 'media'])
+
+
 def get_join_date(username):
     profile = q_get_a_profile(username)
     try:
@@ -148,13 +250,71 @@ def get_join_date(username):
 
 
 def get_nr_tweets_per_day(username, start_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1)):
+    # From the materialized tweet_counts, not from an aggregation on the tweets
     nr_tweets_per_day = q_get_nr_tweets_per_day(username, start_date, end_date)
     return pd.DataFrame(nr_tweets_per_day)
 
 
-def reset_all_scrape_flags():  # Todo: Refactor: use update_many in query!
-    for profile in q_get_profiles():
-        q_set_profile_scrape_flag(profile['username'], 0)
+def get_last_tweet_datetime(username):
+    return q_get_last_tweet_datetime(username)
+
+
+def get_reply_edges(usernames=None):
+    # DataFrame with the columns from_username, to_username, count, first_seen, last_seen
+    reply_edges = q_get_reply_edges(usernames)
+    return pd.DataFrame(reply_edges, columns=['from_username', 'to_username', 'count', 'first_seen', 'last_seen'])
+
+
+def rebuild_reply_edges():
+    return q_rebuild_reply_edges()
+
+
+def get_top_terms(usernames=None, begin_date=datetime(2000, 1, 1), end_date=datetime(2035, 1, 1), n=100):
+    # DataFrame with the columns term, count of the n most used terms. The blacklist is applied again for terms that were counted before they were blacklisted.
+    top_terms = q_get_top_terms(usernames, begin_date, end_date, n, exclude=_wordcloud_blacklist())
+    return pd.DataFrame(top_terms, columns=['term', 'count'])
+
+
+def rebuild_term_counts(batch_size=50000):
+    # Recounts the terms of all tweets. Don't run it during a scraping session, the tweets saved meanwhile would be counted twice.
+    logger.info(f'Deleted {q_delete_term_counts()} term counts')
+    stopwords = DUTCH_STOPWORDS | _wordcloud_blacklist()
+    cursor = q_get_tweets_text(batch_size)
+    n, batch = 0, []
+    try:
+        for tweet in cursor:
+            batch.append(tweet)
+            if len(batch) >= batch_size:
+                q_inc_term_counts(_term_counts(batch, stopwords))
+                n += len(batch)
+                batch = []
+                logger.info(f'Counted the terms of {n} tweets')
+        q_inc_term_counts(_term_counts(batch, stopwords))
+        n += len(batch)
+    finally:
+        cursor.close()
+    logger.info(f'Counted the terms of {n} tweets')
+    return n
+
+
+def rebuild_tweet_counts():
+    return q_rebuild_tweet_counts()
+
+
+def bootstrap_tweet_counts():
+    # Builds the tweet counts when the database has tweets but no counts, see q_bootstrap_tweet_counts
+    return q_bootstrap_tweet_counts()
+
+
+def reset_all_scrape_flags(party=None, usernames=None):
+    # Resets the scrape_flag of all profiles, of the profiles of a party (a key of config.USERS_LIST) or of a list of usernames
+    # Returns {'matched': n, 'modified': n}
+    f = {}
+    if party is not None: usernames = users_list_usernames(party)
+    if usernames is not None: f['username'] = {'$in': [username.lower() for username in usernames]}
+    result = q_set_profiles_scrape_flag(f, 0)
+    logger.info(f'Reset scrape flags: {result}')
+    return result
 
 
 if __name__ == '__main__':
@@ -6,9 +6,12 @@
 
 from business.scraping_controller import reset_proxy_servers, reset_scrape_flag, scrape_proxies, TwitterScrapingSession
 
-scrape = TwitterScrapingSession()
-# _ = start_scraping.users_list(['FRanckentheo', 'xsdsdaads', 'smienos'], only_new=False).start_scraping
-# _ = scrape.profiles.tweets.all_users.start_scraping()
-# _ = scrape.tweets.all_users.start_scraping()
-# _ = scrape.profiles.tweets.rescrape_failed_periods(1).start_scraping()
-_ = scrape.profiles.tweets.all_users.start_scraping()
+if __name__ == '__main__':  # The workers of a forkserver pool import __main__
+    scrape = TwitterScrapingSession()
+    # _ = start_scraping.users_list(['FRanckentheo', 'xsdsdaads', 'smienos'], only_new=False).start_scraping
+    # _ = scrape.profiles.tweets.all_users.start_scraping()
+    # _ = scrape.tweets.all_users.start_scraping()
+    # _ = scrape.profiles.tweets.rescrape_failed_periods(1).start_scraping()
+    # _ = scrape.resume(1).start_scraping()
+    # _ = scrape.all_users.start_tailing()
+    _ = scrape.profiles.tweets.all_users.start_scraping()
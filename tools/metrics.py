@@ -0,0 +1,286 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/30
+# src - metrics.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.managers import BaseManager
+
+from tools.logger import logger
+
+"""
+Metrics of a scraping session, gathered across the worker processes and served on a local http endpoint in the Prometheus text format.
+
+The Metrics registry lives in a MetricsManager server process, like the ProxyPool, so all the processes of a session add to the same
+counters and histograms. start_metrics() starts it together with an http server thread that serves GET /metrics. Start it before the
+mp.Pool, so the forked workers inherit it. inc(), observe(), set_gauge() and timer() do nothing when the metrics aren't started.
+A call to the registry is a round trip to the manager process. inc(), observe() and set_gauge() therefore add to a buffer of the
+process, flush() sends it to the registry in one call. The workers flush at the end of every period, snapshot() and the endpoint flush
+the buffer of the session process.
+A collector is a function that returns [(name, {label: value}, value), ...]. It's called at every request of /metrics, for gauges that
+are cheaper to read than to keep up to date, e.g. the size of the proxy pool.
+
+Tweets/sec is rate(twitter_tweets_saved_total[1m]) in Prometheus.
+
+IMPLEMENTED FUNCTIONS
+---------------------
+- start_metrics(port, host, buckets)
+- stop_metrics()
+- is_started()
+- snapshot()
+- flush()
+- get_registry()
+- use_registry(registry)
+- add_collector(collector)
+- inc(name, value, **labels)
+- observe(name, value, **labels)
+- set_gauge(name, value, **labels)
+- timer(name, **labels)
+"""
+latency_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)  # seconds
+metric_definitions = {
+    'twitter_periods_total': ('counter', 'Scraped periods by status (ok, fail)'),
+    'twitter_tweets_saved_total': ('counter', 'Tweets saved by save_tweets'),
+    'twitter_scrape_errors_total': ('counter', 'Failed scraping attempts by error type'),
+    'twitter_period_seconds': ('histogram', 'Time to scrape a period, retries included'),
+    'twitter_proxy_request_seconds': ('histogram', 'Time of a scraping attempt by proxy'),
+    'twitter_mongo_write_seconds': ('histogram', 'Time of the writes to mongodb by collection'),
+    'twitter_worker_cpu_seconds_total': ('counter', 'CPU time of the workers scraping periods'),
+    'twitter_proxy_pool_size': ('gauge', 'Nr of proxies in the pool'),
+    'twitter_proxy_pool_available': ('gauge', 'Nr of proxies that can be acquired'),
+    'twitter_proxy_pool_benched': ('gauge', 'Nr of benched proxies'),
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels):
+    if not labels: return ''
+    escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    Registry of counters, gauges and histograms with labels. The histograms share the same buckets.
+    The labels are a tuple of (label, value) pairs, sorted on label.
+    """
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = tuple(buckets)
+        self._counters = {}  # {(name, labels): value}
+        self._gauges = {}  # {(name, labels): value}
+        self._histograms = {}  # {(name, labels): [count per bucket + the +Inf bucket, sum]}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value, labels=()):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def set_gauge(self, name, value, labels=()):
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            histogram = self._histograms.setdefault((name, labels), [0] * (len(self.buckets) + 1) + [0.0])
+            histogram[bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    def merge(self, counters, gauges, observations):
+        # Adds the buffer of a process: counters {(name, labels): value}, gauges {(name, labels): value}, observations {(name, labels): [values]}
+        for (name, labels), value in counters.items():
+            self.inc(name, value, labels)
+        for (name, labels), value in gauges.items():
+            self.set_gauge(name, value, labels)
+        for (name, labels), values in observations.items():
+            for value in values:
+                self.observe(name, value, labels)
+
+    def snapshot(self):
+        # Copy of the values for reports: {'buckets': (...), 'counters': {(name, labels): value}, 'gauges': {...}, 'histograms': {...}}
+        with self._lock:
+            return {'buckets': self.buckets,
+                    'counters': dict(self._counters),
+                    'gauges': dict(self._gauges),
+                    'histograms': {key: list(histogram) for key, histogram in self._histograms.items()}}
+
+    def render(self, gauges=()):
+        # The metrics in the Prometheus text exposition format, with the extra gauges [(name, labels, value), ...] of the collectors
+        with self._lock:
+            samples = {}
+            values = list(self._counters.items()) + list(self._gauges.items()) + [((name, labels), value) for name, labels, value in gauges]
+            for (name, labels), value in sorted(values):
+                samples.setdefault(name, []).append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for le, count in zip([_format_value(float(b)) for b in self.buckets] + ['+Inf'], histogram[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(histogram[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        text = []
+        for name in sorted(samples):
+            metric_type, description = metric_definitions.get(name, ('untyped', name))
+            text += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}'] + samples[name]
+        return '\n'.join(text) + '\n'
+
+
+class MetricsManager(BaseManager):
+    pass
+
+
+MetricsManager.register('Metrics', Metrics)
+
+_manager = None
+_metrics = None  # Proxy of the Metrics in the manager process, inherited by the workers
+_server = None
+_collectors = []
+_pending_lock = threading.Lock()
+_pending = {'counters': {}, 'gauges': {}, 'observations': {}}  # The buffer of this process, see flush()
+
+
+def _reset_pending():
+    # A forked worker starts with an empty buffer, the buffer of the parent is flushed by the parent
+    global _pending_lock
+    _pending_lock = threading.Lock()
+    for values in _pending.values():
+        values.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pending)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = _render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # No access log on stderr
+        pass
+
+
+def _render():
+    flush()
+    gauges = []
+    for collector in _collectors:
+        try:
+            gauges += [(name, _labels_key(labels), value) for name, labels, value in collector()]
+        except Exception as e:
+            logger.warning(f'Metrics collector {collector} failed: {e!r}')
+    return _metrics.render(gauges)
+
+
+def start_metrics(port=None, host='127.0.0.1', buckets=latency_buckets):
+    # Starts the registry and, when a port is given, the /metrics endpoint. Returns the registry.
+    global _manager, _metrics, _server
+    if _metrics is not None: return _metrics
+    _manager = MetricsManager()
+    _manager.start()
+    _metrics = _manager.Metrics(buckets)
+    if port:
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:  # Ex. the port of another session. The metrics are optional, the session goes on without the endpoint.
+            logger.warning(f'Metrics endpoint http://{host}:{port}/metrics not started: {e!r}')
+            return _metrics
+        threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+        logger.info(f'Metrics on http://{host}:{port}/metrics')
+    return _metrics
+
+
+def stop_metrics():
+    global _manager, _metrics, _server
+    flush()
+    _reset_pending()
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+    if _manager is not None:
+        _manager.shutdown()
+    _manager, _metrics, _server = None, None, None
+    _collectors.clear()
+
+
+def is_started():
+    return _metrics is not None
+
+
+def get_registry():
+    return _metrics
+
+
+def use_registry(registry):
+    # In a worker that didn't inherit the registry of the session. Doesn't start the endpoint.
+    global _metrics
+    _metrics = registry
+
+
+def snapshot():
+    flush()
+    return _metrics.snapshot() if _metrics is not None else None
+
+
+def flush():
+    # Sends the buffer of this process to the registry in one call
+    if _metrics is None: return
+    with _pending_lock:
+        pending = {key: dict(values) for key, values in _pending.items()}
+        for values in _pending.values():
+            values.clear()
+    if any(pending.values()):
+        _metrics.merge(pending['counters'], pending['gauges'], pending['observations'])
+
+
+def add_collector(collector):
+    _collectors.append(collector)
+
+
+def inc(name, value=1, **labels):
+    if _metrics is None: return
+    key = (name, _labels_key(labels))
+    with _pending_lock:
+        _pending['counters'][key] = _pending['counters'].get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    if _metrics is None: return
+    with _pending_lock:
+        _pending['observations'].setdefault((name, _labels_key(labels)), []).append(value)
+
+
+def set_gauge(name, value, **labels):
+    if _metrics is None: return
+    with _pending_lock:
+        _pending['gauges'][(name, _labels_key(labels))] = value
+
+
+@contextmanager
+def timer(name, **labels):
+    # Observes the seconds spent in the with block
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start_time, **labels)
@@ -0,0 +1,271 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/31
+# src - profiling.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import contextvars
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import signal
+import time
+from contextlib import contextmanager
+
+from tools.logger import logger
+
+"""
+Opt-in profiling of the scraping workers: where does the time of a period go?
+
+Modes (config 'profiling'):
+    - 'stages':   wall and CPU time per stage for every period
+    - 'cprofile': 'stages' + a cProfile of every worker process
+    - 'sampling': 'stages' + a sampling profile of every worker process: the stack of the worker every 'profiling_interval'
+                  seconds of CPU time, in the folded format of flamegraph.pl and speedscope
+
+period(username, begin_date, end_date) measures a period and stage(name) a part of it. The time of a stage inside another stage only
+counts for the inner stage, the time of a period outside the stages is 'other'. The CPU time is the one of the process while the stage runs.
+With the async fetch engine the periods of a batch run concurrently: their stages overlap and the CPU time of a stage includes the other periods.
+
+start() is called by the session before the mp.Pool, so the workers inherit it, the workers of a forkserver pool get it with use_settings().
+Every worker writes its periods to a file in 'profiling_dir' and its profile at flush(), at the end of every work unit. stop() merges the
+files of all the workers into a report.
+Without start() period(), stage() and flush() do nothing.
+
+IMPLEMENTED FUNCTIONS
+---------------------
+- start(session_id, mode, directory, interval)
+- stop()
+- period(username, begin_date, end_date)
+- stage(name)
+- flush()
+- get_settings()
+- use_settings(settings)
+- report(session_id, directory, top)
+"""
+stages = ('proxy_pool', 'fetch', 'format', 'save', 'log', 'proxy_stats', 'error_sleep')
+
+_mode = None
+_directory = None
+_interval = None
+_session_id = None
+_period = contextvars.ContextVar('profiling_period', default=None)  # Per asyncio task
+_worker_pid = None
+_profiler = None
+_samples = {}  # {folded stack: nr of samples}
+
+
+def _now():
+    return time.perf_counter(), time.process_time()
+
+
+def _path(kind, extension, pid='*', session_id=None, directory=None):
+    return os.path.join(directory or _directory, f'{kind}-{session_id if session_id is not None else _session_id}-{pid}.{extension}')
+
+
+def start(session_id, mode='stages', directory='profiles', interval=0.005):
+    global _mode, _directory, _interval, _session_id
+    if mode not in ('stages', 'cprofile', 'sampling'):
+        raise ValueError(f'Unknown profiling mode: {mode}')
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(_path('*', '*', session_id=session_id, directory=directory)):  # A rescrape reuses the session_id
+        os.remove(path)
+    _mode, _directory, _interval, _session_id = mode, directory, interval, session_id
+    logger.info(f'Profiling session {session_id} | mode={mode}, directory={directory}')
+
+
+def stop():
+    # Returns the report of the session
+    global _mode
+    if _mode is None: return None
+    _stop_worker()
+    _mode = None
+    return report(_session_id, _directory)
+
+
+def get_settings():
+    return (_session_id, _mode, _directory, _interval) if _mode is not None else None
+
+
+def use_settings(settings):
+    # In a worker that didn't inherit the profiling of the session
+    global _mode, _directory, _interval, _session_id
+    if settings is None: return
+    _session_id, _mode, _directory, _interval = settings
+
+
+def _start_worker():
+    # The profiler of a worker starts with its first period
+    global _worker_pid, _profiler, _samples
+    if _worker_pid == os.getpid(): return
+    _worker_pid, _profiler, _samples = os.getpid(), None, {}
+    if _mode == 'cprofile':
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif _mode == 'sampling':
+        signal.signal(signal.SIGPROF, _sample)
+        signal.setitimer(signal.ITIMER_PROF, _interval, _interval)
+
+
+def _stop_worker():
+    global _worker_pid, _profiler
+    if _worker_pid != os.getpid(): return
+    flush()
+    if _profiler is not None:
+        _profiler.disable()
+    if _mode == 'sampling':
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+    _worker_pid, _profiler = None, None
+
+
+def _sample(signum, frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    key = ';'.join(reversed(stack))
+    _samples[key] = _samples.get(key, 0) + 1
+
+
+def flush():
+    # Saves the profile of the worker. The profile is cumulative, every flush overwrites the previous one.
+    if _worker_pid != os.getpid(): return
+    if _profiler is not None:
+        _profiler.dump_stats(_path('cprofile', 'prof', os.getpid()))
+    elif _mode == 'sampling':
+        with open(_path('sampling', 'folded', os.getpid()), 'w') as f:
+            f.writelines(f'{stack} {n}\n' for stack, n in _samples.copy().items())
+
+
+def _add(record, entry, now):
+    # Adds the time since the (re)start of the stage entry [name, wall, cpu] to the stage and restarts it
+    total = record['stages'].setdefault(entry[0], [0.0, 0.0])
+    total[0] += now[0] - entry[1]
+    total[1] += now[1] - entry[2]
+    entry[1:] = now
+
+
+@contextmanager
+def period(username, begin_date, end_date):
+    if _mode is None:
+        yield
+        return
+    _start_worker()
+    record = {'username': username, 'begin_date': str(begin_date), 'end_date': str(end_date), 'pid': os.getpid(), 'stages': {}, 'stack': []}
+    token = _period.set(record)
+    start_time = _now()
+    try:
+        yield
+    finally:
+        now = _now()
+        _period.reset(token)
+        record['wall'], record['cpu'] = now[0] - start_time[0], now[1] - start_time[1]
+        del record['stack']
+        with open(_path('stages', 'jsonl', os.getpid()), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def stage(name):
+    record = _period.get()
+    if record is None:
+        yield
+        return
+    stack = record['stack']
+    now = _now()
+    if stack: _add(record, stack[-1], now)  # Pause the outer stage
+    stack.append([name, *now])
+    try:
+        yield
+    finally:
+        now = _now()
+        _add(record, stack.pop(), now)
+        if stack: stack[-1][1:] = now  # Resume the outer stage
+
+
+def _load_periods(session_id, directory):
+    periods = []
+    for path in glob.glob(_path('stages', 'jsonl', session_id=session_id, directory=directory)):
+        with open(path) as f:
+            periods += [json.loads(line) for line in f if line.strip()]
+    return periods
+
+
+def _stages_report(periods):
+    wall, cpu = sum(p['wall'] for p in periods), sum(p['cpu'] for p in periods)
+    totals = {}
+    for p in periods:
+        for name, (stage_wall, stage_cpu) in p['stages'].items():
+            total = totals.setdefault(name, [0.0, 0.0])
+            total[0] += stage_wall
+            total[1] += stage_cpu
+    totals['other'] = [wall - sum(t[0] for t in totals.values()), cpu - sum(t[1] for t in totals.values())]
+    names = [s for s in stages if s in totals] + sorted(set(totals) - set(stages) - {'other'}) + ['other']
+    lines = [f'{"stage":<12} {"wall s":>10} {"wall %":>7} {"cpu s":>10} {"cpu %":>7} {"wall s/period":>14}']
+    for name in names:
+        stage_wall, stage_cpu = totals[name]
+        lines.append(f'{name:<12} {stage_wall:>10.1f} {100 * stage_wall / wall if wall else 0:>7.1f} {stage_cpu:>10.1f} '
+                     f'{100 * stage_cpu / cpu if cpu else 0:>7.1f} {stage_wall / len(periods):>14.3f}')
+    lines.append(f'{"total":<12} {wall:>10.1f} {"":>7} {cpu:>10.1f} {"":>7} {wall / len(periods):>14.3f}')
+    lines += ['', f'{"pid":>8} {"periods":>8} {"wall s":>10} {"cpu s":>10}']
+    for pid in sorted({p['pid'] for p in periods}):
+        worker_periods = [p for p in periods if p['pid'] == pid]
+        lines.append(f'{pid:>8} {len(worker_periods):>8} {sum(p["wall"] for p in worker_periods):>10.1f} {sum(p["cpu"] for p in worker_periods):>10.1f}')
+    return lines
+
+
+def _cprofile_report(session_id, directory, top):
+    paths = glob.glob(_path('cprofile', 'prof', session_id=session_id, directory=directory))
+    if not paths: return []
+    stats = pstats.Stats(*paths, stream=io.StringIO())
+    merged_path = _path('cprofile', 'prof', 'all', session_id, directory)
+    stats.dump_stats(merged_path)
+    stats.sort_stats('tottime').print_stats(top)
+    return ['', f'Top {top} functions by own time of {len(paths)} workers (merged profile: {merged_path})', stats.stream.getvalue()]
+
+
+def _sampling_report(session_id, directory, top):
+    paths = glob.glob(_path('sampling', 'folded', session_id=session_id, directory=directory))
+    if not paths: return []
+    samples = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, n = line.rsplit(' ', 1)
+                samples[stack] = samples.get(stack, 0) + int(n)
+    merged_path = _path('sampling', 'folded', 'all', session_id, directory)
+    with open(merged_path, 'w') as f:
+        f.writelines(f'{stack} {n}\n' for stack, n in samples.items())
+    own, inclusive = {}, {}
+    for stack, n in samples.items():
+        functions = stack.split(';')
+        own[functions[-1]] = own.get(functions[-1], 0) + n
+        for function in set(functions):
+            inclusive[function] = inclusive.get(function, 0) + n
+    total = sum(samples.values())
+    lines = ['', f'Top {top} functions of {total} samples of {len(paths)} workers (merged stacks: {merged_path})',
+             f'{"own %":>7} {"total %":>8}  function']
+    for function, n in sorted(own.items(), key=lambda x: -x[1])[:top]:
+        lines.append(f'{100 * n / total:>7.1f} {100 * inclusive[function] / total:>8.1f}  {function}')
+    return lines
+
+
+def report(session_id, directory='profiles', top=30):
+    # Merges the files of the workers of a session. Logs the report, saves it in the directory and returns it.
+    periods = _load_periods(session_id, directory)
+    if not periods:
+        logger.warning(f'No profiled periods for session {session_id} in {directory}')
+        return None
+    lines = [f'Profile of session {session_id}: {len(periods)} periods in {len({p["pid"] for p in periods})} processes', '']
+    lines += _stages_report(periods)
+    lines += _cprofile_report(session_id, directory, top)
+    lines += _sampling_report(session_id, directory, top)
+    txt = '\n'.join(lines)
+    with open(_path('report', 'txt', 'all', session_id, directory), 'w') as f:
+        f.write(txt + '\n')
+    logger.info(f'\n{txt}')
+    return txt
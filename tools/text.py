@@ -0,0 +1,38 @@
+# --------------------------------------------------------------------------------------------------------
+# 2020/07/28
+# src - text.py
+# md
+# --------------------------------------------------------------------------------------------------------
+import re
+from collections import Counter
+
+# Dutch stopwords of nltk, with some Flemish and tweet specific additions
+DUTCH_STOPWORDS = {
+    'de', 'en', 'van', 'ik', 'te', 'dat', 'die', 'in', 'een', 'hij', 'het', 'niet', 'zijn', 'is', 'was', 'op', 'aan', 'met', 'als', 'voor', 'had',
+    'er', 'maar', 'om', 'hem', 'dan', 'zou', 'of', 'wat', 'mijn', 'men', 'dit', 'zo', 'door', 'over', 'ze', 'zich', 'bij', 'ook', 'tot', 'je',
+    'mij', 'uit', 'der', 'daar', 'haar', 'naar', 'heb', 'hoe', 'heeft', 'hebben', 'deze', 'u', 'want', 'nog', 'zal', 'me', 'zij', 'nu', 'ge',
+    'geen', 'omdat', 'iets', 'worden', 'toch', 'al', 'waren', 'veel', 'meer', 'doen', 'toen', 'moet', 'ben', 'zonder', 'kan', 'hun', 'dus',
+    'alles', 'onder', 'ja', 'eens', 'hier', 'wie', 'werd', 'altijd', 'doch', 'wordt', 'wezen', 'kunnen', 'ons', 'zelf', 'tegen', 'na', 'reeds',
+    'wil', 'kon', 'niets', 'uw', 'iemand', 'geweest', 'andere',
+    'we', 'wij', 'jullie', 'onze', 'jouw', 'uw', 'wel', 'gaan', 'gaat', 'moeten', 'zullen', 'alle', 'echt', 'waar', 'nie', 'da', 'ne', 'gij',
+    'rt', 'amp', 'via', 'https', 'http'}
+
+_url_pattern = re.compile(r'https?://\S+|pic\.twitter\.com/\S+|www\.\S+')
+_mention_pattern = re.compile(r'@\w+')
+_word_pattern = re.compile(r"[^\W\d_]+(?:['’-][^\W\d_]+)*")  # Letters only, 'zo\'n' and 'ex-minister' are one word
+
+
+def tokenize(text, stopwords=DUTCH_STOPWORDS, min_length=3):
+    """
+    Lowercase words of a tweet for word clouds, without urls, @mentions, numbers and stopwords. Hashtags count as their word.
+    """
+    if not text: return []
+    text = _mention_pattern.sub(' ', _url_pattern.sub(' ', text.lower()))
+    return [word for word in _word_pattern.findall(text) if len(word) >= min_length and word not in stopwords]
+
+
+def count_terms(texts, stopwords=DUTCH_STOPWORDS, min_length=3):
+    counter = Counter()
+    for text in texts:
+        counter.update(tokenize(text, stopwords, min_length))
+    return counter
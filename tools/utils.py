@@ -8,6 +8,8 @@ import urllib
 from urllib import parse
 import pandas as pd
 
+import config
+
 
 def current_datetime(alt: str = False) -> [datetime.datetime, str]:
     """Returns current datetime object by default. Accepts alternate format for string format result."""
@@ -43,6 +45,12 @@ def set_pandas_display_options():
     pd.set_option('display.width', 1000)
 
 
+def users_list_usernames(party=None):
+    """All usernames of config.USERS_LIST, or of one party (a key of USERS_LIST), sorted and lowercase like in the database"""
+    groups = [config.USERS_LIST[party]] if party is not None else config.USERS_LIST.values()
+    return sorted({username.lower() for usernames in groups for username in usernames})
+
+
 if __name__ == '__main__':
     print(current_datetime('%Y:%m:%d'))
     print(dict_to_query({'a': 1, 'b': current_date()}))